@@ -0,0 +1,37 @@
+import argparse
+import time
+from src.gmail.client import GmailClient
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+from src.gmail.scheduler import RequestScheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sequential vs batched message fetching against the fake Gmail server.")
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every HTTP request")
+    parser.add_argument('--sample', type=int, default=100, help="messages fetched one at a time for the baseline")
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with FakeGmailServer(FakeMailbox(args.messages), latency=args.latency) as server:
+        client = GmailClient(api_endpoint=server.url, scheduler=RequestScheduler(rate=None))
+        ids = server.mailbox.ordered_ids()
+
+        start = time.perf_counter()
+        for msg_id in ids[:args.sample]:
+            client.get_message(msg_id)
+        sequential_rate = args.sample / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        fetched = sum(1 for _, message in client.get_messages(ids, max_workers=args.workers) if message)
+        batched_time = time.perf_counter() - start
+        batched_rate = fetched / batched_time
+
+    print(f"{args.messages} messages, {args.latency * 1000:.0f}ms per request")
+    print(f"  sequential get_message: {sequential_rate:8.1f} msg/s (sampled {args.sample})")
+    print(f"  batched get_messages:   {batched_rate:8.1f} msg/s ({fetched} in {batched_time:.1f}s)")
+    print(f"  speedup:                {batched_rate / sequential_rate:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from benchmarks.synthetic import make_email_data
+from src.database.ingest import existing_gmail_ids, ingest_emails
+from src.database.models import Base, Email
+
+
+def new_session(path):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)()
+
+
+def orm_path(db, rows):
+    """The original fetch_emails path: one SELECT per message, ORM adds, one commit."""
+    for row in rows:
+        if db.query(Email).filter_by(gmail_id=row['gmail_id']).first():
+            continue
+        db.add(Email(**row))
+    db.commit()
+
+
+def bulk_path(db, rows):
+    existing = existing_gmail_ids(db, [row['gmail_id'] for row in rows])
+    ingest_emails(db, (row for row in rows if row['gmail_id'] not in existing))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-row ORM storage against bulk ingestion.")
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--sample', type=int, default=20000, help="messages stored through the ORM baseline")
+    parser.add_argument('--body-words', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    rows = [make_email_data(index, rng, now, args.body_words) for index in range(args.messages)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = new_session(os.path.join(tmp, 'orm.db'))
+        start = time.perf_counter()
+        orm_path(db, rows[:args.sample])
+        orm_rate = args.sample / (time.perf_counter() - start)
+        db.close()
+
+        db = new_session(os.path.join(tmp, 'bulk.db'))
+        start = time.perf_counter()
+        bulk_path(db, rows)
+        bulk_time = time.perf_counter() - start
+
+        # A second pass over the same messages only pays for the dedup lookups
+        start = time.perf_counter()
+        bulk_path(db, rows)
+        rerun_time = time.perf_counter() - start
+        assert db.query(Email).count() == args.messages
+        db.close()
+
+    print(f"{args.messages} synthetic messages")
+    print(f"  ORM per-row:      {orm_rate:10,.0f} msg/s (sampled {args.sample})")
+    print(f"  bulk ingest:      {args.messages / bulk_time:10,.0f} msg/s ({bulk_time:.1f}s)")
+    print(f"  bulk re-ingest:   {args.messages / rerun_time:10,.0f} msg/s (all duplicates)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import argparse
+import random
+import string
+import time
+from src.rules.matcher import PatternAutomaton
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the substring automaton against per-pattern searches.")
+    parser.add_argument('--body-words', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 9))) for _ in range(4000)]
+    text = ' '.join(rng.choice(words) for _ in range(args.body_words))
+
+    print(f"body of {len(text)} characters")
+    for count in (16, 64, 256, 1024, 4000):
+        patterns = words[:count]
+        automaton = PatternAutomaton(patterns)
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            automaton.scan(text)
+        automaton_time = (time.perf_counter() - start) / args.repeat
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            {pattern_id for pattern_id, pattern in enumerate(patterns) if pattern in text}
+        naive_time = (time.perf_counter() - start) / args.repeat
+
+        print(f"  {count:5d} patterns: automaton {automaton_time * 1e3:6.2f}ms, per-pattern {naive_time * 1e3:6.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import time
+from benchmarks.synthetic import make_emails, make_rules, make_sender_rules
+from src.rules.engine import RuleEngine
+
+
+def run(engine, emails, rules, evaluate):
+    start = time.perf_counter()
+    matches = evaluate(engine, emails, rules)
+    return time.perf_counter() - start, matches
+
+
+def interpreted(engine, emails, rules):
+    return sum(engine.evaluate_rule(email, rule) for email in emails for rule in rules)
+
+
+def compiled(engine, emails, rules):
+    compiled_rules = engine.compile_rules(rules)
+    return sum(engine.evaluate_rule(email, rule) for email in emails for rule in compiled_rules)
+
+
+def dispatched(engine, emails, rules):
+    compiled_rules = engine.compile_rules(rules)
+    return sum(len(engine.matching_rules(email, compiled_rules)) for email in emails)
+
+
+def columnar(engine, emails, rules, chunk_size=1000):
+    compiled_rules = engine.compile_rules(rules)
+    return sum(len(matched)
+               for start in range(0, len(emails), chunk_size)
+               for matched in engine.matching_rules_batch(emails[start:start + chunk_size], compiled_rules))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark interpreted vs compiled rule evaluation.")
+    parser.add_argument('--emails', type=int, default=5000)
+    parser.add_argument('--rules', type=int, default=40)
+    parser.add_argument('--sender-rules', type=int, default=0,
+                        help="add rules on a single sender or sender domain, as most production rules are")
+    args = parser.parse_args()
+
+    emails = make_emails(args.emails)
+    rules = make_rules(args.rules) + make_sender_rules(args.sender_rules)
+    engine = RuleEngine(gmail_client=None)
+
+    base_time, base_matches = run(engine, emails, rules, interpreted)
+    fast_time, fast_matches = run(engine, emails, rules, compiled)
+    dispatch_time, dispatch_matches = run(engine, emails, rules, dispatched)
+    column_time, column_matches = run(engine, emails, rules, columnar)
+    assert base_matches == fast_matches, "compiled rules disagree with the interpreter"
+    assert base_matches == dispatch_matches, "dispatched rules disagree with the interpreter"
+    assert base_matches == column_matches, "columnar evaluation disagrees with the interpreter"
+
+    checks = len(emails) * len(rules)
+    print(f"{len(emails)} emails x {len(rules)} rules ({base_matches} matches)")
+    print(f"  interpreted: {base_time:.3f}s ({checks / base_time:,.0f} rule checks/s)")
+    print(f"  compiled:    {fast_time:.3f}s ({checks / fast_time:,.0f} rule checks/s)")
+    print(f"  dispatched:  {dispatch_time:.3f}s ({checks / dispatch_time:,.0f} rule checks/s)")
+    print(f"  columnar:    {column_time:.3f}s ({checks / column_time:,.0f} rule checks/s)")
+    print(f"  speedup:     {base_time / fast_time:.1f}x compiled, {base_time / dispatch_time:.1f}x dispatched, "
+          f"{base_time / column_time:.1f}x columnar")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from contextlib import redirect_stdout
+from sqlalchemy.orm import sessionmaker
+from benchmarks.synthetic import make_rules
+from scripts import process_emails as process_script
+from scripts.fetch_emails import fetch_emails
+from src.database.models import Email
+from src.database.schema import upgrade_schema
+from src.database.sqlite import create_database_engine
+from src.gmail.client import GmailClient
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+from src.gmail.scheduler import RequestScheduler
+from src.rules import processing
+from src.rules.engine import RuleEngine
+from src.rules.parser import RuleParser
+
+
+class TimedGmailClient(GmailClient):
+    """GmailClient recording how long each HTTP batch fetch takes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_times = []
+
+    def _get_batch(self, msg_ids, format, metadata_headers=None):
+        start = time.perf_counter()
+        try:
+            return super()._get_batch(msg_ids, format, metadata_headers)
+        finally:
+            self.batch_times.append(time.perf_counter() - start)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def report(name, count, elapsed, latencies, unit):
+    print(f"  {name:<12} {count / elapsed:>10,.0f} msg/s   "
+          f"p50 {percentile(latencies, 50) * 1000:8.2f}ms   p99 {percentile(latencies, 99) * 1000:8.2f}ms   ({unit})")
+
+
+def bench_fetch(server, session_factory, count, rules_file):
+    client = TimedGmailClient(api_endpoint=server.url, scheduler=RequestScheduler(rate=None))
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        fetch_emails(max_results=count, gmail_client=client, session_factory=session_factory, rules_file=rules_file)
+    elapsed = time.perf_counter() - start
+    report('fetch', count, elapsed, client.batch_times, 'per HTTP batch')
+
+
+def bench_engine(session_factory, rules):
+    db = session_factory()
+    emails = db.query(Email).all()
+    engine = RuleEngine(gmail_client=None)
+    compiled_rules = engine.compile_rules(rules)
+    latencies = []
+    start = time.perf_counter()
+    for email in emails:
+        began = time.perf_counter()
+        engine.matching_rules(email, compiled_rules)
+        latencies.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    db.close()
+    report('rule engine', len(emails), elapsed, latencies, 'per email')
+
+
+def bench_process(server, session_factory, count, rules_file):
+    client = GmailClient(api_endpoint=server.url, scheduler=RequestScheduler(rate=None))
+    chunk_times = []
+    iter_email_chunks = processing.iter_email_chunks
+
+    def timed_chunks(*args, **kwargs):
+        # Time from asking for a chunk to asking for the next: loading, evaluation and actions
+        began = time.perf_counter()
+        for chunk in iter_email_chunks(*args, **kwargs):
+            yield chunk
+            chunk_times.append(time.perf_counter() - began)
+            began = time.perf_counter()
+
+    processing.iter_email_chunks = timed_chunks
+    try:
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            process_script.process_emails(gmail_client=client, session_factory=session_factory,
+                                          rules_file=rules_file)
+        elapsed = time.perf_counter() - start
+    finally:
+        processing.iter_email_chunks = iter_email_chunks
+    report('process', count, elapsed, chunk_times, f'per {processing.CHUNK_SIZE}-email chunk')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput of fetch, rule evaluation and processing "
+                                                 "against the fake Gmail server.")
+    parser.add_argument('--sizes', default='1000,10000,100000', help="comma-separated mailbox sizes")
+    parser.add_argument('--rules', type=int, default=40)
+    parser.add_argument('--body-words', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every HTTP request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of API calls answered with a 429")
+    args = parser.parse_args()
+
+    for count in (int(size) for size in args.sizes.split(',')):
+        mailbox = FakeMailbox(count, body_words=args.body_words)
+        with tempfile.TemporaryDirectory() as tmp, \
+                FakeGmailServer(mailbox, latency=args.latency, error_rate=args.error_rate) as server:
+            # The production database setup (WAL, pool, indexes); rules and their cache stay out of config/
+            engine = create_database_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+            upgrade_schema(engine)
+            session_factory = sessionmaker(bind=engine)
+            rules = make_rules(args.rules)
+            rules_file = os.path.join(tmp, 'rules.json')
+            with open(rules_file, 'w') as f:
+                json.dump({'rules': [RuleParser.rule_to_dict(rule) for rule in rules]}, f)
+
+            print(f"{count} messages, {args.rules} rules, {args.latency * 1000:.0f}ms latency, "
+                  f"{args.error_rate:.0%} errors")
+            bench_fetch(server, session_factory, count, rules_file)
+            bench_engine(session_factory, rules)
+            bench_process(server, session_factory, count, rules_file)
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import random
+from datetime import datetime, timedelta
+from src.database.models import Email, Rule, RuleCondition, RuleAction
+from src.gmail.fake_server import SENDERS, WORDS
+
+
+def make_email_data(index, rng, now, body_words=200):
+    """Build the parsed-message dict for one synthetic email."""
+    subject = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+    return {
+        'gmail_id': f'msg{index:08d}',
+        'thread_id': f'thread{index // 3:08d}',
+        'from_address': rng.choice(SENDERS),
+        'to_address': 'me@example.com',
+        'subject': subject,
+        'message': ' '.join(rng.choice(WORDS) for _ in range(body_words)),
+        'received_date': now - timedelta(minutes=rng.randint(0, 60 * 24 * 60)),
+        'is_read': rng.random() < 0.5,
+    }
+
+
+def make_emails(count, seed=0, body_words=200):
+    """Build `count` transient Email objects with a deterministic mix of senders and words."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    return [Email(**make_email_data(i, rng, now, body_words)) for i in range(count)]
+
+
+def make_rules(count, seed=0):
+    """Build `count` transient rules mixing text, date and read-state conditions."""
+    rng = random.Random(seed)
+    rules = []
+    for i in range(count):
+        rule = Rule(name=f'Rule {i}', predicate=rng.choice(['all', 'any']))
+        rule.conditions = [
+            RuleCondition(field='subject', predicate=rng.choice(['contains', 'not_contains']),
+                          value=rng.choice(WORDS)),
+            RuleCondition(field='from', predicate=rng.choice(['contains', 'equals']),
+                          value=rng.choice(SENDERS)),
+            RuleCondition(field='message', predicate='contains',
+                          value=f'{rng.choice(WORDS)} {rng.choice(WORDS)}'),
+            RuleCondition(field='received_date', predicate=rng.choice(['less_than', 'greater_than']),
+                          value=f'{rng.randint(1, 30)} days'),
+            RuleCondition(field='is_read', predicate='equals', value=rng.choice(['true', 'false'])),
+        ]
+        rule.actions = [RuleAction(action_type='mark_as_read')]
+        rules.append(rule)
+    return rules
+
+
+def make_sender_rules(count, seed=0):
+    """Build `count` transient rules of the common production shape: a sender or sender domain,
+    sometimes narrowed by a subject pattern."""
+    rng = random.Random(seed)
+    domains = sorted({sender.split('@')[1] for sender in SENDERS})
+    rules = []
+    for i in range(count):
+        # Most rules name senders that only rarely write
+        sender = rng.choice(SENDERS) if rng.random() < 0.05 else f'user{i}@company{i % 50}.com'
+        kind = rng.random()
+        if kind < 0.6:
+            conditions = [RuleCondition(field='from', predicate='equals', value=sender)]
+        elif kind < 0.9:
+            domain = rng.choice(domains) if rng.random() < 0.05 else sender.split('@')[1]
+            conditions = [RuleCondition(field='from', predicate='domain_is', value=domain)]
+        else:
+            conditions = [RuleCondition(field='from', predicate='starts_with', value=sender.split('@')[0]),
+                          RuleCondition(field='subject', predicate='matches',
+                                        value=rf'^{rng.choice(WORDS)}\b')]
+        rule = Rule(name=f'Sender rule {i}', predicate='all')
+        rule.conditions = conditions
+        rule.actions = [RuleAction(action_type='move_to', value='Filed')]
+        rules.append(rule)
+    return rules
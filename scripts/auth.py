@@ -1,10 +1,16 @@
 from src.gmail.auth import authenticate
+import argparse
 
 def main():
+    parser = argparse.ArgumentParser(description="Authorize access to a Gmail mailbox.")
+    parser.add_argument('--token-file', default=None,
+                        help="where to save the token, e.g. one per mailbox listed in config/accounts.json")
+    args = parser.parse_args()
+    
     print("Starting Gmail authentication...")
-    service = authenticate()
+    service = authenticate(args.token_file)
     print("Authentication successful!")
     print("You can now use the Gmail API.")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
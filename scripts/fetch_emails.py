@@ -1,39 +1,46 @@
 from src.gmail.client import GmailClient
 from src.database.session import SessionLocal
-from src.database.models import Email
+from src.database.ingest import EmailIngestor, existing_gmail_ids
+from src.gmail.sync import MailboxSync
+from src.rules.parser import RuleParser
+from src.rules.planner import plan_fetch
+from src.metrics import export_metrics, metrics
+import argparse
+import os
 import sys
 
-def fetch_emails(max_results=100):
+def load_fetch_plan(db, rules_file=None):
+    """Plan the message format from the stored rules (loading them from JSON on first use)."""
+    rule_parser = RuleParser(rules_file or os.path.join('config', 'rules.json'))
+    plan = plan_fetch(rule_parser.load_rules(db))
+    print(f"Fetching messages with format='{plan.format}'")
+    return plan
+
+def fetch_emails(max_results=100, query=None, label_ids=None, gmail_client=None, session_factory=SessionLocal,
+                 rules_file=None):
     """Fetch emails from Gmail and store them in the database."""
-    gmail_client = GmailClient()
-    db = SessionLocal()
+    gmail_client = gmail_client or GmailClient()
+    db = session_factory()
     
     try:
         # Get messages from Gmail
-        messages = gmail_client.list_messages(max_results=max_results)
+        messages = gmail_client.list_messages(max_results=max_results, query=query, label_ids=label_ids)
         print(f"Found {len(messages)} messages in Gmail")
         
-        # Process each message
-        for message in messages:
-            # Check if email already exists in database
-            existing_email = db.query(Email).filter_by(gmail_id=message['id']).first()
-            if existing_email:
-                continue
-            
-            # Get full message details
-            full_message = gmail_client.get_message(message['id'])
-            if not full_message:
-                continue
-            
-            # Parse message
-            email_data = gmail_client.parse_message(full_message)
-            
-            # Create email record
-            email = Email(**email_data)
-            db.add(email)
+        # Skip messages that are already stored
+        existing = existing_gmail_ids(db, [message['id'] for message in messages])
+        new_ids = [message['id'] for message in messages if message['id'] not in existing]
+        
+        # Fetch the message details the rules need in HTTP batches and insert them in
+        # committed chunks
+        plan = load_fetch_plan(db, rules_file)
+        with EmailIngestor(db) as ingestor:
+            for msg_id, message in gmail_client.get_messages(new_ids, format=plan.format,
+                                                             metadata_headers=plan.metadata_headers):
+                if message:
+                    ingestor.add(gmail_client.parse_message(message))
         
-        db.commit()
-        print("Successfully fetched and stored emails")
+        print(f"Successfully fetched and stored {ingestor.inserted} emails")
     
     except Exception as e:
         db.rollback()
@@ -42,9 +49,64 @@ def fetch_emails(max_results=100):
     finally:
         db.close()
 
+def sync_emails(max_results=100, query=None, label_ids=None):
+    """Bring the database up to date with Gmail using the stored historyId."""
+    gmail_client = GmailClient()
+    db = SessionLocal()
+    
+    try:
+        stats = MailboxSync(gmail_client, db, max_results=max_results, query=query, label_ids=label_ids,
+                            fetch_plan=load_fetch_plan(db)).sync()
+        print(f"Added {stats['added']}, relabelled {stats['relabelled']}, deleted {stats['deleted']} emails")
+    
+    except Exception as e:
+        db.rollback()
+        print(f"Error syncing emails: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+def backfill_emails(query=None, label_ids=None):
+    """Store every matching message, resuming an interrupted backfill from its saved cursor."""
+    gmail_client = GmailClient()
+    db = SessionLocal()
+    
+    try:
+        added = MailboxSync(gmail_client, db, fetch_plan=load_fetch_plan(db)).backfill(query=query, label_ids=label_ids)
+        print(f"Backfill complete, added {added} emails")
+    
+    except Exception as e:
+        db.rollback()
+        print(f"Error during backfill, rerun to resume: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
 def main():
+    parser = argparse.ArgumentParser(description="Fetch emails from Gmail into the database.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="sync only the changes since the last run using the Gmail history")
+    parser.add_argument('--backfill', action='store_true',
+                        help="page through every matching message; resumes where an interrupted run stopped")
+    parser.add_argument('--max-results', type=int, default=100)
+    parser.add_argument('--query', help="Gmail search query, e.g. 'newer_than:7d is:unread'")
+    parser.add_argument('--label', dest='label_ids', action='append', help="only messages with this label id")
+    parser.add_argument('--metrics-dir', default=None,
+                        help="record Gmail API metrics and write metrics.json/metrics.prom here")
+    args = parser.parse_args()
+    if args.metrics_dir:
+        metrics.enable()
+    
     print("Starting email fetch process...")
-    fetch_emails()
+    try:
+        if args.backfill:
+            backfill_emails(query=args.query, label_ids=args.label_ids)
+        elif args.incremental:
+            sync_emails(max_results=args.max_results, query=args.query, label_ids=args.label_ids)
+        else:
+            fetch_emails(max_results=args.max_results, query=args.query, label_ids=args.label_ids)
+    finally:
+        export_metrics(args.metrics_dir)
     print("Email fetch process completed!")
 
 if __name__ == "__main__":
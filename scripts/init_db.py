@@ -1,9 +1,15 @@
 from src.database.session import init_db
+import argparse
 
 def main():
-    print("Initializing database...")
-    init_db()
+    parser = argparse.ArgumentParser(description="Create the database, or upgrade an existing one in place.")
+    parser.add_argument('--reset', action='store_true',
+                        help="drop every table first, deleting all stored emails, rules and state")
+    args = parser.parse_args()
+
+    print("Resetting database..." if args.reset else "Initializing database...")
+    init_db(reset=args.reset)
     print("Database initialization completed!")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -1,25 +1,25 @@
 from src.gmail.client import GmailClient
+from src.gmail.labels import LabelStore
 from src.database.session import SessionLocal
-from src.database.models import Email
-from src.rules.engine import RuleEngine
+from src.rules.compiler import compile_rules
 from src.rules.parser import RuleParser
+from src.rules.processing import process_stored_emails
+from src.rules.selectivity import load_condition_stats, refresh_condition_stats
+from src.metrics import export_metrics, metrics, print_hot_rules
+import argparse
 import os
 import sys
 
-def process_emails():
-    """Process emails based on rules."""
-    gmail_client = GmailClient()
-    db = SessionLocal()
-    rules_file = os.path.join('config', 'rules.json')
+def process_emails(reprocess=False, gmail_client=None, session_factory=SessionLocal, workers=1, rules_file=None):
+    """Process emails based on rules (see rules.processing.process_stored_emails)."""
+    gmail_client = gmail_client or GmailClient(label_store=LabelStore(session_factory))
+    db = session_factory()
+    rules_file = rules_file or os.path.join('config', 'rules.json')
     
     try:
-        # Load rules
+        # Load rules, picking up changes to the JSON file
         rule_parser = RuleParser(rules_file)
-        rules = rule_parser.get_rules_from_db(db)
-        
-        if not rules:
-            print("No rules found in database. Loading from JSON file...")
-            rules = rule_parser.save_rules_to_db(db)
+        rules = rule_parser.load_rules(db)
         
         if not rules:
             print("No rules found. Please create rules in config/rules.json")
@@ -27,25 +27,17 @@ def process_emails():
         
         print(f"Loaded {len(rules)} rules")
         
-        # Initialize rule engine
-        rule_engine = RuleEngine(gmail_client)
-        
-        # Get unprocessed emails
-        emails = db.query(Email).all()
-        print(f"Processing {len(emails)} emails")
+        # Compile the rules once for this run, ordering each rule's conditions by the hit
+        # rates measured in earlier runs
+        compiled_rules = compile_rules(rules, stats=load_condition_stats(db))
         
-        # Process each email
-        for email in emails:
-            # Refresh the email object to ensure it's bound to the current session
-            db.refresh(email)
-            results = rule_engine.process_email(email, rules)
-            if results:
-                print(f"Email {email.gmail_id} matched rules:")
-                for result in results:
-                    print(f"  Rule: {result['rule_name']}")
-                    for action in result['actions']:
-                        status = "successful" if action['success'] else "failed"
-                        print(f"    Action: {action['action_type']} - {status}")
+        total = process_stored_emails(gmail_client, db, compiled_rules, reprocess=reprocess, workers=workers)
+        print(f"Processed {total} candidate emails")
+        if metrics.enabled:
+            print("Slowest rules:")
+            print_hot_rules()
+        # Sampled again only when the conditions changed or the saved rates grew old
+        refresh_condition_stats(db, compiled_rules)
             
     except Exception as e:
         print(f"Error processing emails: {e}")
@@ -54,8 +46,22 @@ def process_emails():
         db.close()
 
 def main():
+    parser = argparse.ArgumentParser(description="Apply the rules to stored emails.")
+    parser.add_argument('--reprocess', action='store_true',
+                        help="evaluate every email again, even those the current rules already handled")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="evaluate the rules in this many processes (for large backlogs)")
+    parser.add_argument('--metrics-dir', default=None,
+                        help="record rule and API metrics and write metrics.json/metrics.prom here")
+    args = parser.parse_args()
+    if args.metrics_dir:
+        metrics.enable()
+    
     print("Starting email processing...")
-    process_emails()
+    try:
+        process_emails(reprocess=args.reprocess, workers=args.workers)
+    finally:
+        export_metrics(args.metrics_dir)
     print("Email processing completed!")
 
 if __name__ == "__main__":
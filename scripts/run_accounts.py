@@ -0,0 +1,99 @@
+from src.accounts import ACCOUNTS_FILE, MultiAccountRunner, detached_rules, load_accounts
+from src.database.session import SessionLocal
+from src.rules.parser import RuleParser
+from src.rules.selectivity import load_condition_stats
+from src.metrics import export_metrics, metrics
+import argparse
+import os
+import sys
+import time
+
+def reload_rules(runner, rule_parser):
+    """Give the runner the rules of a changed rules file; returns the hash of the file seen.
+
+    A file that fails to load keeps the current rules until it changes again.
+    """
+    db = SessionLocal()
+    rules_hash = rule_parser.file_hash()
+    try:
+        rules = rule_parser.load_rules(db)
+        runner.set_rules(detached_rules(rules), load_condition_stats(db))
+        print(f"Reloaded {len(rules)} rules")
+    except Exception as e:
+        db.rollback()
+        print(f"Error reloading rules, keeping the current ones: {e}")
+    finally:
+        db.close()
+    return rules_hash
+
+def run_accounts(accounts_file=ACCOUNTS_FILE, workers=8, interval=None, reprocess=False):
+    """Fetch and process every mailbox in the accounts file, once or every `interval` seconds."""
+    db = SessionLocal()
+    
+    try:
+        accounts = load_accounts(accounts_file)
+        if not accounts:
+            print(f"No accounts found. Please list them in {accounts_file}")
+            return
+        
+        # The rules live in the main database and are loaded once for all mailboxes
+        rule_parser = RuleParser(os.path.join('config', 'rules.json'))
+        rules = rule_parser.load_rules(db)
+        if not rules:
+            print("No rules found. Please create rules in config/rules.json")
+            return
+        runner = MultiAccountRunner(accounts, detached_rules(rules), max_workers=workers, reprocess=reprocess,
+                                    condition_stats=load_condition_stats(db))
+        rules_hash = rule_parser.file_hash()
+        print(f"Loaded {len(rules)} rules for {len(accounts)} accounts")
+    
+    except Exception as e:
+        print(f"Error starting the account runner: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+    
+    try:
+        while True:
+            started = time.monotonic()
+            if rule_parser.file_hash() != rules_hash:
+                rules_hash = reload_rules(runner, rule_parser)
+            results = runner.run()
+            failed = sorted(name for name, stats in results.items() if 'error' in stats)
+            added = sum(stats.get('added', 0) for stats in results.values())
+            processed = sum(stats.get('processed', 0) for stats in results.values())
+            print(f"Round done in {time.monotonic() - started:.1f}s: {len(results) - len(failed)} accounts, "
+                  f"added {added} emails, processed {processed} candidates")
+            if failed:
+                print(f"Failed accounts: {', '.join(failed)}")
+            if interval is None:
+                break
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch and process many mailboxes from one process.")
+    parser.add_argument('--accounts', default=ACCOUNTS_FILE, help="accounts file (default config/accounts.json)")
+    parser.add_argument('--workers', type=int, default=8, help="mailboxes worked on concurrently")
+    parser.add_argument('--interval', type=float, default=None,
+                        help="keep running, starting a new round every this many seconds")
+    parser.add_argument('--reprocess', action='store_true',
+                        help="evaluate every email again, even those the current rules already handled")
+    parser.add_argument('--metrics-dir', default=None,
+                        help="record rule and API metrics and write metrics.json/metrics.prom here")
+    args = parser.parse_args()
+    if args.metrics_dir:
+        metrics.enable()
+    
+    print("Starting multi-account run...")
+    try:
+        run_accounts(args.accounts, args.workers, args.interval, args.reprocess)
+    finally:
+        export_metrics(args.metrics_dir)
+    print("Multi-account run completed!")
+
+if __name__ == "__main__":
+    main()
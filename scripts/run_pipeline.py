@@ -0,0 +1,67 @@
+from src.gmail.client import GmailClient
+from src.gmail.labels import LabelStore
+from src.database.session import SessionLocal
+from src.pipeline import EmailPipeline
+from src.rules.parser import RuleParser
+from src.rules.selectivity import load_condition_stats, refresh_condition_stats
+from src.metrics import export_metrics, metrics
+import argparse
+import os
+import sys
+
+def run_pipeline(max_results=None, query=None, label_ids=None, fetch_workers=4, act_workers=2,
+                 parse_workers=1, evaluate_workers=1):
+    """Fetch new emails and apply the rules to each batch as soon as it is stored."""
+    gmail_client = GmailClient(label_store=LabelStore(SessionLocal))
+    rules_db = SessionLocal()
+    rules_file = os.path.join('config', 'rules.json')
+    
+    try:
+        rule_parser = RuleParser(rules_file)
+        rules = rule_parser.load_rules(rules_db)
+        print(f"Loaded {len(rules)} rules")
+        
+        pipeline = EmailPipeline(gmail_client, SessionLocal, rules, query=query, label_ids=label_ids,
+                                 max_results=max_results, fetch_workers=fetch_workers, act_workers=act_workers,
+                                 parse_workers=parse_workers, evaluate_workers=evaluate_workers,
+                                 condition_stats=load_condition_stats(rules_db))
+        stats = pipeline.run()
+        # Sampled again only when the conditions changed or the saved rates grew old
+        refresh_condition_stats(rules_db, pipeline.rules)
+        print(f"Listed {stats['listed']}, skipped {stats['skipped']} already stored, "
+              f"stored {stats['stored']}, matched {stats['matched']}, failed to fetch {stats['failed']}")
+    
+    except Exception as e:
+        print(f"Error running pipeline: {e}")
+        sys.exit(1)
+    finally:
+        rules_db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch emails and apply the rules in one pipelined pass.")
+    parser.add_argument('--max-results', type=int, default=None, help="stop after listing this many messages")
+    parser.add_argument('--query', default=None, help="Gmail search query, e.g. 'newer_than:7d'")
+    parser.add_argument('--label', dest='label_ids', action='append', default=None,
+                        help="only list messages with this label id (repeatable)")
+    parser.add_argument('--fetch-workers', type=int, default=4, help="HTTP batches fetched concurrently")
+    parser.add_argument('--act-workers', type=int, default=2, help="action batches sent concurrently")
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help="parse messages in this many processes (1 parses on a thread)")
+    parser.add_argument('--evaluate-workers', type=int, default=1,
+                        help="evaluate the rules in this many processes (1 evaluates on a thread)")
+    parser.add_argument('--metrics-dir', default=None,
+                        help="record rule and API metrics and write metrics.json/metrics.prom here")
+    args = parser.parse_args()
+    if args.metrics_dir:
+        metrics.enable()
+    
+    print("Starting email pipeline...")
+    try:
+        run_pipeline(args.max_results, args.query, args.label_ids, args.fetch_workers, args.act_workers,
+                     args.parse_workers, args.evaluate_workers)
+    finally:
+        export_metrics(args.metrics_dir)
+    print("Email pipeline completed!")
+
+if __name__ == "__main__":
+    main()
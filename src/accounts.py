@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy.orm import sessionmaker
+from .database.schema import upgrade_schema
+from .database.sqlite import create_database_engine
+from .gmail.auth import get_gmail_service
+from .gmail.client import GmailClient
+from .gmail.labels import LabelStore
+from .gmail.scheduler import QUOTA_RATE, RequestScheduler
+from .gmail.sync import MailboxSync
+from .rules.compiler import compile_rules
+from .rules.parser import RuleParser
+from .rules.planner import plan_fetch
+from .rules.processing import process_stored_emails
+
+ACCOUNTS_FILE = os.getenv('GMAIL_ACCOUNTS_FILE', os.path.join('config', 'accounts.json'))
+# Where mailboxes without a database_url keep their SQLite database
+MAILBOX_DIR = os.getenv('GMAIL_MAILBOX_DIR', 'mailboxes')
+
+
+class Account:
+    """One mailbox to fetch and process, as listed in the accounts file.
+
+    Every account has its own OAuth token and its own database (emails, ledger, labels
+    and sync state), so mailboxes never see each other's messages.
+    """
+
+    __slots__ = ('name', 'token_file', 'database_url', 'api_endpoint', 'query', 'label_ids', 'max_results')
+
+    def __init__(self, name: str, token_file: Optional[str] = None, database_url: Optional[str] = None,
+                 api_endpoint: Optional[str] = None, query: Optional[str] = None,
+                 label_ids: Optional[List[str]] = None, max_results: int = 100):
+        self.name = name
+        self.token_file = token_file or os.path.join('tokens', f'{name}.pickle')
+        self.database_url = database_url or f"sqlite:///{os.path.join(MAILBOX_DIR, name + '.db')}"
+        self.api_endpoint = api_endpoint
+        self.query = query
+        self.label_ids = label_ids
+        self.max_results = max_results
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Account':
+        return cls(data['name'], token_file=data.get('token_file'), database_url=data.get('database_url'),
+                   api_endpoint=data.get('api_endpoint'), query=data.get('query'),
+                   label_ids=data.get('label_ids'), max_results=data.get('max_results', 100))
+
+    def __repr__(self):
+        return f"<Account(name='{self.name}')>"
+
+
+def load_accounts(path: str = ACCOUNTS_FILE) -> List[Account]:
+    """Read the accounts file: {"accounts": [{"name": ..., "token_file": ..., ...}, ...]}."""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    accounts = [Account.from_dict(entry) for entry in data.get('accounts', [])]
+    names = [account.name for account in accounts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate account names in {path}: {', '.join(duplicates)}")
+    return accounts
+
+
+class Mailbox:
+    """The long-lived resources of one account: database engine, Gmail service and client.
+
+    They are created the first time the account is worked on and reused by every later
+    round, so the discovery document, OAuth token, HTTP connections and label cache are
+    set up once per process. Each mailbox has its own RequestScheduler, since Gmail
+    quotas are per user: one mailbox being throttled never slows the others down.
+    """
+
+    def __init__(self, account: Account, api_endpoint: Optional[str] = None, quota_rate: Optional[float] = QUOTA_RATE):
+        self.account = account
+        if account.database_url.startswith('sqlite:///'):
+            directory = os.path.dirname(account.database_url[len('sqlite:///'):])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        # Pool threads take turns on a mailbox, so its SQLite connections move between threads
+        # (create_database_engine allows that); databases from older versions are upgraded
+        self.engine = create_database_engine(account.database_url)
+        upgrade_schema(self.engine)
+        self.session_factory = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        api_endpoint = account.api_endpoint or api_endpoint
+        service = get_gmail_service(api_endpoint, token_file=account.token_file, interactive=False)
+        self.gmail_client = GmailClient(service=service, label_store=LabelStore(self.session_factory),
+                                        api_endpoint=api_endpoint, scheduler=RequestScheduler(rate=quota_rate))
+        # Held while a round works on the account, so two rounds never overlap on it
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.engine.dispose()
+
+
+class MultiAccountRunner:
+    """Fetches and processes many mailboxes from one process on a bounded thread pool.
+
+    The rules are compiled at the start of each round, so relative dates count from the
+    round, and shared read-only by every account. Each round syncs every mailbox (see
+    MailboxSync) and applies the rules to its new emails, with at most `max_workers`
+    mailboxes in flight. A failing account is reported and skipped without stopping the
+    others.
+
+    `rules` should be detached from any session (e.g. built with RuleParser.rule_from_dict),
+    since pool threads read them concurrently.
+    """
+
+    def __init__(self, accounts: Iterable[Account], rules, max_workers: int = 8, api_endpoint: Optional[str] = None,
+                 quota_rate: Optional[float] = QUOTA_RATE, reprocess: bool = False, condition_stats=None):
+        self.accounts = list(accounts)
+        self.set_rules(rules, condition_stats)
+        self.max_workers = max_workers
+        self.api_endpoint = api_endpoint
+        self.quota_rate = quota_rate
+        self.reprocess = reprocess
+        self.mailboxes: Dict[str, Mailbox] = {}
+        self.lock = threading.Lock()
+
+    def set_rules(self, rules, condition_stats=None):
+        """Set the rules every account is processed with; call between rounds."""
+        self.source_rules = list(rules)
+        self.condition_stats = condition_stats
+        self.compile()
+
+    def compile(self):
+        """Compile the rules against the current time."""
+        self.rules = compile_rules(self.source_rules, stats=self.condition_stats)
+        self.fetch_plan = plan_fetch(self.rules)
+
+    def mailbox(self, account: Account) -> Mailbox:
+        mailbox = self.mailboxes.get(account.name)
+        if mailbox is None:
+            # Built outside the lock so new mailboxes are set up in parallel
+            created = Mailbox(account, self.api_endpoint, self.quota_rate)
+            with self.lock:
+                mailbox = self.mailboxes.setdefault(account.name, created)
+            if mailbox is not created:
+                created.close()
+        return mailbox
+
+    def run_account(self, account: Account) -> Dict[str, int]:
+        """Sync one mailbox and apply the rules to it; returns its change and candidate counts."""
+        mailbox = self.mailbox(account)
+        with mailbox.lock:
+            db = mailbox.session_factory()
+            try:
+                stats = MailboxSync(mailbox.gmail_client, db, max_results=account.max_results, query=account.query,
+                                    label_ids=account.label_ids, fetch_plan=self.fetch_plan).sync()
+                stats['processed'] = process_stored_emails(mailbox.gmail_client, db, self.rules,
+                                                           reprocess=self.reprocess)
+                return stats
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def run(self) -> Dict[str, Dict[str, Any]]:
+        """Run one round over every account; returns {account name: counts, or {'error': message}}."""
+        # "7 days" and similar cutoffs move forward with every round
+        self.compile()
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.run_account, account): account for account in self.accounts}
+            for future in as_completed(futures):
+                account = futures[future]
+                try:
+                    results[account.name] = future.result()
+                except Exception as e:
+                    print(f"Error in account {account.name}: {e}")
+                    results[account.name] = {'error': str(e)}
+        return results
+
+    def close(self):
+        with self.lock:
+            for mailbox in self.mailboxes.values():
+                mailbox.close()
+            self.mailboxes = {}
+
+
+def detached_rules(rules) -> List:
+    """Copies of loaded rules that no session can expire or lazy-load under another thread."""
+    return [RuleParser.rule_from_dict(RuleParser.rule_to_dict(rule)) for rule in rules]
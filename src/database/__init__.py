@@ -1,3 +1,5 @@
 """
 Database models and session management
-""" 
\ No newline at end of file
+""" 
+# Registers the full-text index's DDL and ORM hooks alongside the models
+from . import fts  # noqa: F401
@@ -0,0 +1,180 @@
+import sqlite3
+import weakref
+from typing import Any, Dict, Iterable
+from sqlalchemy import column, event, insert, select, table, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.elements import ColumnElement
+from .models import Email
+from .types import CompressedText
+
+# Trigram-tokenized FTS5 index over the emails' subject and message, keyed by emails.id.
+# It is contentless: only the index is stored, the text itself stays compressed in emails.
+FTS_TABLE = 'email_fts'
+# SQL function turning a stored (possibly compressed) message back into its text
+TEXT_FUNCTION = 'email_text'
+# Trigram queries need at least this many characters; shorter values use the old paths
+FTS_MIN_LENGTH = 3
+# Rows read back and indexed per statement when (re)indexing
+INDEX_CHUNK_SIZE = 500
+
+email_fts = table(FTS_TABLE, column('rowid'), column('subject'), column('message'))
+
+# A contentless table forgets a row through the 'delete' command, given the exact text it
+# indexed. The triggers hand it the old values, so every way emails are removed or their
+# text rewritten keeps the index right; connections need TEXT_FUNCTION registered for them.
+_FORGET_OLD = (f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, subject, message) "
+               f"VALUES ('delete', old.id, old.subject, {TEXT_FUNCTION}(old.message));")
+_CREATE = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(subject, message, content='', tokenize='trigram')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON emails BEGIN {_FORGET_OLD} END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF subject, message ON emails BEGIN "
+    f"{_FORGET_OLD} INSERT INTO {FTS_TABLE}(rowid, subject, message) "
+    f"VALUES (new.id, new.subject, {TEXT_FUNCTION}(new.message)); END",
+]
+_DROP = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_update",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+_message_type = CompressedText()
+
+# Engine -> whether its database has the index, so hot paths do not query sqlite_master
+_available = weakref.WeakKeyDictionary()
+
+
+def email_text(value):
+    """TEXT_FUNCTION: the text of a stored message, as Email.message would load it."""
+    return _message_type.process_result_value(value, None)
+
+
+@event.listens_for(Engine, 'connect')
+def _register_text_function(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(TEXT_FUNCTION, 1, email_text, deterministic=True)
+
+
+def fts_available(bind) -> bool:
+    """Whether the database behind `bind` (a session, connection or engine) has the index."""
+    bind = bind.get_bind() if hasattr(bind, 'get_bind') else bind
+    engine = getattr(bind, 'engine', bind)
+    if engine.dialect.name != 'sqlite':
+        return False
+    if engine not in _available:
+        query = text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name")
+        if isinstance(bind, Connection):
+            _available[engine] = bind.execute(query, {'name': FTS_TABLE}).first() is not None
+        else:
+            with engine.connect() as connection:
+                _available[engine] = connection.execute(query, {'name': FTS_TABLE}).first() is not None
+    return _available[engine]
+
+
+def create_fts(connection: Connection) -> bool:
+    """Create the index (empty) if this SQLite build supports trigram FTS5."""
+    if connection.dialect.name != 'sqlite':
+        return False
+    try:
+        for statement in _CREATE:
+            connection.execute(text(statement))
+    except OperationalError as e:
+        print(f"Full-text index unavailable, substring rules will scan instead: {e}")
+        return False
+    finally:
+        _available.pop(connection.engine, None)
+    return True
+
+
+def fts_contentless(connection: Connection) -> bool:
+    """Whether the index exists and was created without its own copy of the text."""
+    sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                             {'name': FTS_TABLE}).scalar()
+    return sql is not None and "content=''" in sql
+
+
+def drop_fts(connection: Connection):
+    if connection.dialect.name == 'sqlite':
+        for statement in _DROP:
+            connection.execute(text(statement))
+        _available.pop(connection.engine, None)
+
+
+def fts_phrase(value: str) -> str:
+    """Quote a value as an FTS5 phrase, which a trigram index matches as a plain substring."""
+    return '"' + value.replace('"', '""') + '"'
+
+
+def fts_contains(attribute: str, value: str) -> ColumnElement:
+    """Filter on emails whose `attribute` contains `value` (ASCII, at least FTS_MIN_LENGTH chars)."""
+    matching = select(email_fts.c.rowid).where(email_fts.c[attribute].op('MATCH')(fts_phrase(value)))
+    return Email.id.in_(matching)
+
+
+def index_rows(connection: Connection, rows: Iterable[Dict[str, Any]]):
+    """Add freshly inserted emails ({'id', 'subject', 'message'} dicts) to the index."""
+    rows = [{'rowid': row['id'], 'subject': row.get('subject'), 'message': row.get('message')} for row in rows]
+    if rows and fts_available(connection):
+        connection.execute(insert(email_fts), rows)
+
+
+def reindex(connection: Connection, email_ids: Iterable[int]) -> int:
+    """Index those of the given emails that have no entry yet; returns how many were added.
+
+    Entries of indexed emails follow their updates and deletes through the triggers, so this
+    only fills gaps, such as rows inserted by something that did not index them.
+    """
+    if not fts_available(connection):
+        return 0
+    email_ids = list(email_ids)
+    emails = Email.__table__
+    added = 0
+    for start in range(0, len(email_ids), INDEX_CHUNK_SIZE):
+        chunk = email_ids[start:start + INDEX_CHUNK_SIZE]
+        present = select(email_fts.c.rowid).where(email_fts.c.rowid.in_(chunk))
+        rows = connection.execute(
+            select(emails.c.id, emails.c.subject, emails.c.message)
+            .where(emails.c.id.in_(chunk), emails.c.id.not_in(present))
+        ).mappings().all()
+        index_rows(connection, rows)
+        added += len(rows)
+    return added
+
+
+def rebuild_fts(connection: Connection) -> int:
+    """Index every stored email from scratch, e.g. for a database created before the index.
+
+    The index is dropped and created again, which also converts one that kept its own copy
+    of the text into a contentless one.
+    """
+    drop_fts(connection)
+    if not create_fts(connection):
+        return 0
+    emails = Email.__table__
+    indexed = 0
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(emails.c.id, emails.c.subject, emails.c.message)
+            .where(emails.c.id > last_id).order_by(emails.c.id).limit(INDEX_CHUNK_SIZE)
+        ).mappings().all()
+        if not rows:
+            return indexed
+        index_rows(connection, rows)
+        indexed += len(rows)
+        last_id = rows[-1]['id']
+
+
+@event.listens_for(Email.__table__, 'after_create')
+def _create_with_emails(target, connection, **kw):
+    create_fts(connection)
+
+
+@event.listens_for(Email.__table__, 'before_drop')
+def _drop_with_emails(target, connection, **kw):
+    drop_fts(connection)
+
+
+@event.listens_for(Email, 'after_insert')
+def _index_inserted(mapper, connection, target):
+    index_rows(connection, [{'id': target.id, 'subject': target.subject,
+                             'message': target.__dict__.get('message')}])
@@ -0,0 +1,85 @@
+from typing import Any, Dict, Iterable, List, Set
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .fts import index_rows
+from .models import Email
+
+# Rows per INSERT executemany and per commit
+INSERT_CHUNK_SIZE = 1000
+# Ids per IN (...) lookup, below SQLite's bound-parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+_INSERT_DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def existing_gmail_ids(db: Session, gmail_ids: Iterable[str], chunk_size: int = LOOKUP_CHUNK_SIZE) -> Set[str]:
+    """Return which of `gmail_ids` are already stored, using one IN query per chunk."""
+    gmail_ids = list(gmail_ids)
+    existing = set()
+    for start in range(0, len(gmail_ids), chunk_size):
+        chunk = gmail_ids[start:start + chunk_size]
+        existing.update(gmail_id for gmail_id, in db.query(Email.gmail_id).filter(Email.gmail_id.in_(chunk)))
+    return existing
+
+
+def dialect_insert(db: Session, table):
+    """An INSERT for `table` supporting ON CONFLICT clauses on the session's dialect."""
+    insert = _INSERT_DIALECTS.get(db.get_bind().dialect.name)
+    if insert is None:
+        raise NotImplementedError(f"Bulk insert is not supported for {db.get_bind().dialect.name}")
+    return insert(table)
+
+
+def _insert_statement(db: Session):
+    # Rows that raced in since the dedup check are skipped instead of failing the chunk;
+    # RETURNING reports the ids of the rows actually inserted, for the full-text index
+    table = Email.__table__
+    return (dialect_insert(db, table).on_conflict_do_nothing(index_elements=['gmail_id'])
+            .returning(table.c.id, table.c.gmail_id))
+
+
+class EmailIngestor:
+    """Buffers parsed messages and writes them with Core executemany inserts.
+
+    Each full buffer of `chunk_size` rows is inserted and committed on its own, so memory
+    stays flat and a crash loses at most one chunk. Use as a context manager, or call
+    flush() when done.
+    """
+
+    def __init__(self, db: Session, chunk_size: int = INSERT_CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.statement = _insert_statement(db)
+        self.buffer: List[Dict[str, Any]] = []
+        self.inserted = 0
+
+    def add(self, row: Dict[str, Any]):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        inserted = dict(self.db.execute(self.statement, self.buffer).all())
+        rows = {row['gmail_id']: row for row in self.buffer}
+        index_rows(self.db.connection(),
+                   [dict(rows[gmail_id], id=email_id) for email_id, gmail_id in inserted.items()])
+        self.db.commit()
+        self.inserted += len(inserted)
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+
+def ingest_emails(db: Session, rows: Iterable[Dict[str, Any]], chunk_size: int = INSERT_CHUNK_SIZE) -> int:
+    """Insert parsed messages in committed chunks, skipping gmail_ids that already exist."""
+    with EmailIngestor(db, chunk_size) as ingestor:
+        for row in rows:
+            ingestor.add(row)
+    return ingestor.inserted
@@ -0,0 +1,17 @@
+from typing import Optional
+from sqlalchemy.orm import Session
+from .models import Meta
+
+
+def get_meta(db: Session, key: str) -> Optional[str]:
+    row = db.query(Meta.value).filter_by(key=key).first()
+    return row[0] if row else None
+
+
+def set_meta(db: Session, key: str, value: Optional[str]):
+    """Set a value in the meta table; committed with the caller's transaction."""
+    row = db.query(Meta).filter_by(key=key).first()
+    if row is None:
+        db.add(Meta(key=key, value=value))
+    else:
+        row.value = value
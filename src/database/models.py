@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Index, UniqueConstraint, func
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from datetime import datetime
+from .types import CompressedText
 
 Base = declarative_base()
 
@@ -14,12 +15,24 @@ class Email(Base):
     from_address = Column(String, nullable=False)
     to_address = Column(String, nullable=False)
     subject = Column(String)
-    message = Column(Text)
+    # Bodies are compressed and only loaded when accessed or undeferred (see rules.sql.email_load_options)
+    message = deferred(Column(CompressedText))
     received_date = Column(DateTime, nullable=False)
     is_read = Column(Boolean, default=False)
     label = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # What rule filters (see rules.sql) and sync look emails up by. Text rules compare
+    # lower(column), so the sender is indexed on that expression. The composites cover
+    # the common "unread and older than" and "from X and older than" rules, and their
+    # first column on its own.
+    __table_args__ = (
+        Index('ix_emails_received_date', received_date),
+        Index('ix_emails_is_read_received_date', is_read, received_date),
+        Index('ix_emails_from_address_received_date', func.lower(from_address), received_date),
+        Index('ix_emails_thread_id', thread_id),
+        Index('ix_emails_label', label),
+    )
 
     def __repr__(self):
         return f"<Email(id={self.id}, subject='{self.subject}')>"
@@ -33,8 +46,11 @@ class Rule(Base):
     priority = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    conditions = relationship("RuleCondition", back_populates="rule", cascade="all, delete-orphan")
-    actions = relationship("RuleAction", back_populates="rule", cascade="all, delete-orphan")
+    # Kept in the order they were written in rules.json
+    conditions = relationship("RuleCondition", back_populates="rule", cascade="all, delete-orphan",
+                              order_by="RuleCondition.id")
+    actions = relationship("RuleAction", back_populates="rule", cascade="all, delete-orphan",
+                           order_by="RuleAction.id")
 
     def __repr__(self):
         return f"<Rule(id={self.id}, name='{self.name}')>"
@@ -45,7 +61,10 @@ class RuleCondition(Base):
     id = Column(Integer, primary_key=True)
     rule_id = Column(Integer, ForeignKey('rules.id'), nullable=False)
     field = Column(String, nullable=False)  # 'from', 'subject', 'message', 'received_date'
-    predicate = Column(String, nullable=False)  # 'contains', 'not_contains', 'equals', 'not_equals', 'less_than', 'greater_than'
+    # Text fields: 'contains', 'not_contains', 'equals', 'not_equals', 'starts_with', 'domain_is'
+    # (sender or recipient domain, subdomains included), 'matches' (case-insensitive regex);
+    # received_date: 'less_than', 'greater_than'. See rules.compiler.TEXT_PREDICATES
+    predicate = Column(String, nullable=False)
     value = Column(String, nullable=False)
     rule = relationship("Rule", back_populates="conditions")
 
@@ -62,4 +81,64 @@ class RuleAction(Base):
     rule = relationship("Rule", back_populates="actions")
 
     def __repr__(self):
-        return f"<RuleAction(id={self.id}, action_type='{self.action_type}')>" 
\ No newline at end of file
+        return f"<RuleAction(id={self.id}, action_type='{self.action_type}')>" 
+
+class GmailLabel(Base):
+    __tablename__ = 'gmail_labels'
+
+    id = Column(Integer, primary_key=True)
+    label_id = Column(String, unique=True, nullable=False)
+    name = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<GmailLabel(label_id='{self.label_id}', name='{self.name}')>"
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    id = Column(Integer, primary_key=True)
+    account = Column(String, unique=True, nullable=False, default='me')
+    history_id = Column(String)  # Gmail historyId the stored mailbox is in sync with
+    backfill_query = Column(String)  # Filters of the backfill in progress, see MailboxSync.backfill
+    backfill_token = Column(String)  # Page token the backfill resumes from
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<SyncState(account='{self.account}', history_id='{self.history_id}')>"
+
+class ProcessedEmail(Base):
+    __tablename__ = 'processed_emails'
+    __table_args__ = (UniqueConstraint('email_id', 'fingerprint'),)
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey('emails.id'), nullable=False)
+    fingerprint = Column(String, nullable=False, index=True)  # Hash of the rule set the email was processed with
+    outcome = Column(String, nullable=False)  # 'matched', 'no_match' or 'failed'
+    processed_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ProcessedEmail(email_id={self.email_id}, outcome='{self.outcome}')>"
+
+class ConditionStat(Base):
+    __tablename__ = 'condition_stats'
+
+    id = Column(Integer, primary_key=True)
+    condition = Column(String, unique=True, nullable=False)  # "field predicate value", see rules.compiler.condition_label
+    evaluations = Column(Integer, nullable=False, default=0)  # Emails the condition was tested on in the last sample
+    hits = Column(Integer, nullable=False, default=0)  # How many of those it matched
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ConditionStat(condition='{self.condition}', hits={self.hits}/{self.evaluations})>"
+
+class Meta(Base):
+    __tablename__ = 'meta'
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True, nullable=False)  # e.g. 'rules_hash', see rules.parser.RULES_HASH_KEY
+    value = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Meta(key='{self.key}', value='{self.value}')>"
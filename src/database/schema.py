@@ -0,0 +1,65 @@
+from typing import List, Set
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateColumn
+from .fts import FTS_TABLE, fts_contentless, rebuild_fts
+from .models import Base
+
+
+def _index_names(connection: Connection, table_name: str) -> Set[str]:
+    if connection.dialect.name == 'sqlite':
+        # The inspector skips expression indexes such as lower(from_address)
+        rows = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name"),
+                                  {'name': table_name})
+        return {name for name, in rows}
+    return {index['name'] for index in inspect(connection).get_indexes(table_name)}
+
+
+def upgrade_schema(engine: Engine) -> List[str]:
+    """Bring an existing database up to date with the models without losing data.
+
+    Creates missing tables, adds missing columns and indexes, and builds the full-text
+    index of a database that predates it. Returns a description of each change.
+    Columns that SQLite cannot add in place (NOT NULL without a default) are reported
+    and need a reset.
+    """
+    changes = []
+    with engine.begin() as connection:
+        existing = set(inspect(connection).get_table_names())
+        Base.metadata.create_all(bind=connection)
+
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                changes.append(f"created table {table.name}")
+                continue
+
+            columns = {column['name'] for column in inspect(connection).get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    print(f"Warning: Cannot add NOT NULL column {table.name}.{column.name} in place; "
+                          f"run init_db with --reset")
+                    continue
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                changes.append(f"added column {table.name}.{column.name}")
+
+            indexes = _index_names(connection, table.name)
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(bind=connection)
+                    changes.append(f"created index {index.name}")
+
+        # Creating the emails table creates the index with it; older databases need it built,
+        # or rebuilt when theirs still stores a full copy of every subject and body
+        if ('emails' in existing and connection.dialect.name == 'sqlite'
+                and (FTS_TABLE not in existing or not fts_contentless(connection))):
+            indexed = rebuild_fts(connection)
+            if indexed or FTS_TABLE in inspect(connection).get_table_names():
+                changes.append(f"built {FTS_TABLE} over {indexed} emails")
+
+        if changes and connection.dialect.name == 'sqlite':
+            # Give the query planner statistics for the new indexes
+            connection.execute(text("ANALYZE"))
+    return changes
@@ -1,19 +1,16 @@
-from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.ext.declarative import declarative_base
 import os
 from dotenv import load_dotenv
+from .schema import upgrade_schema
+from .sqlite import create_database_engine
 
 load_dotenv()
 
 # Use SQLite database file in the project directory
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///gmail_processor.db')
 
-# Create engine with SQLite-specific configuration
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={'check_same_thread': False}  # Needed for SQLite
-)
+# Create engine with the SQLite performance profile (WAL, busy timeout, pooled connections)
+engine = create_database_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 db_session = scoped_session(SessionLocal)
 
@@ -24,17 +21,13 @@ def get_db():
     finally:
         db.close()
 
-def init_db():
+def init_db(reset=False):
+    """Create or upgrade the database in place; with `reset`, drop every table first."""
     from .models import Base
-    # Drop all tables if they exist
-    Base.metadata.drop_all(bind=engine)
-    # Create all tables
-    Base.metadata.create_all(bind=engine)
-    
-    # Initialize with empty tables using SQLite-compatible commands
-    with engine.connect() as conn:
-        conn.execute(text("DELETE FROM rule_actions"))
-        conn.execute(text("DELETE FROM rule_conditions"))
-        conn.execute(text("DELETE FROM rules"))
-        conn.execute(text("DELETE FROM emails"))
-        conn.commit() 
\ No newline at end of file
+    if reset:
+        # Drop all tables if they exist
+        Base.metadata.drop_all(bind=engine)
+    changes = upgrade_schema(engine)
+    for change in changes:
+        print(f"  {change}")
+    return changes
@@ -0,0 +1,32 @@
+from typing import Iterator, List, Sequence
+from sqlalchemy.orm import Session
+from .models import Email
+
+# Emails loaded per keyset page
+EMAIL_CHUNK_SIZE = 1000
+
+
+def iter_email_chunks(db: Session, filters: Sequence = (), chunk_size: int = EMAIL_CHUNK_SIZE,
+                      options: Sequence = ()) -> Iterator[List[Email]]:
+    """Yield matching emails in id order, one chunk at a time, with bounded memory.
+
+    Pages are fetched with keyset pagination on Email.id (WHERE id > last id LIMIT n), so
+    each query is an index range scan no matter how deep into the table it is. Once the
+    caller is done with a chunk its emails are expunged from the session, keeping the
+    identity map from growing with the table.
+    """
+    last_id = 0
+    while True:
+        chunk = (db.query(Email)
+                 .filter(Email.id > last_id, *filters)
+                 .options(*options)
+                 .order_by(Email.id)
+                 .limit(chunk_size)
+                 .all())
+        if not chunk:
+            return
+        last_id = chunk[-1].id
+        yield chunk
+        for email in chunk:
+            if email in db:
+                db.expunge(email)
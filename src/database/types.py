@@ -0,0 +1,51 @@
+import os
+import zlib
+from typing import Optional, Union
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+# Values shorter than this many bytes are stored as plain UTF-8; compression would not pay off
+COMPRESS_THRESHOLD = int(os.getenv('COMPRESS_THRESHOLD', '256'))
+COMPRESS_LEVEL = 6
+
+# First byte of every stored value
+_PLAIN = b'\x00'
+_ZLIB = b'\x01'
+
+
+class CompressedText(TypeDecorator):
+    """Text stored as a blob, zlib-compressed once it reaches `threshold` bytes.
+
+    Each stored value starts with a one-byte header saying whether the rest is plain
+    UTF-8 or zlib data. Rows written before the column was compressed come back from
+    SQLite as str and are returned unchanged.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, threshold: int = COMPRESS_THRESHOLD, level: int = COMPRESS_LEVEL, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+        self.level = level
+
+    def process_bind_param(self, value: Optional[str], dialect) -> Optional[bytes]:
+        if value is None:
+            return None
+        data = value.encode('utf-8')
+        if len(data) >= self.threshold:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                return _ZLIB + compressed
+        return _PLAIN + data
+
+    def process_result_value(self, value: Optional[Union[bytes, str]], dialect) -> Optional[str]:
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        header, data = value[:1], value[1:]
+        if header == _ZLIB:
+            return zlib.decompress(data).decode('utf-8')
+        if header == _PLAIN:
+            return data.decode('utf-8')
+        # A blob without our header: written by something else, so take it as UTF-8 text
+        return value.decode('utf-8', errors='replace')
@@ -1,5 +1,6 @@
 import os
 import pickle
+import httplib2
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
@@ -10,30 +11,47 @@ load_dotenv()
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
 TOKEN_FILE = 'token.pickle'
+# Base URL of a Gmail-compatible endpoint (e.g. the local fake server); unset means Google
+API_ENDPOINT = os.getenv('GMAIL_API_ENDPOINT')
 
-def get_gmail_service():
+def get_gmail_service(api_endpoint=None, token_file=None, interactive=True):
+    """Build a Gmail service authorized with the OAuth token stored in `token_file`.
+
+    Each mailbox has its own token file (TOKEN_FILE by default). An expired token is
+    refreshed; a missing or revoked one starts the browser consent flow, or raises
+    PermissionError when `interactive` is off, as for unattended multi-account runs.
+    """
+    api_endpoint = api_endpoint or API_ENDPOINT
+    if api_endpoint:
+        # Local stand-ins do not authenticate, so skip the OAuth flow entirely
+        return build('gmail', 'v1', http=httplib2.Http(), static_discovery=True,
+                     client_options={'api_endpoint': api_endpoint})
+
+    token_file = token_file or TOKEN_FILE
     creds = None
     
     # Load existing token if available
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
+    if os.path.exists(token_file):
+        with open(token_file, 'rb') as token:
             creds = pickle.load(token)
     
     # If credentials are not valid or don't exist, get new ones
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
+        elif not interactive:
+            raise PermissionError(f"No valid Gmail token in {token_file}; run scripts.auth --token-file {token_file}")
         else:
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
         
         # Save the credentials for future use
-        with open(TOKEN_FILE, 'wb') as token:
+        with open(token_file, 'wb') as token:
             pickle.dump(creds, token)
     
     return build('gmail', 'v1', credentials=creds)
 
-def authenticate():
-    """Run the authentication flow and save credentials."""
-    service = get_gmail_service()
+def authenticate(token_file=None):
+    """Run the authentication flow and save credentials (to `token_file` for another mailbox)."""
+    service = get_gmail_service(token_file=token_file)
     return service 
\ No newline at end of file
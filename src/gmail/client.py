@@ -1,75 +1,254 @@
 import base64
 import email
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from email.mime.text import MIMEText
 from datetime import datetime
-from .auth import get_gmail_service
+from itertools import islice
+from urllib.parse import urljoin
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+from .auth import API_ENDPOINT, get_gmail_service
+from .labels import LABEL_CACHE_TTL, LabelCache
+from .scheduler import QUOTA_UNITS, RequestScheduler, is_retryable
+
+# Maximum number of message ids accepted by a single users.messages.batchModify call
+BATCH_MODIFY_LIMIT = 1000
+# Maximum number of sub-requests in one HTTP batch request
+BATCH_REQUEST_LIMIT = 100
+# Largest page users.messages.list will return
+MAX_PAGE_SIZE = 500
+# Headers parse_message reads; all a format='metadata' fetch needs to ask for
+PARSED_HEADERS = ['From', 'To', 'Subject', 'Date']
+
+def parse_message(message):
+    """Parse a Gmail message into a dictionary; a plain function so worker processes can run it.
+
+    Messages fetched without their body (format='metadata') get a None message, so
+    they can be told apart from messages whose body is empty.
+    """
+    headers = message['payload']['headers']
+    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
+    from_address = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+    to_address = next((h['value'] for h in headers if h['name'].lower() == 'to'), '')
+    date = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
+    
+    # Parse the message body
+    body = ''
+    if 'parts' not in message['payload'] and 'body' not in message['payload']:
+        body = None
+    elif 'parts' in message['payload']:
+        for part in message['payload']['parts']:
+            if part['mimeType'] == 'text/plain':
+                body = base64.urlsafe_b64decode(part['body']['data']).decode()
+                break
+    elif 'body' in message['payload'] and 'data' in message['payload']['body']:
+        body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode()
+
+    return {
+        'gmail_id': message['id'],
+        'thread_id': message['threadId'],
+        'subject': subject,
+        'from_address': from_address,
+        'to_address': to_address,
+        'message': body,
+        'received_date': datetime.fromtimestamp(int(message['internalDate'])/1000),
+        'is_read': 'UNREAD' not in message['labelIds'] if 'labelIds' in message else False,
+        'label': ','.join(message.get('labelIds', []))
+    }
+
 
 class GmailClient:
-    def __init__(self):
-        self.service = get_gmail_service()
+    def __init__(self, service=None, label_store=None, label_cache_ttl=LABEL_CACHE_TTL, api_endpoint=None,
+                 scheduler=None):
+        self.api_endpoint = api_endpoint or API_ENDPOINT
+        self.service = service or get_gmail_service(self.api_endpoint)
+        # Every request goes through the scheduler, which keeps within the quota and retries
+        self.scheduler = scheduler or RequestScheduler()
+        self._local = threading.local()
+        self.labels = LabelCache(self.service, ttl=label_cache_ttl, store=label_store, scheduler=self.scheduler,
+                                 http=self._thread_http)
+
+    def _execute(self, method, request, **kwargs):
+        # Clients are shared by pool threads, so every call goes over the calling thread's connection
+        kwargs.setdefault('http', self._thread_http())
+        return self.scheduler.execute(method, request, **kwargs)
+
+    def _thread_http(self):
+        """An httplib2 connection for the current thread (httplib2.Http is not thread-safe)."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            shared = getattr(self.service, '_http', None)
+            if isinstance(shared, AuthorizedHttp):
+                http = AuthorizedHttp(shared.credentials, http=httplib2.Http())
+            else:
+                http = httplib2.Http()
+            self._local.http = http
+        return http
+
+    def _new_batch(self, callback):
+        if self.api_endpoint:
+            return BatchHttpRequest(callback=callback, batch_uri=urljoin(self.api_endpoint, 'batch'))
+        return self.service.new_batch_http_request(callback=callback)
+
+    def iter_messages(self, query=None, label_ids=None, page_size=MAX_PAGE_SIZE, page_token=None, on_page=None):
+        """Yield message references ({'id', 'threadId'}) lazily, following nextPageToken.
+
+        `query` is a Gmail search query (the `q` parameter) and `label_ids` restricts the
+        listing to messages carrying all of those labels, so filtering happens server-side.
+        Listing starts at `page_token` when given. After the last message of each page has
+        been consumed, `on_page(next_page_token)` is called with the cursor to resume from
+        (None once the listing is complete). Errors are raised so a cursor is never advanced
+        past a page that was not delivered.
+        """
+        while True:
+            response = self._execute('messages.list', self.service.users().messages().list(
+                userId='me',
+                q=query,
+                labelIds=label_ids,
+                maxResults=min(page_size, MAX_PAGE_SIZE),
+                pageToken=page_token
+            ))
+            yield from response.get('messages', [])
+            page_token = response.get('nextPageToken')
+            if on_page is not None:
+                on_page(page_token)
+            if not page_token:
+                return
 
-    def list_messages(self, max_results=100):
+    def list_messages(self, max_results=100, query=None, label_ids=None):
         """List messages in the user's mailbox."""
         try:
-            results = self.service.users().messages().list(
-                userId='me',
-                maxResults=max_results
-            ).execute()
-            return results.get('messages', [])
+            messages = self.iter_messages(query=query, label_ids=label_ids, page_size=max_results)
+            return list(islice(messages, max_results))
         except Exception as e:
             print(f"An error occurred: {e}")
             return []
 
-    def get_message(self, msg_id):
-        """Get a specific message by ID."""
+    def get_message(self, msg_id, format='full', metadata_headers=None):
+        """Get a specific message by ID.
+
+        With format='metadata' only the `metadata_headers` are returned and no body.
+        """
         try:
-            message = self.service.users().messages().get(
+            message = self._execute('messages.get', self.service.users().messages().get(
                 userId='me',
                 id=msg_id,
-                format='full'
-            ).execute()
+                format=format,
+                metadataHeaders=metadata_headers
+            ))
             return message
         except Exception as e:
             print(f"An error occurred: {e}")
             return None
 
+    def _get_batch(self, msg_ids, format, metadata_headers=None):
+        """Fetch up to BATCH_REQUEST_LIMIT messages in one HTTP batch request.
+
+        Returns ({msg_id: message, or None if it cannot be fetched}, [msg_ids to fetch again],
+        [msg_ids Gmail does not have]). The scheduler retries the batch as a whole; items that
+        fail inside it with a retryable error are left for get_messages to fetch on their own.
+        """
+        messages, retry, missing = {}, [], []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+            elif is_retryable(exception):
+                retry.append(request_id)
+            else:
+                messages[request_id] = None
+                if isinstance(exception, HttpError) and exception.resp.status == 404:
+                    missing.append(request_id)
+
+        batch = self._new_batch(callback)
+        # Building resource objects is costly, so reuse one for every sub-request
+        messages_resource = self.service.users().messages()
+        for msg_id in msg_ids:
+            batch.add(messages_resource.get(userId='me', id=msg_id, format=format, metadataHeaders=metadata_headers),
+                      request_id=msg_id)
+        try:
+            # A batch costs the quota of each of its calls
+            self._execute('messages.get', batch, units=QUOTA_UNITS['messages.get'] * len(msg_ids))
+        except Exception as e:
+            # The scheduler has used up its retries, so the ids are not tried again
+            print(f"An error occurred: {e}")
+            return dict.fromkeys(msg_ids), [], []
+        return messages, retry, missing
+
+    def get_messages(self, msg_ids, format='full', batch_size=BATCH_REQUEST_LIMIT, max_workers=4,
+                     metadata_headers=None, not_found=None):
+        """Fetch many messages, yielding (msg_id, message) pairs as batches complete.
+
+        Ids are sent as HTTP batch requests of up to `batch_size` sub-requests, with up to
+        `max_workers` batches in flight. Retries belong to the scheduler: items that fail
+        inside a batch with a retryable error are requested once more on their own with
+        get_message, where the scheduler retries and backs off. Ids that cannot be fetched
+        are yielded with a None message; those Gmail answers 404 for (deleted messages) are
+        also added to the `not_found` set when one is given.
+        """
+        msg_ids = list(msg_ids)
+        batch_size = min(batch_size, BATCH_REQUEST_LIMIT)
+        chunks = iter([msg_ids[start:start + batch_size] for start in range(0, len(msg_ids), batch_size)])
+        retry = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Keep at most two batches per worker in flight so results stream in bounded memory
+            pending = {executor.submit(self._get_batch, chunk, format, metadata_headers)
+                       for chunk in islice(chunks, max_workers * 2)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    messages, chunk_retry, missing = future.result()
+                    retry.extend(chunk_retry)
+                    if not_found is not None:
+                        not_found.update(missing)
+                    for chunk in islice(chunks, 1):
+                        pending.add(executor.submit(self._get_batch, chunk, format, metadata_headers))
+                    yield from messages.items()
+
+        for msg_id in retry:
+            yield msg_id, self.get_message(msg_id, format=format, metadata_headers=metadata_headers)
+
+    def get_profile(self):
+        """Get the mailbox profile, including its current historyId."""
+        return self._execute('getProfile', self.service.users().getProfile(userId='me'))
+
+    def list_history(self, start_history_id, history_types=None, label_id=None):
+        """Yield history records newer than start_history_id, following every page.
+
+        With `label_id`, only records of messages carrying that label are returned. Unlike
+        the other methods, errors are raised: a 404 HttpError means the history id has
+        expired and the caller must fall back to a full sync.
+        """
+        page_token = None
+        while True:
+            response = self._execute('history.list', self.service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=history_types,
+                labelId=label_id,
+                pageToken=page_token,
+                maxResults=500
+            ))
+            yield from response.get('history', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
     def parse_message(self, message):
-        """Parse a Gmail message into a dictionary."""
-        headers = message['payload']['headers']
-        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
-        from_address = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-        to_address = next((h['value'] for h in headers if h['name'].lower() == 'to'), '')
-        date = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
-        
-        # Parse the message body
-        body = ''
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode()
-                    break
-        elif 'body' in message['payload'] and 'data' in message['payload']['body']:
-            body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode()
-
-        return {
-            'gmail_id': message['id'],
-            'thread_id': message['threadId'],
-            'subject': subject,
-            'from_address': from_address,
-            'to_address': to_address,
-            'message': body,
-            'received_date': datetime.fromtimestamp(int(message['internalDate'])/1000),
-            'is_read': 'UNREAD' not in message['labelIds'] if 'labelIds' in message else False
-        }
+        """Parse a Gmail message into a dictionary (see parse_message)."""
+        return parse_message(message)
 
     def mark_as_read(self, msg_id):
         """Mark a message as read."""
         try:
-            self.service.users().messages().modify(
+            self._execute('messages.modify', self.service.users().messages().modify(
                 userId='me',
                 id=msg_id,
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            ))
             return True
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -78,43 +257,72 @@ class GmailClient:
     def mark_as_unread(self, msg_id):
         """Mark a message as unread."""
         try:
-            self.service.users().messages().modify(
+            self._execute('messages.modify', self.service.users().messages().modify(
                 userId='me',
                 id=msg_id,
                 body={'addLabelIds': ['UNREAD']}
-            ).execute()
+            ))
             return True
         except Exception as e:
             print(f"An error occurred: {e}")
             return False
 
+    def get_label_id(self, label_name):
+        """Resolve a label name to its id, creating the label if it does not exist."""
+        return self.labels.get_id(label_name)
+
     def move_message(self, msg_id, label_name):
         """Move a message to a specific label."""
         try:
             # First, get or create the label
-            labels = self.service.users().labels().list(userId='me').execute()
-            label_id = None
-            
-            for label in labels.get('labels', []):
-                if label['name'].lower() == label_name.lower():
-                    label_id = label['id']
-                    break
-            
-            if not label_id:
-                # Create new label
-                label = self.service.users().labels().create(
-                    userId='me',
-                    body={'name': label_name}
-                ).execute()
-                label_id = label['id']
+            label_id = self.get_label_id(label_name)
             
             # Apply the label
-            self.service.users().messages().modify(
+            self._execute('messages.modify', self.service.users().messages().modify(
                 userId='me',
                 id=msg_id,
                 body={'addLabelIds': [label_id]}
-            ).execute()
+            ))
             return True
         except Exception as e:
             print(f"An error occurred: {e}")
-            return False 
\ No newline at end of file
+            return False
+
+    def modify_message(self, msg_id, add_label_ids=None, remove_label_ids=None):
+        """Add and remove labels on a single message."""
+        try:
+            self._execute('messages.modify', self.service.users().messages().modify(
+                userId='me',
+                id=msg_id,
+                body={'addLabelIds': list(add_label_ids or []), 'removeLabelIds': list(remove_label_ids or [])}
+            ))
+            return True
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return False
+
+    def batch_modify(self, msg_ids, add_label_ids=None, remove_label_ids=None):
+        """Apply the same label change to many messages with batchModify.
+
+        Returns a dict of message id to success. When a batchModify call fails, the
+        messages of that chunk are retried one by one so each gets its own status.
+        """
+        results = {}
+        msg_ids = list(msg_ids)
+        for start in range(0, len(msg_ids), BATCH_MODIFY_LIMIT):
+            chunk = msg_ids[start:start + BATCH_MODIFY_LIMIT]
+            try:
+                self._execute('messages.batchModify', self.service.users().messages().batchModify(
+                    userId='me',
+                    body={
+                        'ids': chunk,
+                        'addLabelIds': list(add_label_ids or []),
+                        'removeLabelIds': list(remove_label_ids or [])
+                    }
+                ))
+                results.update((msg_id, True) for msg_id in chunk)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                for msg_id in chunk:
+                    results[msg_id] = self.modify_message(msg_id, add_label_ids, remove_label_ids)
+        return results
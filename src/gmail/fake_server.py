@@ -0,0 +1,424 @@
+"""
+Local stand-in for the Gmail REST endpoints used by GmailClient, for tests and benchmarks.
+
+Point a client at it with GmailClient(api_endpoint=server.url) or GMAIL_API_ENDPOINT.
+"""
+import base64
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+# Senders and words of generated mail, shared with benchmarks/synthetic.py
+SENDERS = ['noreply@google.com', 'alerts@bank.com', 'team@example.com', 'news@example.org',
+           'friend@gmail.com', 'billing@vendor.io', 'jobs@linkedin.com', 'support@shop.com']
+WORDS = ['urgent', 'important', 'newsletter', 'invoice', 'meeting', 'update', 'business',
+         'info', 'weekly', 'report', 'offer', 'sale', 'reminder', 'project', 'status', 'hello']
+SYSTEM_LABELS = ['INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH']
+# Reason Gmail reports with each injectable error status
+ERROR_REASONS = {429: 'rateLimitExceeded', 403: 'userRateLimitExceeded', 500: 'backendError', 503: 'backendError'}
+
+
+def make_message(index: int, rng: random.Random, now: datetime, body_words: int = 200) -> Dict[str, Any]:
+    """Build one synthetic message in the shape returned by users.messages.get(format='full')."""
+    subject = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+    body = ' '.join(rng.choice(WORDS) for _ in range(body_words))
+    received = now - timedelta(minutes=rng.randint(0, 60 * 24 * 60))
+    label_ids = ['INBOX'] + (['UNREAD'] if rng.random() < 0.5 else [])
+    data = base64.urlsafe_b64encode(body.encode()).decode()
+    return {
+        'id': f'{index:016x}',
+        'threadId': f'{index // 3:016x}',
+        'labelIds': label_ids,
+        'snippet': body[:100],
+        'internalDate': str(int(received.timestamp() * 1000)),
+        'sizeEstimate': len(body) + 500,
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [
+                {'name': 'From', 'value': rng.choice(SENDERS)},
+                {'name': 'To', 'value': 'me@example.com'},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Date', 'value': received.strftime('%a, %d %b %Y %H:%M:%S +0000')},
+            ],
+            'body': {'size': len(body), 'data': data},
+        },
+    }
+
+
+class FakeMailbox:
+    """In-memory mailbox holding synthetic messages, newest first, with a change history."""
+
+    def __init__(self, count: int = 0, seed: int = 0, body_words: int = 200):
+        rng = random.Random(seed)
+        now = datetime.utcnow()
+        self.lock = threading.Lock()
+        self.messages: Dict[str, Dict[str, Any]] = {}
+        self.history: List[Dict[str, Any]] = []
+        self.history_id = 1000
+        # Requests for history older than this get a 404, like an expired Gmail historyId
+        self.history_floor = self.history_id
+        self.labels: Dict[str, Dict[str, str]] = {
+            label: {'id': label, 'name': label, 'type': 'system'} for label in SYSTEM_LABELS
+        }
+        for index in range(count):
+            self.messages[f'{index:016x}'] = make_message(index, rng, now, body_words)
+        self.next_index = count
+
+    def _record(self, **change) -> int:
+        self.history_id += 1
+        self.history.append(dict(change, id=str(self.history_id)))
+        return self.history_id
+
+    def _ref(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        return {'message': {'id': message['id'], 'threadId': message['threadId'],
+                            'labelIds': list(message['labelIds'])}}
+
+    def add(self, message: Dict[str, Any]):
+        with self.lock:
+            self.messages[message['id']] = message
+            self._record(messagesAdded=[self._ref(message)])
+
+    def add_new(self, body_words: int = 200) -> Dict[str, Any]:
+        """Deliver a new synthetic message, as if it had just arrived."""
+        with self.lock:
+            index = self.next_index
+            self.next_index += 1
+        message = make_message(index, random.Random(index), datetime.utcnow(), body_words)
+        message['internalDate'] = str(int(time.time() * 1000))
+        self.add(message)
+        return message
+
+    def delete(self, msg_id: str):
+        with self.lock:
+            message = self.messages.pop(msg_id)
+            self._record(messagesDeleted=[self._ref(message)])
+
+    def modify_labels(self, msg_id: str, add: List[str] = (), remove: List[str] = ()):
+        with self.lock:
+            message = self.messages[msg_id]
+            added = [label for label in add if label not in message['labelIds']]
+            removed = [label for label in remove if label in message['labelIds'] and label not in added]
+            message['labelIds'] = [label for label in message['labelIds'] if label not in removed] + added
+            ref = self._ref(message)
+            if added:
+                self._record(labelsAdded=[dict(ref, labelIds=added)])
+            if removed:
+                self._record(labelsRemoved=[dict(ref, labelIds=removed)])
+
+    def create_label(self, name: str) -> Optional[Dict[str, str]]:
+        """Add a user label; returns None when a label with that name already exists."""
+        with self.lock:
+            if any(label['name'].lower() == name.lower() for label in self.labels.values()):
+                return None
+            label = {'id': f'Label_{len(self.labels) + 1}', 'name': name, 'type': 'user'}
+            self.labels[label['id']] = label
+            return label
+
+    def expire_history(self):
+        """Forget all history so older historyIds can no longer be synced from."""
+        with self.lock:
+            self.history = []
+            self.history_floor = self.history_id
+
+    def ordered_ids(self) -> List[str]:
+        with self.lock:
+            return sorted(self.messages, key=lambda msg_id: int(self.messages[msg_id]['internalDate']), reverse=True)
+
+
+def _format_message(message: Dict[str, Any], fmt: str, metadata_headers: List[str]) -> Dict[str, Any]:
+    if fmt == 'minimal':
+        return {key: value for key, value in message.items() if key != 'payload'}
+    if fmt == 'metadata':
+        wanted = {name.lower() for name in metadata_headers}
+        headers = [h for h in message['payload']['headers'] if not wanted or h['name'].lower() in wanted]
+        payload = {'mimeType': message['payload']['mimeType'], 'headers': headers}
+        return dict(message, payload=payload)
+    return message
+
+
+class FakeGmailServer:
+    """Threaded HTTP server serving a FakeMailbox under the Gmail v1 REST paths.
+
+    `latency` seconds, plus up to `jitter` random seconds, are added to every HTTP request
+    (a batch counts as one request). A fraction `error_rate` of API calls, including
+    calls inside a batch, fail with `error_status` and the reason Gmail gives for it.
+    """
+
+    def __init__(self, mailbox: Optional[FakeMailbox] = None, latency: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 429, seed: int = 0):
+        self.mailbox = mailbox or FakeMailbox()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+        self.request_count = 0
+        self.error_count = 0
+        self.counter_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'FakeGmailServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, method: str, url: str, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        """Dispatch one (possibly batched) API call and return (status, JSON body)."""
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        path = parts.path
+
+        if self.error_rate:
+            with self.counter_lock:
+                failing = self.rng.random() < self.error_rate
+                self.error_count += failing
+            if failing:
+                status = self.error_status
+                return status, _error(status, 'Injected error', ERROR_REASONS.get(status, 'backendError'))
+
+        match = re.fullmatch(r'/gmail/v1/users/[^/]+/messages/batchModify', path)
+        if match and method == 'POST':
+            return self._batch_modify(_json(body))
+
+        match = re.fullmatch(r'/gmail/v1/users/[^/]+/messages/([^/]+)/modify', path)
+        if match and method == 'POST':
+            return self._modify(match.group(1), _json(body))
+
+        if re.fullmatch(r'/gmail/v1/users/[^/]+/labels', path):
+            if method == 'GET':
+                with self.mailbox.lock:
+                    return 200, {'labels': list(self.mailbox.labels.values())}
+            if method == 'POST':
+                label = self.mailbox.create_label(_json(body).get('name', ''))
+                if label is None:
+                    return 409, _error(409, 'Label name exists or conflicts', 'duplicate')
+                return 200, label
+
+        match = re.fullmatch(r'/gmail/v1/users/[^/]+/messages', path)
+        if match and method == 'GET':
+            return 200, self._list_messages(query)
+
+        if re.fullmatch(r'/gmail/v1/users/[^/]+/profile', path) and method == 'GET':
+            return 200, {'emailAddress': 'me@example.com', 'messagesTotal': len(self.mailbox.messages),
+                         'historyId': str(self.mailbox.history_id)}
+
+        if re.fullmatch(r'/gmail/v1/users/[^/]+/history', path) and method == 'GET':
+            return self._list_history(query)
+
+        match = re.fullmatch(r'/gmail/v1/users/[^/]+/messages/([^/]+)', path)
+        if match and method == 'GET':
+            message = self.mailbox.messages.get(match.group(1))
+            if message is None:
+                return 404, _error(404, 'Requested entity was not found.')
+            fmt = query.get('format', ['full'])[0]
+            return 200, _format_message(message, fmt, query.get('metadataHeaders', []))
+
+        return 404, _error(404, f'Unknown endpoint {method} {path}')
+
+    def _check_labels(self, label_ids: List[str]) -> Optional[Tuple[int, Dict[str, Any]]]:
+        unknown = [label for label in label_ids if label not in self.mailbox.labels]
+        if unknown:
+            return 400, _error(400, f'Invalid label: {unknown[0]}', 'invalidArgument')
+        return None
+
+    def _modify(self, msg_id: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        add, remove = body.get('addLabelIds', []), body.get('removeLabelIds', [])
+        invalid = self._check_labels(add + remove)
+        if invalid:
+            return invalid
+        if msg_id not in self.mailbox.messages:
+            return 404, _error(404, 'Requested entity was not found.')
+        self.mailbox.modify_labels(msg_id, add, remove)
+        return 200, _format_message(self.mailbox.messages[msg_id], 'minimal', [])
+
+    def _batch_modify(self, body: Dict[str, Any]) -> Tuple[int, Optional[Dict[str, Any]]]:
+        ids = body.get('ids', [])
+        add, remove = body.get('addLabelIds', []), body.get('removeLabelIds', [])
+        if len(ids) > 1000:
+            return 400, _error(400, 'Too many ids', 'invalidArgument')
+        invalid = self._check_labels(add + remove)
+        if invalid:
+            return invalid
+        # Like Gmail, ids that do not exist are ignored
+        for msg_id in ids:
+            if msg_id in self.mailbox.messages:
+                self.mailbox.modify_labels(msg_id, add, remove)
+        return 204, None
+
+    def _list_messages(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        ids = self.mailbox.ordered_ids()
+        label_ids = query.get('labelIds', [])
+        search = query.get('q', [''])[0]
+        if label_ids or search:
+            messages = self.mailbox.messages
+            ids = [msg_id for msg_id in ids
+                   if all(label in messages[msg_id]['labelIds'] for label in label_ids)
+                   and _matches_search(messages[msg_id], search)]
+        page_size = min(int(query.get('maxResults', ['100'])[0]), 500)
+        offset = int(query.get('pageToken', ['0'])[0])
+        page = ids[offset:offset + page_size]
+        response: Dict[str, Any] = {
+            'messages': [{'id': msg_id, 'threadId': self.mailbox.messages[msg_id]['threadId']} for msg_id in page],
+            'resultSizeEstimate': len(ids),
+        }
+        if offset + page_size < len(ids):
+            response['nextPageToken'] = str(offset + page_size)
+        return response
+
+    def _list_history(self, query: Dict[str, List[str]]) -> Tuple[int, Dict[str, Any]]:
+        start = int(query['startHistoryId'][0])
+        with self.mailbox.lock:
+            if start < self.mailbox.history_floor:
+                return 404, _error(404, 'Requested entity was not found.')
+            types = set(query.get('historyTypes', []))
+            records = [record for record in self.mailbox.history if int(record['id']) > start]
+            current = str(self.mailbox.history_id)
+        if types:
+            records = [record for record in records if _history_type(record) in types]
+        label_id = query.get('labelId', [None])[0]
+        if label_id:
+            records = [record for record in records if label_id in _history_message(record)['labelIds']]
+        page_size = int(query.get('maxResults', ['100'])[0])
+        offset = int(query.get('pageToken', ['0'])[0])
+        response: Dict[str, Any] = {'history': records[offset:offset + page_size], 'historyId': current}
+        if offset + page_size < len(records):
+            response['nextPageToken'] = str(offset + page_size)
+        return 200, response
+
+    def handle_batch(self, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        """Answer a multipart/mixed batch request with a multipart/mixed response."""
+        envelope = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        boundary = f'batch_{random.getrandbits(64):x}'
+        chunks = []
+        for part in envelope.iter_parts():
+            content_id = part['Content-ID'] or ''
+            raw = part.get_payload(decode=False)
+            request_line, _, rest = raw.partition('\n')
+            method, url, _ = request_line.strip().split(' ', 2)
+            _, _, sub_body = rest.partition('\r\n\r\n')
+            status, payload = self.handle(method, url, sub_body.encode())
+            response_id = content_id.replace('<', '<response-', 1)
+            chunks.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {response_id}\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status < 400 else "Error"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n{"" if payload is None else json.dumps(payload)}\r\n'
+            )
+        chunks.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(chunks).encode()
+
+
+def _matches_search(message: Dict[str, Any], search: str) -> bool:
+    """Evaluate the subset of Gmail search syntax the fake understands."""
+    headers = {h['name'].lower(): h['value'].lower() for h in message['payload']['headers']}
+    body = base64.urlsafe_b64decode(message['payload']['body'].get('data', '')).decode().lower()
+    age_days = (time.time() - int(message['internalDate']) / 1000) / 86400
+    for term in search.lower().split():
+        key, _, value = term.partition(':')
+        if not value:
+            key, value = '', term
+        if key == 'is' and value in ('read', 'unread'):
+            ok = ('UNREAD' in message['labelIds']) == (value == 'unread')
+        elif key in ('from', 'to', 'subject'):
+            ok = value in headers.get(key, '')
+        elif key == 'label':
+            ok = value in (label.lower() for label in message['labelIds'])
+        elif key in ('newer_than', 'older_than') and value.endswith('d'):
+            ok = (age_days < int(value[:-1])) == (key == 'newer_than')
+        else:
+            ok = term in headers.get('subject', '') or term in body
+        if not ok:
+            return False
+    return True
+
+
+def _history_message(record: Dict[str, Any]) -> Dict[str, Any]:
+    """The message a history record (holding a single change) is about."""
+    for key in ('messagesAdded', 'messagesDeleted', 'labelsAdded', 'labelsRemoved'):
+        if key in record:
+            return record[key][0]['message']
+    return {'labelIds': []}
+
+
+def _history_type(record: Dict[str, Any]) -> str:
+    for key, name in (('messagesAdded', 'messageAdded'), ('messagesDeleted', 'messageDeleted'),
+                      ('labelsAdded', 'labelAdded'), ('labelsRemoved', 'labelRemoved')):
+        if key in record:
+            return name
+    return ''
+
+
+def _error(code: int, message: str, reason: str = 'notFound') -> Dict[str, Any]:
+    return {'error': {'code': code, 'message': message, 'errors': [{'message': message, 'reason': reason}]}}
+
+
+def _json(body: bytes) -> Dict[str, Any]:
+    return json.loads(body) if body else {}
+
+
+def _make_handler(server: FakeGmailServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _respond(self, status: int, content_type: str, body: bytes):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _serve(self, method: str):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            with server.counter_lock:
+                server.request_count += 1
+            if server.latency or server.jitter:
+                # Handlers run on their own threads; the shared RNG is only drawn from under the lock
+                with server.counter_lock:
+                    jitter = server.rng.uniform(0, server.jitter)
+                time.sleep(server.latency + jitter)
+
+            if urlsplit(self.path).path.startswith('/batch'):
+                content_type, payload = server.handle_batch(self.headers['Content-Type'], body)
+                self._respond(200, content_type, payload)
+                return
+            status, payload = server.handle(method, self.path, body)
+            content = b'' if payload is None else json.dumps(payload).encode()
+            self._respond(status, 'application/json; charset=UTF-8', content)
+
+        def do_GET(self):
+            self._serve('GET')
+
+        def do_POST(self):
+            self._serve('POST')
+
+    return Handler
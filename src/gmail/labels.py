@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+from googleapiclient.errors import HttpError
+from ..database.models import GmailLabel
+from .scheduler import RequestScheduler
+
+# Seconds before the cached label list is considered stale and reloaded
+LABEL_CACHE_TTL = float(os.getenv('GMAIL_LABEL_CACHE_TTL', '3600'))
+
+
+class LabelStore:
+    """Persists the label name -> id mapping so later runs start with a warm cache."""
+
+    def __init__(self, session_factory: Callable):
+        self.session_factory = session_factory
+
+    def load(self) -> Tuple[Dict[str, str], Optional[datetime]]:
+        """Return the stored {name: label_id} mapping and when it was last written."""
+        db = self.session_factory()
+        try:
+            rows = db.query(GmailLabel).all()
+            labels = {row.name: row.label_id for row in rows}
+            updated_at = max((row.updated_at for row in rows if row.updated_at), default=None)
+            return labels, updated_at
+        finally:
+            db.close()
+
+    def save(self, labels: Dict[str, str], replace: bool = False):
+        """Upsert labels; with replace=True, labels missing from `labels` are removed."""
+        db = self.session_factory()
+        try:
+            existing = {row.label_id: row for row in db.query(GmailLabel).all()}
+            now = datetime.utcnow()
+            for name, label_id in labels.items():
+                row = existing.pop(label_id, None)
+                if row is None:
+                    db.add(GmailLabel(label_id=label_id, name=name, updated_at=now))
+                else:
+                    row.name = name
+                    row.updated_at = now
+            if replace:
+                for row in existing.values():
+                    db.delete(row)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+class LabelCache:
+    """Case-insensitive label name -> id cache for a Gmail mailbox.
+
+    The label list is loaded once and reused until it is older than `ttl` seconds or a
+    lookup misses. Lookups that need to create a label are serialized, so concurrent
+    moves to the same new label create it only once. `http`, when given, returns the
+    connection to send each request over (see GmailClient._thread_http).
+    """
+
+    def __init__(self, service, ttl: float = LABEL_CACHE_TTL, store: Optional[LabelStore] = None,
+                 scheduler: Optional[RequestScheduler] = None, http: Optional[Callable] = None):
+        self.service = service
+        self.scheduler = scheduler or RequestScheduler()
+        self.http = http
+        self.ttl = ttl
+        self.store = store
+        self.labels: Dict[str, str] = {}
+        self.loaded_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+        if store is not None:
+            labels, updated_at = store.load()
+            if labels:
+                self.labels = {name.lower(): label_id for name, label_id in labels.items()}
+                self.loaded_at = (updated_at - datetime(1970, 1, 1)).total_seconds() if updated_at else None
+
+    def is_stale(self) -> bool:
+        return self.loaded_at is None or time.time() - self.loaded_at > self.ttl
+
+    def _execute(self, method: str, request):
+        if self.http is None:
+            return self.scheduler.execute(method, request)
+        return self.scheduler.execute(method, request, http=self.http())
+
+    def refresh(self):
+        """Reload every label from Gmail."""
+        response = self._execute('labels.list', self.service.users().labels().list(userId='me'))
+        labels = {label['name']: label['id'] for label in response.get('labels', [])}
+        self.labels = {name.lower(): label_id for name, label_id in labels.items()}
+        self.loaded_at = time.time()
+        if self.store is not None:
+            self.store.save(labels, replace=True)
+
+    def get_id(self, label_name: str, create: bool = True) -> Optional[str]:
+        """Resolve a label name to its id, optionally creating the label on a miss."""
+        key = label_name.lower()
+        if not self.is_stale():
+            label_id = self.labels.get(key)
+            if label_id:
+                return label_id
+
+        with self.lock:
+            # Another thread may have refreshed or created the label while we waited
+            if self.is_stale() or key not in self.labels:
+                self.refresh()
+            label_id = self.labels.get(key)
+            if label_id or not create:
+                return label_id
+            return self._create(label_name)
+
+    def _create(self, label_name: str) -> str:
+        try:
+            label = self._execute('labels.create', self.service.users().labels().create(
+                userId='me',
+                body={'name': label_name}
+            ))
+        except HttpError as e:
+            # 409: the label was created elsewhere since our last refresh
+            if e.resp.status != 409:
+                raise
+            self.refresh()
+            return self.labels[label_name.lower()]
+
+        self.labels[label_name.lower()] = label['id']
+        if self.store is not None:
+            self.store.save({label['name']: label['id']})
+        return label['id']
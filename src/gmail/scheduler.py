@@ -0,0 +1,182 @@
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+from googleapiclient.errors import HttpError
+from ..metrics import metrics
+
+# Gmail API quota units per call (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'labels.create': 5,
+    'getProfile': 1,
+    'history.list': 2,
+}
+DEFAULT_QUOTA_UNITS = 5
+# Per-user quota units per second; 0 turns throttling off (e.g. against the fake server)
+QUOTA_RATE = float(os.getenv('GMAIL_QUOTA_RATE', '250'))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# A 403 is only retried when Gmail says it is a rate limit rather than a permission problem
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed request is worth retrying after a pause."""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status in RETRYABLE_STATUSES:
+            return True
+        if status == 403:
+            content = error.content.decode(errors='replace') if isinstance(error.content, bytes) else str(error.content)
+            return any(reason in content for reason in RATE_LIMIT_REASONS)
+        return False
+    # Dropped connections and timeouts
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def _status(error: Exception) -> str:
+    """The status a failed call is counted under: its HTTP status or the exception type."""
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return type(error).__name__
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    if isinstance(error, HttpError):
+        value = error.resp.get('retry-after')
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` units per second, up to `capacity`.
+
+    acquire() reserves its units straight away and lets the balance go negative, then
+    sleeps outside the lock until the reservation is covered. Callers are therefore
+    spaced evenly at the refill rate rather than all waking up together.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units: float) -> float:
+        """Take `units`, waiting for them if needed; returns the seconds waited."""
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def drain(self):
+        """Empty the bucket so every caller slows down after a rate-limit response."""
+        with self.lock:
+            self._refill(self.clock())
+            self.tokens = min(self.tokens, 0.0)
+
+
+class RequestScheduler:
+    """Runs Gmail requests within the per-user quota, retrying transient failures.
+
+    Every request first takes its quota units from a token bucket. Retryable errors
+    (429, 5xx, 403 rate limits and dropped connections) are retried up to `max_retries`
+    times with exponential backoff and full jitter, honouring Retry-After when present.
+    A rate-limit response also empties the bucket so concurrent callers back off too.
+    The counters in stats() show how much time went into throttling and backoff; with
+    metrics enabled every attempt's latency and status is also recorded per method.
+    """
+
+    def __init__(self, rate: Optional[float] = QUOTA_RATE, burst: Optional[float] = None, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 32.0, sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.monotonic):
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'units': 0, 'retries': 0, 'failures': 0,
+                         'throttled_seconds': 0.0, 'backoff_seconds': 0.0}
+
+    def _count(self, name: str, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return dict(self.counters)
+
+    def acquire(self, units: float):
+        """Wait until `units` quota units are available."""
+        if self.bucket is not None:
+            waited = self.bucket.acquire(units)
+            if waited:
+                self._count('throttled_seconds', waited)
+                metrics.inc('gmail_throttled_seconds_total', waited)
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def execute(self, method: str, request, units: Optional[float] = None, **kwargs):
+        """Execute `request` (anything with .execute()) as a call to Gmail `method`.
+
+        `units` overrides the quota cost, e.g. for an HTTP batch of several calls; extra
+        keyword arguments go to request.execute(). The last error is raised once the
+        retries are used up or the error is not retryable.
+        """
+        if units is None:
+            units = QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+        attempt = 0
+        while True:
+            self.acquire(units)
+            self._count('requests')
+            self._count('units', units)
+            metrics.inc('gmail_api_units_total', units, method=method)
+            start = time.perf_counter()
+            try:
+                response = request.execute(**kwargs)
+                if metrics.enabled:
+                    metrics.observe('gmail_api_latency_seconds', time.perf_counter() - start, method=method)
+                    metrics.inc('gmail_api_calls_total', method=method, status='ok')
+                return response
+            except Exception as e:
+                if metrics.enabled:
+                    metrics.observe('gmail_api_latency_seconds', time.perf_counter() - start, method=method)
+                    metrics.inc('gmail_api_calls_total', method=method, status=_status(e))
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                if isinstance(e, HttpError) and e.resp.status in (403, 429) and self.bucket is not None:
+                    self.bucket.drain()
+                delay = self.backoff_delay(attempt, e)
+                self._count('retries')
+                metrics.inc('gmail_api_retries_total', method=method)
+                self._count('backoff_seconds', delay)
+                self.sleep(delay)
+                attempt += 1
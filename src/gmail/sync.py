@@ -0,0 +1,254 @@
+import json
+from typing import Dict, Iterable, List, Optional
+from googleapiclient.errors import HttpError
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+from ..database.ingest import EmailIngestor, existing_gmail_ids
+from ..database.models import Email, SyncState
+from ..rules.planner import FULL_FETCH, FetchPlan
+from .client import GmailClient
+
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+# Number of gmail ids per IN (...) query
+ID_CHUNK_SIZE = 500
+
+
+def _chunks(items: List[str], size: int = ID_CHUNK_SIZE) -> Iterable[List[str]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class MailboxSync:
+    """Keeps the emails table in step with a Gmail mailbox using its historyId.
+
+    The first run (and any run whose stored historyId has expired) does a full sync of the
+    newest `max_results` messages matching `query`/`label_ids`. Later runs replay users.history.list from the stored
+    historyId, so they only touch messages that were added, deleted or relabelled.
+
+    Later runs keep to the same filters: history is requested for the first of `label_ids`
+    and only new messages carrying all of them are stored, along with messages that are
+    given one of them and now carry all of them. History cannot be searched, so
+    with a `query` new messages are checked against one listing of the newest
+    max(`max_results`, number of new messages) matches; a new message dated before all of
+    them is left out, as a full sync would leave it out.
+
+    New messages are fetched in the format `fetch_plan` asks for; without a body when no
+    rule reads it (see rules.planner).
+    """
+
+    def __init__(self, gmail_client: GmailClient, db: Session, account: str = 'me', max_results: int = 100,
+                 query: Optional[str] = None, label_ids: Optional[List[str]] = None,
+                 fetch_plan: FetchPlan = FULL_FETCH):
+        self.gmail_client = gmail_client
+        self.db = db
+        self.account = account
+        self.max_results = max_results
+        self.query = query
+        self.label_ids = label_ids
+        self.fetch_plan = fetch_plan
+
+    def get_state(self) -> SyncState:
+        state = self.db.query(SyncState).filter_by(account=self.account).first()
+        if state is None:
+            state = SyncState(account=self.account)
+            self.db.add(state)
+        return state
+
+    def sync(self) -> Dict[str, int]:
+        """Run an incremental sync when possible, otherwise a full one. Returns change counts."""
+        state = self.get_state()
+        if state.history_id:
+            try:
+                return self.incremental_sync(state)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                self.db.rollback()
+                state = self.get_state()
+                print(f"History {state.history_id} has expired, running a full resync")
+        return self.full_sync(state)
+
+    def full_sync(self, state: SyncState) -> Dict[str, int]:
+        # Take the historyId first so changes made while we list are replayed next time
+        history_id = self.gmail_client.get_profile()['historyId']
+        listed = [message['id'] for message in self.gmail_client.list_messages(
+            max_results=self.max_results, query=self.query, label_ids=self.label_ids)]
+
+        existing = self.existing_ids(listed)
+
+        stats = {'added': self.store_messages([gmail_id for gmail_id in listed if gmail_id not in existing])}
+        labels = {}
+        for gmail_id, message in self.gmail_client.get_messages(sorted(existing), format='minimal'):
+            if message:
+                labels[gmail_id] = message.get('labelIds', [])
+        stats['relabelled'] = self.update_labels(labels)
+        stats['deleted'] = 0
+
+        state.history_id = history_id
+        self.db.commit()
+        return stats
+
+    def incremental_sync(self, state: SyncState) -> Dict[str, int]:
+        history_id = self.gmail_client.get_profile()['historyId']
+        added: Dict[str, List[str]] = {}
+        labels: Dict[str, List[str]] = {}
+        deleted = set()
+
+        label_id = self.label_ids[0] if self.label_ids else None
+        for record in self.gmail_client.list_history(state.history_id, HISTORY_TYPES, label_id=label_id):
+            for item in record.get('messagesAdded', []):
+                message = item['message']
+                added[message['id']] = message.get('labelIds', [])
+                deleted.discard(message['id'])
+            for item in record.get('messagesDeleted', []):
+                gmail_id = item['message']['id']
+                deleted.add(gmail_id)
+                added.pop(gmail_id, None)
+                labels.pop(gmail_id, None)
+            for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                message = item['message']
+                if message['id'] not in deleted:
+                    labels[message['id']] = message.get('labelIds', [])
+                if message['id'] in added or set(item.get('labelIds', [])) & set(self.label_ids or []):
+                    # A message given one of the filter labels comes into scope like a new one;
+                    # filters are tested on the labels it has by the end of the replay
+                    added[message['id']] = message.get('labelIds', [])
+
+        existing = self.existing_ids(list(added))
+        for gmail_id in existing:
+            labels.setdefault(gmail_id, added[gmail_id])
+        new_ids = self.in_scope({gmail_id: label_ids for gmail_id, label_ids in added.items()
+                                 if gmail_id not in existing})
+
+        stats = {
+            'added': self.store_messages(new_ids),
+            'relabelled': self.update_labels(labels),
+            'deleted': 0,
+        }
+        for chunk in _chunks(sorted(deleted)):
+            stats['deleted'] += self.db.query(Email).filter(Email.gmail_id.in_(chunk)).delete(synchronize_session=False)
+
+        state.history_id = history_id
+        self.db.commit()
+        return stats
+
+    def in_scope(self, added: Dict[str, List[str]]) -> List[str]:
+        """The ids of new messages ({gmail id: label ids}) that match `label_ids` and `query`."""
+        new_ids = [gmail_id for gmail_id, label_ids in added.items()
+                   if all(label in label_ids for label in self.label_ids or [])]
+        if self.query and new_ids:
+            matching = {message['id'] for message in self.gmail_client.list_messages(
+                max_results=max(self.max_results, len(new_ids)), query=self.query, label_ids=self.label_ids)}
+            new_ids = [gmail_id for gmail_id in new_ids if gmail_id in matching]
+        return new_ids
+
+    def backfill(self, query: Optional[str] = None, label_ids: Optional[List[str]] = None) -> int:
+        """Store every message matching the filters, page by page, resuming after a crash.
+
+        The page token of the next page is committed together with the emails of the page
+        just stored, so an interrupted backfill continues where it stopped. Returns the
+        number of emails added by this call.
+        """
+        state = self.get_state()
+        key = json.dumps({'q': query, 'labelIds': sorted(label_ids or [])}, sort_keys=True)
+        page_token = state.backfill_token if state.backfill_query == key else None
+        state.backfill_query = key
+        added = 0
+        page: List[str] = []
+
+        def on_page(next_token):
+            nonlocal added
+            added += self.store_new_messages(page)
+            page.clear()
+            state.backfill_token = next_token
+            if next_token is None:
+                state.backfill_query = None
+            self.db.commit()
+
+        for message in self.gmail_client.iter_messages(query=query, label_ids=label_ids,
+                                                       page_token=page_token, on_page=on_page):
+            page.append(message['id'])
+        return added
+
+    def existing_ids(self, gmail_ids: List[str]) -> set:
+        """The subset of `gmail_ids` already stored."""
+        return existing_gmail_ids(self.db, gmail_ids)
+
+    def store_new_messages(self, gmail_ids: List[str]) -> int:
+        """Fetch and add the messages that are not stored yet."""
+        existing = self.existing_ids(gmail_ids)
+        return self.store_messages([gmail_id for gmail_id in gmail_ids if gmail_id not in existing])
+
+    def store_messages(self, gmail_ids: List[str]) -> int:
+        """Fetch and insert the given messages in committed chunks; returns how many were stored."""
+        with EmailIngestor(self.db) as ingestor:
+            for gmail_id, message in self.gmail_client.get_messages(
+                    gmail_ids, format=self.fetch_plan.format, metadata_headers=self.fetch_plan.metadata_headers):
+                if message:
+                    ingestor.add(self.gmail_client.parse_message(message))
+        return ingestor.inserted
+
+    def fetch_missing_bodies(self, chunk_size: int = ID_CHUNK_SIZE) -> int:
+        """Download the bodies of stored emails that were fetched without one.
+
+        Needed once a rule starts reading the message body. Works through the emails in id
+        order, committing each chunk; returns how many bodies were filled in. Emails whose
+        message Gmail no longer has are deleted, as a sync would delete them, so they are
+        not requested again; those that failed for another reason are tried on the next call.
+        """
+        table = Email.__table__
+        statement = update(table).where(table.c.id == bindparam('email_id')).values(message=bindparam('body'))
+        filled = 0
+        last_id = 0
+        while True:
+            rows = (self.db.query(Email.id, Email.gmail_id)
+                    .filter(Email.id > last_id, Email.message.is_(None))
+                    .order_by(Email.id).limit(chunk_size).all())
+            if not rows:
+                return filled
+            last_id = rows[-1].id
+            email_ids = {gmail_id: email_id for email_id, gmail_id in rows}
+            bodies = []
+            gone = set()
+            for gmail_id, message in self.gmail_client.get_messages(list(email_ids), not_found=gone):
+                if message:
+                    bodies.append({'email_id': email_ids[gmail_id],
+                                   'body': self.gmail_client.parse_message(message)['message']})
+            if bodies:
+                # The index follows the new bodies through its update trigger
+                self.db.execute(statement, bodies)
+            if gone:
+                self.db.query(Email).filter(Email.gmail_id.in_(gone)).delete(synchronize_session=False)
+            self.db.commit()
+            filled += len(bodies)
+
+    def update_labels(self, labels: Dict[str, List[str]]) -> int:
+        """Update is_read/label in place for stored emails; returns how many changed.
+
+        Only a read-state change moves updated_at. No rule reads the label, so a label-only
+        change (such as a rule's own move_to coming back) writes updated_at back unchanged
+        and the email stays processed (see rules.ledger).
+        """
+        table = Email.__table__
+        relabel = (update(table).where(table.c.id == bindparam('email_id'))
+                   .values(label=bindparam('new_label'), updated_at=table.c.updated_at))
+        mark = (update(table).where(table.c.id == bindparam('email_id'))
+                .values(is_read=bindparam('read'), label=bindparam('new_label')))
+        changed = 0
+        for chunk in _chunks(sorted(labels)):
+            relabelled, marked = [], []
+            rows = self.db.query(Email.id, Email.gmail_id, Email.is_read, Email.label).filter(Email.gmail_id.in_(chunk))
+            for email_id, gmail_id, was_read, old_label in rows:
+                label_ids = labels[gmail_id]
+                is_read = 'UNREAD' not in label_ids
+                label = ','.join(label_ids)
+                if was_read != is_read:
+                    marked.append({'email_id': email_id, 'read': is_read, 'new_label': label})
+                elif old_label != label:
+                    relabelled.append({'email_id': email_id, 'new_label': label})
+            if relabelled:
+                self.db.execute(relabel, relabelled)
+            if marked:
+                self.db.execute(mark, marked)
+            changed += len(relabelled) + len(marked)
+        return changed
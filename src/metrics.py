@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Tuple
+
+# Directory the scripts write metrics.json and metrics.prom to; setting it turns metrics on
+METRICS_DIR = os.getenv('METRICS_DIR')
+# Prefix of every exported Prometheus metric name
+NAMESPACE = 'gmail_processor'
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _finite(value: float) -> Optional[float]:
+    # JSON has no infinity; a quantile above every bucket bound is reported as null
+    return None if value == float('inf') else value
+
+
+class Histogram:
+    """Observation counts per bucket, plus their number and sum."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket and a last one for observations above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(upper bound, observations at or below it) pairs as Prometheus expects them."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return pairs
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the q-quantile: the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, labels: Dict[str, Any]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class MetricsRegistry:
+    """Thread-safe counters and latency histograms keyed by name and labels.
+
+    While disabled every recording call returns straight away, so instrumented code only
+    pays for an attribute check; hot loops test `enabled` themselves before doing any
+    timing. report() and to_prometheus() export what was recorded since the last reset().
+    """
+
+    def __init__(self, enabled: bool = False, namespace: str = NAMESPACE):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[LabelKey, float]] = {}
+        self.histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Add `amount` to a counter."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """Record one observation (usually seconds) in a histogram."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def time(self, name: str, **labels):
+        """Context manager observing the seconds its block took in histogram `name`."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def value(self, name: str, **labels) -> float:
+        """A counter's current value (0 if it was never incremented)."""
+        with self.lock:
+            return self.counters.get(name, {}).get(_label_key(labels), 0)
+
+    def totals(self, name: str, label: str) -> Dict[str, float]:
+        """A counter summed per value of one of its labels, e.g. seconds per rule."""
+        totals: Dict[str, float] = {}
+        with self.lock:
+            for key, value in self.counters.get(name, {}).items():
+                label_value = dict(key).get(label)
+                if label_value is not None:
+                    totals[label_value] = totals.get(label_value, 0) + value
+        return totals
+
+    def take_counters(self) -> Dict[str, Dict[LabelKey, float]]:
+        """Remove and return the counters, e.g. to send them from a worker process."""
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        return counters
+
+    def merge_counters(self, counters: Dict[str, Dict[LabelKey, float]]):
+        """Add counters taken from another registry."""
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, other in counters.items():
+                series = self.counters.setdefault(name, {})
+                for key, value in other.items():
+                    series[key] = series.get(key, 0) + value
+
+    def report(self) -> Dict[str, Any]:
+        """Everything recorded, as a JSON-serializable dict."""
+        with self.lock:
+            counters = [
+                {'name': name, 'labels': dict(key), 'value': value}
+                for name, series in sorted(self.counters.items()) for key, value in sorted(series.items())
+            ]
+            histograms = [
+                {'name': name, 'labels': dict(key), 'count': histogram.count, 'sum': histogram.sum,
+                 'p50': _finite(histogram.quantile(0.5)), 'p99': _finite(histogram.quantile(0.99)),
+                 'buckets': dict(histogram.cumulative())}
+                for name, series in sorted(self.histograms.items()) for key, histogram in sorted(series.items())
+            ]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self) -> str:
+        """Everything recorded, in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                metric = f"{self.namespace}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{metric}{_format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                metric = f"{self.namespace}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for key, histogram in sorted(series.items()):
+                    for bound, count in histogram.cumulative():
+                        lines.append(f"{metric}_bucket{_format_labels(key, (('le', bound),))} {count}")
+                    lines.append(f"{metric}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{metric}_count{_format_labels(key)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory: Optional[str] = None) -> List[str]:
+        """Write metrics.json and metrics.prom to `directory` (METRICS_DIR by default).
+
+        Returns the paths written; nothing is written while disabled or without a directory.
+        """
+        directory = directory or METRICS_DIR
+        if not self.enabled or not directory:
+            return []
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, 'metrics.json')
+        prometheus_path = os.path.join(directory, 'metrics.prom')
+        with open(json_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        # Written under a temporary name first so a node_exporter textfile collector never reads half a file
+        with open(prometheus_path + '.tmp', 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(prometheus_path + '.tmp', prometheus_path)
+        return [json_path, prometheus_path]
+
+
+# The registry the engine, actions and Gmail scheduler record into
+metrics = MetricsRegistry(enabled=bool(METRICS_DIR))
+
+
+def export_metrics(directory: Optional[str] = None):
+    """Write the run's metrics (see MetricsRegistry.export) and say where they went."""
+    for path in metrics.export(directory):
+        print(f"Wrote metrics to {path}")
+
+
+def print_hot_rules(limit: int = 5):
+    """Print the rules that took longest to evaluate, with their match rates."""
+    seconds = metrics.totals('rule_evaluation_seconds_total', 'rule')
+    evaluations = metrics.totals('rule_evaluations_total', 'rule')
+    matches = metrics.totals('rule_matches_total', 'rule')
+    for rule, spent in sorted(seconds.items(), key=lambda item: item[1], reverse=True)[:limit]:
+        count = evaluations.get(rule, 0)
+        rate = matches.get(rule, 0) / count if count else 0.0
+        print(f"  {rule}: {spent * 1000:.1f}ms over {count:.0f} evaluations, {rate:.1%} matched")
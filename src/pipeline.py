@@ -0,0 +1,312 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from .database.ingest import EmailIngestor, existing_gmail_ids
+from .database.models import Email
+from .gmail.client import BATCH_REQUEST_LIMIT, GmailClient, parse_message
+from .metrics import metrics
+from .rules.actions import ActionBatch
+from .rules.compiler import compile_rules
+from .rules.engine import RuleEngine
+from .rules.ledger import ProcessingLedger, outcome_of
+from .rules.parser import RuleParser
+from .rules.planner import plan_fetch
+from .rules.sql import email_load_options
+
+# Marks the end of a queue's input
+_DONE = object()
+# Longest pause applied to fetching while Gmail keeps failing requests
+MAX_FETCH_BACKOFF = 30.0
+
+# Per-process state of the evaluate workers, set up by _init_evaluator
+_evaluator: Dict[str, Any] = {}
+
+
+def _parse_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [parse_message(message) for message in messages]
+
+
+def _init_evaluator(rules_data: List[Dict[str, Any]], now: datetime, condition_stats, record_metrics: bool):
+    metrics.enabled = record_metrics
+    rules = compile_rules([RuleParser.rule_from_dict(data) for data in rules_data], now, condition_stats)
+    _evaluator['rules'] = rules
+    _evaluator['positions'] = {id(rule): position for position, rule in enumerate(rules)}
+    _evaluator['engine'] = RuleEngine(gmail_client=None)
+
+
+def _evaluate_rows(rows: List[Dict[str, Any]]) -> Tuple[List[List[int]], Dict]:
+    """Evaluate emails, given as the field values the rules read, in a worker process.
+
+    Returns the positions of the rules each email matches and the rule metrics recorded.
+    """
+    positions = _evaluator['positions']
+    matched = _evaluator['engine'].matching_rules_batch([Email(**row) for row in rows], _evaluator['rules'])
+    return [[positions[id(rule)] for rule in rules] for rules in matched], metrics.take_counters()
+
+
+class PipelineStopped(Exception):
+    """Raised in the listing thread when the pipeline is shutting down."""
+
+
+class EmailPipeline:
+    """Fetches, stores and processes emails in overlapping stages.
+
+    The stages (list -> fetch -> parse -> store -> evaluate -> act) are coroutines joined by
+    bounded queues, so a slow stage makes the ones before it wait instead of buffering the
+    whole mailbox. Blocking Gmail calls run on a thread pool and every database call runs
+    on a single dedicated thread with its own session. Parsing and rule evaluation run off
+    the event loop too, on a thread each by default; with `parse_workers` or
+    `evaluate_workers` above 1 they run in that many processes, in parallel with each
+    other and the other stages. A batch of emails is acted on as soon as it is stored, or
+    after `flush_interval` seconds if the batch is not full yet.
+
+    When fetched messages come back missing (rate limited or failing), the fetch workers
+    back off exponentially before taking more ids, and the bounded id queue then stalls
+    the listing.
+
+    `rules` are compiled once up front, with their conditions ordered by `condition_stats`
+    (see rules.selectivity) when given; load them from a session other than
+    `session_factory`'s, since the pipeline commits its own session after each batch.
+    """
+
+    def __init__(self, gmail_client: GmailClient, session_factory, rules, query: Optional[str] = None,
+                 label_ids: Optional[List[str]] = None, max_results: Optional[int] = None,
+                 fetch_workers: int = 4, fetch_batch_size: int = BATCH_REQUEST_LIMIT,
+                 parse_workers: int = 1, evaluate_workers: int = 1, act_workers: int = 2,
+                 store_batch_size: int = 500, act_batch_size: int = 100,
+                 queue_size: int = 1000, flush_interval: float = 1.0, condition_stats=None):
+        self.gmail_client = gmail_client
+        self.session_factory = session_factory
+        self.rule_engine = RuleEngine(gmail_client)
+        self.rules = self.rule_engine.compile_rules(rules, stats=condition_stats)
+        self.condition_stats = condition_stats
+        # Emails are evaluated detached from the session, so bodies the rules read are loaded up front
+        self.load_options = email_load_options(self.rules)
+        self.fetch_plan = plan_fetch(self.rules)
+        self.query = query
+        self.label_ids = label_ids
+        self.max_results = max_results
+        self.fetch_workers = fetch_workers
+        self.fetch_batch_size = min(fetch_batch_size, BATCH_REQUEST_LIMIT)
+        self.parse_workers = parse_workers
+        self.evaluate_workers = evaluate_workers
+        self.act_workers = act_workers
+        self.store_batch_size = store_batch_size
+        self.act_batch_size = act_batch_size
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.stats = {'listed': 0, 'skipped': 0, 'fetched': 0, 'failed': 0, 'stored': 0,
+                      'evaluated': 0, 'matched': 0}
+        self._backoff = 0.0
+        self._stop = threading.Event()
+
+    def run(self) -> Dict[str, int]:
+        """Run the pipeline to completion and return its counters."""
+        return asyncio.run(self.run_async())
+
+    async def run_async(self) -> Dict[str, int]:
+        self._loop = asyncio.get_running_loop()
+        self._network = ThreadPoolExecutor(max_workers=self.fetch_workers + self.act_workers + 1)
+        self._database = ThreadPoolExecutor(max_workers=1)
+        # One worker is a thread, which keeps the event loop free without pickling anything;
+        # more are processes, spawned rather than forked since this process already runs threads
+        spawn = multiprocessing.get_context('spawn')
+        self._parsers = (ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=spawn)
+                         if self.parse_workers > 1 else ThreadPoolExecutor(max_workers=1))
+        self._evaluators = (ProcessPoolExecutor(
+            max_workers=self.evaluate_workers, mp_context=spawn, initializer=_init_evaluator,
+            initargs=([RuleParser.rule_to_dict(rule) for rule in self.rules], self.rules.now,
+                      self.condition_stats, metrics.enabled))
+            if self.evaluate_workers > 1 else ThreadPoolExecutor(max_workers=1))
+        self._db = await self._in_database(self.session_factory)
+        self._ledger = ProcessingLedger(self._db, self.rules)
+
+        ids, messages, rows, emails, results = (asyncio.Queue(self.queue_size) for _ in range(5))
+        stages = [asyncio.ensure_future(stage) for stage in (
+            self._stage([self._list(ids)], ids),
+            self._stage([self._fetch(ids, messages) for _ in range(self.fetch_workers)], messages),
+            self._stage([self._parse(messages, rows) for _ in range(self.parse_workers)], rows),
+            self._stage([self._store(rows, emails)], emails),
+            self._stage([self._evaluate(emails, results) for _ in range(self.evaluate_workers)], results),
+            self._stage([self._act(results) for _ in range(self.act_workers)], None),
+        )]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            raise
+        finally:
+            self._stop.set()
+            await self._in_database(self._db.close)
+            self._network.shutdown(wait=True)
+            self._database.shutdown(wait=True)
+            self._parsers.shutdown(wait=True, cancel_futures=True)
+            self._evaluators.shutdown(wait=True, cancel_futures=True)
+        return self.stats
+
+    async def _stage(self, workers, outbound: Optional[asyncio.Queue]):
+        """Run a stage's workers, then tell the next stage no more input is coming."""
+        tasks = [asyncio.ensure_future(worker) for worker in workers]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if outbound is not None:
+            await outbound.put(_DONE)
+
+    def _in_network(self, function, *args):
+        return self._loop.run_in_executor(self._network, function, *args)
+
+    def _in_database(self, function, *args):
+        return self._loop.run_in_executor(self._database, function, *args)
+
+    async def _collect(self, queue: asyncio.Queue, size: int) -> Optional[List[Any]]:
+        """Take up to `size` items, waiting at most flush_interval once the first one arrived.
+
+        Returns None when the queue is finished; the end marker is put back so the other
+        workers of the stage see it too.
+        """
+        item = await queue.get()
+        if item is _DONE:
+            queue.put_nowait(_DONE)
+            return None
+        items = [item]
+        deadline = self._loop.time() + self.flush_interval
+        while len(items) < size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _DONE:
+                queue.put_nowait(_DONE)
+                break
+            items.append(item)
+        return items
+
+    def _put_from_thread(self, queue: asyncio.Queue, item):
+        # Blocks the listing thread while the queue is full, which is what throttles listing
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), self._loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if self._stop.is_set():
+                    future.cancel()
+                    raise PipelineStopped()
+
+    def _list_ids(self, outbound: asyncio.Queue):
+        listed = 0
+        try:
+            for message in self.gmail_client.iter_messages(query=self.query, label_ids=self.label_ids):
+                if self.max_results is not None and listed >= self.max_results:
+                    break
+                self._put_from_thread(outbound, message['id'])
+                listed += 1
+        except PipelineStopped:
+            pass
+        return listed
+
+    async def _list(self, outbound: asyncio.Queue):
+        self.stats['listed'] = await self._in_network(self._list_ids, outbound)
+
+    async def _fetch(self, inbound: asyncio.Queue, outbound: asyncio.Queue):
+        while True:
+            if self._backoff:
+                await asyncio.sleep(self._backoff)
+            gmail_ids = await self._collect(inbound, self.fetch_batch_size)
+            if gmail_ids is None:
+                return
+            existing = await self._in_database(existing_gmail_ids, self._db, gmail_ids)
+            self.stats['skipped'] += len(existing)
+            new_ids = [gmail_id for gmail_id in gmail_ids if gmail_id not in existing]
+            if not new_ids:
+                continue
+            fetched = await self._in_network(self._get_messages, new_ids)
+            failed = sum(message is None for _, message in fetched)
+            self.stats['failed'] += failed
+            self._backoff = min(max(self._backoff * 2, 0.5), MAX_FETCH_BACKOFF) if failed else 0.0
+            for _, message in fetched:
+                if message is not None:
+                    self.stats['fetched'] += 1
+                    await outbound.put(message)
+
+    def _get_messages(self, gmail_ids: List[str]):
+        # Concurrency is set by the number of fetch workers, so one batch per call
+        return list(self.gmail_client.get_messages(gmail_ids, batch_size=self.fetch_batch_size, max_workers=1,
+                                                   format=self.fetch_plan.format,
+                                                   metadata_headers=self.fetch_plan.metadata_headers))
+
+    async def _parse(self, inbound: asyncio.Queue, outbound: asyncio.Queue):
+        while True:
+            messages = await self._collect(inbound, self.fetch_batch_size)
+            if messages is None:
+                return
+            for row in await self._loop.run_in_executor(self._parsers, _parse_messages, messages):
+                await outbound.put(row)
+
+    def _store_rows(self, rows: List[Dict[str, Any]]) -> List[Email]:
+        with EmailIngestor(self._db, chunk_size=len(rows)) as ingestor:
+            for row in rows:
+                ingestor.add(row)
+        emails = (self._db.query(Email).options(*self.load_options)
+                  .filter(Email.gmail_id.in_([row['gmail_id'] for row in rows])).all())
+        for email in emails:
+            self._db.expunge(email)
+        return emails
+
+    async def _store(self, inbound: asyncio.Queue, outbound: asyncio.Queue):
+        while True:
+            rows = await self._collect(inbound, self.store_batch_size)
+            if rows is None:
+                return
+            emails = await self._in_database(self._store_rows, rows)
+            self.stats['stored'] += len(emails)
+            for email in emails:
+                await outbound.put(email)
+
+    async def _evaluate(self, inbound: asyncio.Queue, outbound: asyncio.Queue):
+        while True:
+            # Emails arrive a stored batch at a time, which is evaluated column-wise in one go
+            emails = await self._collect(inbound, self.store_batch_size)
+            if emails is None:
+                return
+            self.stats['evaluated'] += len(emails)
+            for evaluated in zip(emails, await self._matching_rules(emails)):
+                await outbound.put(evaluated)
+
+    async def _matching_rules(self, emails: List[Email]):
+        if isinstance(self._evaluators, ThreadPoolExecutor):
+            return await self._loop.run_in_executor(self._evaluators, self.rule_engine.matching_rules_batch,
+                                                    emails, self.rules)
+        # Worker processes get the field values the rules read, not the ORM objects
+        rows = [{attribute: getattr(email, attribute) for attribute in self.rules.attributes} for email in emails]
+        matched, counters = await self._loop.run_in_executor(self._evaluators, _evaluate_rows, rows)
+        metrics.merge_counters(counters)
+        return [[self.rules[position] for position in positions] for positions in matched]
+
+    async def _act(self, inbound: asyncio.Queue):
+        while True:
+            evaluated = await self._collect(inbound, self.act_batch_size)
+            if evaluated is None:
+                return
+            batch = ActionBatch(self.gmail_client)
+            outcomes = {}
+            for email, rules in evaluated:
+                outcomes[email.id] = self.rule_engine.apply_rules(email, rules, batch=batch)
+                if rules:
+                    self.stats['matched'] += 1
+            if len(batch):
+                await self._in_network(batch.flush)
+            await self._in_database(self._ledger.record,
+                                    {email_id: outcome_of(results) for email_id, results in outcomes.items()},
+                                    batch.read_states)
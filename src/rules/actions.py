@@ -0,0 +1,98 @@
+from typing import Any, Dict, List, Optional, Tuple
+from ..database.models import Email, RuleAction
+from ..gmail.client import GmailClient
+from ..metrics import metrics
+
+UNREAD_LABEL = 'UNREAD'
+
+
+class ActionBatch:
+    """Collects rule actions and applies them with as few batchModify calls as possible.
+
+    Actions are turned into label changes, netted per message (later actions win, as they
+    would with one modify call per action) and messages with the same net add/remove label
+    sets are sent together. The `success` of every queued action result is filled in by
+    flush(), and `read_states` then holds {email id: is_read} for the emails whose read
+    state the flushed actions changed.
+    """
+
+    def __init__(self, gmail_client: GmailClient):
+        self.gmail_client = gmail_client
+        # gmail_id -> list of (operation, label, result) in the order the actions fired
+        self.pending: Dict[str, List[Tuple[str, Optional[str], Dict[str, Any]]]] = {}
+        self.email_ids: Dict[str, int] = {}
+        self.read_states: Dict[int, bool] = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, email: Email, action: RuleAction, result: Dict[str, Any]):
+        """Queue an action for the email; `result['success']` is set when the batch is flushed."""
+        if action.action_type == 'mark_as_read':
+            change = ('remove', UNREAD_LABEL)
+        elif action.action_type == 'mark_as_unread':
+            change = ('add', UNREAD_LABEL)
+        elif action.action_type == 'move_to' and action.value:
+            change = ('move', action.value)
+        else:
+            result['success'] = False
+            metrics.inc('actions_total', action=action.action_type, outcome='failure')
+            return
+        self.pending.setdefault(email.gmail_id, []).append(change + (result,))
+        self.email_ids[email.gmail_id] = email.id
+
+    def _resolve_labels(self) -> Dict[str, Optional[str]]:
+        label_ids = {}
+        for changes in self.pending.values():
+            for operation, label, _ in changes:
+                if operation == 'move' and label not in label_ids:
+                    try:
+                        label_ids[label] = self.gmail_client.get_label_id(label)
+                    except Exception as e:
+                        print(f"Error resolving label {label}: {e}")
+                        label_ids[label] = None
+        return label_ids
+
+    def flush(self) -> Dict[str, bool]:
+        """Send the queued label changes and return the per-message outcome."""
+        label_ids = self._resolve_labels()
+
+        groups: Dict[Tuple[frozenset, frozenset], List[str]] = {}
+        applied: Dict[str, List[Dict[str, Any]]] = {}
+        read_changes: Dict[str, bool] = {}
+        for gmail_id, changes in self.pending.items():
+            add, remove = set(), set()
+            for operation, label, result in changes:
+                if operation == 'move':
+                    label = label_ids[label]
+                    if label is None:
+                        result['success'] = False
+                        metrics.inc('actions_total', action=result.get('action_type'), outcome='failure')
+                        continue
+                    operation = 'add'
+                if operation == 'add':
+                    add.add(label)
+                    remove.discard(label)
+                else:
+                    remove.add(label)
+                    add.discard(label)
+                applied.setdefault(gmail_id, []).append(result)
+            if gmail_id in applied:
+                groups.setdefault((frozenset(add), frozenset(remove)), []).append(gmail_id)
+                if UNREAD_LABEL in add or UNREAD_LABEL in remove:
+                    read_changes[gmail_id] = UNREAD_LABEL in remove
+
+        outcome = {}
+        for (add, remove), gmail_ids in groups.items():
+            outcome.update(self.gmail_client.batch_modify(gmail_ids, sorted(add), sorted(remove)))
+
+        for gmail_id, results in applied.items():
+            for result in results:
+                result['success'] = outcome.get(gmail_id, False)
+                metrics.inc('actions_total', action=result.get('action_type'),
+                            outcome='success' if result['success'] else 'failure')
+        self.read_states = {self.email_ids[gmail_id]: is_read for gmail_id, is_read in read_changes.items()
+                            if outcome.get(gmail_id)}
+        self.pending = {}
+        self.email_ids = {}
+        return outcome
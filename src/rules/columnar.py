@@ -0,0 +1,187 @@
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from ..database.models import Email
+from .compiler import TEXT_PREDICATES, CompiledCondition, CompiledRule, compile_rules
+from .matcher import domain_matches, normalize_domain
+
+# Text predicates answered from the columns; the others are tested email by email
+VECTOR_TEXT_PREDICATES = ('equals', 'not_equals', 'starts_with', 'domain_is')
+
+
+class EmailColumns:
+    """A chunk of emails as NumPy columns, each built the first time a condition reads it.
+
+    received_date-style attributes become datetime64 arrays, is_read a tri-state int8
+    array (1 for True, 0 for False, -1 for anything else, since the compiled test checks
+    identity), and text attributes an array of ids of their lowercased values.
+    """
+
+    def __init__(self, emails: Sequence[Email]):
+        self.emails = emails
+        self._dates: Dict[str, np.ndarray] = {}
+        self._flags: Dict[str, np.ndarray] = {}
+        self._codes: Dict[str, Tuple[np.ndarray, Dict[str, int]]] = {}
+
+    def __len__(self):
+        return len(self.emails)
+
+    def dates(self, attribute: str) -> np.ndarray:
+        column = self._dates.get(attribute)
+        if column is None:
+            column = self._dates[attribute] = np.array(
+                [getattr(email, attribute) for email in self.emails], dtype='datetime64[us]')
+        return column
+
+    def flags(self, attribute: str) -> np.ndarray:
+        column = self._flags.get(attribute)
+        if column is None:
+            values = (getattr(email, attribute) for email in self.emails)
+            column = self._flags[attribute] = np.fromiter(
+                (1 if value is True else 0 if value is False else -1 for value in values),
+                dtype=np.int8, count=len(self.emails))
+        return column
+
+    def codes(self, attribute: str) -> Tuple[np.ndarray, Dict[str, int]]:
+        """Ids of the lowercased values (str() of non-strings, as the text tests compare) and the id map."""
+        column = self._codes.get(attribute)
+        if column is None:
+            ids: Dict[str, int] = {}
+            values = (getattr(email, attribute) for email in self.emails)
+            codes = np.fromiter(
+                (ids.setdefault((value if isinstance(value, str) else str(value)).lower(), len(ids))
+                 for value in values),
+                dtype=np.int64, count=len(self.emails))
+            column = self._codes[attribute] = (codes, ids)
+        return column
+
+
+def _date_mask(columns: EmailColumns, condition: CompiledCondition) -> Optional[np.ndarray]:
+    cutoff = condition.value
+    if cutoff is None or condition.predicate not in ('less_than', 'greater_than'):
+        # The compiled test never matches
+        return np.zeros(len(columns), dtype=bool)
+    if not isinstance(cutoff, datetime) or cutoff.tzinfo is not None:
+        return None
+    dates = columns.dates(condition.attribute)
+    cutoff = np.datetime64(cutoff, 'us')
+    if condition.predicate == 'less_than':
+        return dates > cutoff
+    return dates < cutoff
+
+
+def _flag_mask(columns: EmailColumns, condition: CompiledCondition) -> np.ndarray:
+    flags = columns.flags(condition.attribute)
+    expected = 1 if condition.value == 'true' else 0
+    if condition.predicate == 'equals':
+        return flags == expected
+    return flags != expected
+
+
+def _text_mask(columns: EmailColumns, condition: CompiledCondition) -> np.ndarray:
+    codes, ids = columns.codes(condition.attribute)
+    code = ids.get(condition.value, -1)
+    if condition.predicate == 'equals':
+        return codes == code
+    return codes != code
+
+
+def _value_mask(columns: EmailColumns, condition: CompiledCondition, test) -> np.ndarray:
+    # Tested once per distinct lowercased value, then spread over the chunk by value id
+    codes, ids = columns.codes(condition.attribute)
+    table = np.fromiter((test(value) for value in ids), dtype=bool, count=len(ids))
+    return table[codes]
+
+
+def condition_mask(columns: EmailColumns, condition: CompiledCondition) -> Optional[np.ndarray]:
+    """The condition's result for every email of the chunk, or None if it must be tested per email.
+
+    Mirrors the tests CompiledCondition binds: dates and is_read true/false compare the
+    columns directly, equals/not_equals compare lowercased value ids, starts_with and
+    domain_is are tested once per distinct value, and predicates the compiler does not
+    know never match. contains/not_contains and matches are left to the per-email tests,
+    which share one pattern scan per field.
+    """
+    if condition.field == 'received_date':
+        return _date_mask(columns, condition)
+    if condition.predicate not in TEXT_PREDICATES:
+        return np.zeros(len(columns), dtype=bool)
+    if condition.predicate not in VECTOR_TEXT_PREDICATES:
+        return None
+    if condition.predicate == 'starts_with':
+        return _value_mask(columns, condition, lambda value: value.startswith(condition.value))
+    if condition.predicate == 'domain_is':
+        domain = normalize_domain(condition.value)
+        return _value_mask(columns, condition, lambda value: domain_matches(value, domain))
+    if condition.field == 'is_read' and condition.value in ('true', 'false'):
+        return _flag_mask(columns, condition)
+    return _text_mask(columns, condition)
+
+
+def _combined_test(rule: CompiledRule, conditions: List[CompiledCondition]) -> Callable:
+    tests = tuple(condition.test for condition in conditions)
+    if len(tests) == 1:
+        return tests[0]
+    if rule.predicate == 'all':
+        return lambda email: all(test(email) for test in tests)
+    return lambda email: any(test(email) for test in tests)
+
+
+def match_matrix(emails: Sequence[Email], rules) -> np.ndarray:
+    """A (rules x emails) boolean matrix of which compiled `rules` each email matches.
+
+    Each rule's column conditions are evaluated as masks over the whole chunk and
+    combined with all/any. Only the emails that outcome leaves open (those passing
+    an 'all' rule's masks, or failing an 'any' rule's) go through the rule's remaining
+    conditions, one email at a time and in email order, so each email's fields are
+    scanned for substrings once for all rules.
+    """
+    rules = compile_rules(rules)
+    columns = EmailColumns(emails)
+    matched = np.zeros((len(rules), len(emails)), dtype=bool)
+    pending = np.zeros((len(rules), len(emails)), dtype=bool)
+    remaining: List[Optional[Callable]] = []
+
+    for position, rule in enumerate(rules):
+        remaining.append(None)
+        if not rule.conditions or rule.predicate not in ('all', 'any'):
+            continue
+        masks, scalar = [], []
+        for condition in rule.conditions:
+            mask = condition_mask(columns, condition)
+            if mask is None:
+                scalar.append(condition)
+            else:
+                masks.append(mask)
+
+        if rule.predicate == 'all':
+            decided = np.logical_and.reduce(masks) if masks else np.ones(len(emails), dtype=bool)
+            if scalar:
+                pending[position] = decided
+            else:
+                matched[position] = decided
+        else:
+            decided = np.logical_or.reduce(masks) if masks else np.zeros(len(emails), dtype=bool)
+            matched[position] = decided
+            if scalar:
+                pending[position] = ~decided
+        if scalar:
+            remaining[position] = _combined_test(rule, scalar)
+
+    email_indexes, rule_indexes = np.nonzero(pending.T)
+    for email_index, position in zip(email_indexes.tolist(), rule_indexes.tolist()):
+        if remaining[position](emails[email_index]):
+            matched[position, email_index] = True
+    return matched
+
+
+def matching_rules_batch(emails: Sequence[Email], rules) -> List[List[CompiledRule]]:
+    """For each email of the chunk, the compiled rules it matches in rule order (as RuleEngine.matching_rules)."""
+    rules = compile_rules(rules)
+    results: List[List[CompiledRule]] = [[] for _ in emails]
+    if not emails or not len(rules):
+        return results
+    email_indexes, rule_indexes = np.nonzero(match_matrix(emails, rules).T)
+    for email_index, position in zip(email_indexes.tolist(), rule_indexes.tolist()):
+        results[email_index].append(rules[position])
+    return results
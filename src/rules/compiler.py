@@ -0,0 +1,322 @@
+from datetime import datetime, timedelta
+from operator import attrgetter
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+from ..database.models import Rule, RuleCondition
+from .matcher import (FieldLookup, FieldPatternIndex, PatternIndex, compile_pattern, domain_matches,
+                      normalize_domain)
+from .selectivity import ConditionCounts, order_conditions
+
+# Field mapping from rule field names to model attribute names
+FIELD_MAPPING = {
+    'from': 'from_address',
+    'to': 'to_address',
+    'subject': 'subject',
+    'message': 'message',
+    'received_date': 'received_date',
+    'is_read': 'is_read'
+}
+
+# Condition predicates by the kind of field they apply to; any other predicate never matches
+DATE_PREDICATES = ('less_than', 'greater_than')
+TEXT_PREDICATES = ('contains', 'not_contains', 'equals', 'not_equals', 'starts_with', 'domain_is', 'matches')
+
+
+def resolve_date_value(value: Any, now: datetime) -> Optional[datetime]:
+    """Resolve a received_date rule value (e.g. "7 days", "2 months") against `now`.
+
+    Returns None when the value cannot be parsed, in which case the condition never matches.
+    """
+    try:
+        if isinstance(value, str):
+            amount, unit = value.split()
+            amount = int(amount)
+            if unit.lower() == 'days':
+                return now - timedelta(days=amount)
+            elif unit.lower() == 'months':
+                return now - timedelta(days=amount * 30)
+            else:
+                return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return value
+
+
+def condition_label(condition: RuleCondition) -> str:
+    """How a condition is named in metrics, e.g. "subject contains invoice"."""
+    return f"{condition.field} {condition.predicate} {condition.value}"
+
+
+def _never(email) -> bool:
+    return False
+
+
+def _date_test(get: Callable, predicate: str, cutoff: Optional[datetime]) -> Callable:
+    if cutoff is None:
+        return _never
+    if predicate == 'less_than':
+        # Younger than the cutoff: the email date is more recent than `cutoff`
+        return lambda email: get(email) > cutoff
+    elif predicate == 'greater_than':
+        # Older than the cutoff: the email date is before `cutoff`
+        return lambda email: get(email) < cutoff
+    return _never
+
+
+def _bool_test(get: Callable, predicate: str, expected: bool) -> Optional[Callable]:
+    if predicate == 'equals':
+        return lambda email: get(email) is expected
+    elif predicate == 'not_equals':
+        return lambda email: get(email) is not expected
+    return None
+
+
+def text_of(value: Any) -> str:
+    """A field value as text conditions test it: str() of anything that is not a string."""
+    return value if isinstance(value, str) else str(value)
+
+
+def _text_test(get: Callable, predicate: str, value: str) -> Callable:
+    needle = value.lower()
+
+    def text(email) -> str:
+        return text_of(get(email)).lower()
+
+    if predicate == 'matches':
+        regex = compile_pattern(value)
+        if regex is None:
+            return _never
+        return lambda email: regex.search(text_of(get(email))) is not None
+    elif predicate == 'domain_is':
+        domain = normalize_domain(value)
+        return lambda email: domain_matches(text(email), domain)
+    elif predicate == 'starts_with':
+        return lambda email: text(email).startswith(needle)
+    elif predicate == 'contains':
+        return lambda email: needle in text(email)
+    elif predicate == 'not_contains':
+        return lambda email: needle not in text(email)
+    elif predicate == 'equals':
+        return lambda email: needle == text(email)
+    elif predicate == 'not_equals':
+        return lambda email: needle != text(email)
+    return _never
+
+
+def _lookup_test(lookup: FieldLookup, predicate: str, value: str) -> Tuple[Callable, Optional[int]]:
+    """A test answered from the field's shared lookups, and the id of its value in them."""
+    if predicate == 'equals':
+        value_id = lookup.add_equals(value.lower())
+        return (lambda email: lookup.equals_id(email) == value_id), value_id
+    elif predicate == 'domain_is':
+        domain = normalize_domain(value)
+        if not domain:
+            return _never, None
+        value_id = lookup.add_domain(domain)
+        return (lambda email: value_id in lookup.domain_ids(email)), value_id
+    elif predicate == 'starts_with':
+        value_id = lookup.add_prefix(value.lower())
+        return (lambda email: value_id in lookup.prefix_ids(email)), value_id
+    value_id = lookup.add_pattern(value)
+    if value_id is None:
+        return _never, None
+    return (lambda email: value_id in lookup.pattern_ids(email)), value_id
+
+
+def _indexed_test(index: FieldPatternIndex, predicate: str, value: str) -> Callable:
+    pattern_id = index.add(value.lower())
+    if predicate == 'contains':
+        return lambda email: pattern_id in index.hits(email)
+    return lambda email: pattern_id not in index.hits(email)
+
+
+# Predicates answered from a FieldLookup when rules are compiled as a set
+LOOKUP_PREDICATES = ('equals', 'domain_is', 'starts_with', 'matches')
+# Lookup predicates a RuleDispatch can file rules under
+DISPATCH_PREDICATES = ('equals', 'domain_is')
+
+
+class CompiledCondition:
+    """A rule condition bound to a specialized test callable.
+
+    `key` is (FieldLookup, predicate, value id) for equals and domain_is conditions
+    answered from a lookup, which RuleDispatch files rules under; None otherwise.
+    """
+
+    __slots__ = ('condition', 'field', 'attribute', 'predicate', 'value', 'test', 'label', 'key')
+
+    def __init__(self, condition: RuleCondition, now: datetime, patterns: Optional[PatternIndex] = None):
+        self.condition = condition
+        self.label = condition_label(condition)
+        self.field = condition.field
+        self.attribute = FIELD_MAPPING.get(condition.field, condition.field)
+        self.predicate = condition.predicate
+        self.key = None
+        get = attrgetter(self.attribute)
+
+        if condition.field == 'received_date':
+            self.value = resolve_date_value(condition.value, now)
+            self.test = _date_test(get, self.predicate, self.value)
+            return
+
+        # Regular expressions keep their case: lowercasing would change escapes such as \S
+        self.value = condition.value if self.predicate == 'matches' else condition.value.lower()
+        test = None
+        if condition.field == 'is_read' and self.value in ('true', 'false'):
+            test = _bool_test(get, self.predicate, self.value == 'true')
+        elif patterns is not None and self.predicate in ('contains', 'not_contains'):
+            # Substring conditions are settled from one shared scan of the field per email
+            test = _indexed_test(patterns.field(self.attribute), self.predicate, condition.value)
+        elif patterns is not None and self.predicate in LOOKUP_PREDICATES:
+            # Values of every rule on the field are looked up together, once per email
+            lookup = patterns.lookup(self.attribute)
+            test, value_id = _lookup_test(lookup, self.predicate, condition.value)
+            if value_id is not None and self.predicate in DISPATCH_PREDICATES:
+                self.key = (lookup, self.predicate, value_id)
+        self.test = test or _text_test(get, self.predicate, condition.value)
+
+    def __call__(self, email) -> bool:
+        return self.test(email)
+
+    def __repr__(self):
+        return f"<CompiledCondition(field='{self.field}', predicate='{self.predicate}')>"
+
+
+class CompiledRule:
+    """A rule whose conditions have been compiled and combined per its predicate.
+
+    The conditions are reordered by estimated cost and selectivity (see
+    selectivity.order_conditions), using the hit-rate `stats` of earlier runs when given.
+    """
+
+    __slots__ = ('rule', 'name', 'predicate', 'conditions', 'actions', 'matches')
+
+    def __init__(self, rule: Rule, now: datetime, patterns: Optional[PatternIndex] = None,
+                 stats: Optional[ConditionCounts] = None):
+        self.rule = rule
+        self.name = rule.name
+        self.predicate = rule.predicate
+        self.conditions = order_conditions(
+            (CompiledCondition(condition, now, patterns) for condition in rule.conditions), rule.predicate, stats
+        )
+        self.actions = list(rule.actions)
+        self.matches = self._bind()
+
+    def _bind(self) -> Callable:
+        tests = tuple(condition.test for condition in self.conditions)
+        if not tests or self.predicate not in ('all', 'any'):
+            return _never
+        if len(tests) == 1:
+            return tests[0]
+        if self.predicate == 'all':
+            return lambda email: all(test(email) for test in tests)
+        return lambda email: any(test(email) for test in tests)
+
+    def __repr__(self):
+        return f"<CompiledRule(name='{self.name}', predicate='{self.predicate}')>"
+
+
+def dispatch_keys(rule: CompiledRule) -> Optional[List[Tuple[FieldLookup, str, int]]]:
+    """Lookup keys at least one of which an email must have for the rule to match, or None.
+
+    An 'all' rule needs any one of its equals/domain_is conditions, so it is filed under the
+    first; an 'any' rule only when every condition is one of them, under all of them.
+    """
+    keys = [condition.key for condition in rule.conditions if condition.key is not None]
+    if not keys:
+        return None
+    if rule.predicate == 'all':
+        return keys[:1]
+    if rule.predicate == 'any' and len(keys) == len(rule.conditions):
+        return keys
+    return None
+
+
+class RuleDispatch:
+    """Finds the few rules an email could match with lookups instead of testing every rule.
+
+    Rules are filed under their dispatch_keys. For an email, each field lookup gives the
+    equals value and sender domains the email has, and only the rules filed under those,
+    plus the rules that could not be filed, are tested. Rule order is kept.
+    """
+
+    def __init__(self, rules: List[CompiledRule]):
+        self.rules = rules
+        filed: Dict[Tuple[FieldLookup, str], Dict[int, List[int]]] = {}
+        unfiled = []
+        for position, rule in enumerate(rules):
+            keys = dispatch_keys(rule)
+            if keys is None:
+                unfiled.append(position)
+                continue
+            for lookup, predicate, value_id in keys:
+                filed.setdefault((lookup, predicate), {}).setdefault(value_id, []).append(position)
+        self.equals = [(lookup, positions) for (lookup, predicate), positions in filed.items() if predicate == 'equals']
+        self.domains = [(lookup, positions) for (lookup, predicate), positions in filed.items()
+                        if predicate == 'domain_is']
+        self.unfiled = unfiled
+        self._unfiled_rules = [rules[position] for position in unfiled]
+
+    def candidates(self, email) -> List[CompiledRule]:
+        """The rules that may match `email`, in rule order."""
+        if not self.equals and not self.domains:
+            return self.rules
+        hits = []
+        for lookup, positions in self.equals:
+            value_id = lookup.equals_id(email)
+            if value_id is not None and value_id in positions:
+                hits.extend(positions[value_id])
+        for lookup, positions in self.domains:
+            for value_id in lookup.domain_ids(email):
+                if value_id in positions:
+                    hits.extend(positions[value_id])
+        if not hits:
+            return self._unfiled_rules
+        rules = self.rules
+        return [rules[position] for position in sorted(set(hits).union(self.unfiled))]
+
+
+class CompiledRuleSet:
+    """Rules compiled once per run against a single run timestamp."""
+
+    def __init__(self, rules: Iterable[Rule], now: Optional[datetime] = None, stats: Optional[ConditionCounts] = None):
+        self.now = now or datetime.utcnow()
+        self.patterns = PatternIndex()
+        self.rules: List[CompiledRule] = [CompiledRule(rule, self.now, self.patterns, stats) for rule in rules]
+        self.patterns.build()
+        self.dispatch = RuleDispatch(self.rules)
+        # Email attributes the rules read, so callers can skip loading the others
+        self.attributes: FrozenSet[str] = frozenset(
+            condition.attribute for rule in self.rules for condition in rule.conditions
+        )
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getitem__(self, index):
+        return self.rules[index]
+
+
+def used_attributes(rules: Iterable) -> FrozenSet[str]:
+    """The Email attributes read by the conditions of `rules`."""
+    rules = compile_rules(rules)
+    if isinstance(rules, CompiledRuleSet):
+        return rules.attributes
+    return frozenset(condition.attribute for rule in rules for condition in rule.conditions)
+
+
+def compile_rules(rules: Iterable[Rule], now: Optional[datetime] = None,
+                  stats: Optional[ConditionCounts] = None) -> Iterable[CompiledRule]:
+    """Compile loaded rules into a CompiledRuleSet; already compiled rules are returned as is.
+
+    `stats` are condition hit counts from selectivity.load_condition_stats, used to order
+    each rule's conditions.
+    """
+    if isinstance(rules, CompiledRuleSet):
+        return rules
+    rules = list(rules)
+    if all(isinstance(rule, CompiledRule) for rule in rules):
+        return rules
+    return CompiledRuleSet(rules, now, stats)
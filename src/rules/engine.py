@@ -1,22 +1,29 @@
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
+import re
+import time
+from datetime import datetime
+from typing import List, Dict, Any, Iterable, Optional, Union
 from ..database.models import Rule, RuleCondition, RuleAction, Email
 from ..gmail.client import GmailClient
+from .actions import ActionBatch
+from ..metrics import metrics
+from .columnar import matching_rules_batch
+from .compiler import (FIELD_MAPPING, CompiledCondition, CompiledRule, CompiledRuleSet, compile_rules,
+                       condition_label, resolve_date_value)
+from .matcher import domain_matches, normalize_domain
+from .selectivity import ConditionCounts
 
 class RuleEngine:
     # Field mapping from rule field names to model attribute names
-    FIELD_MAPPING = {
-        'from': 'from_address',
-        'to': 'to_address',
-        'subject': 'subject',
-        'message': 'message',
-        'received_date': 'received_date',
-        'is_read': 'is_read'
-    }
+    FIELD_MAPPING = FIELD_MAPPING
 
     def __init__(self, gmail_client: GmailClient):
         self.gmail_client = gmail_client
 
+    def compile_rules(self, rules: Iterable[Rule], now: Optional[datetime] = None,
+                      stats: Optional[ConditionCounts] = None) -> CompiledRuleSet:
+        """Compile rules once per run so process_email does not re-interpret them per email."""
+        return compile_rules(rules, now, stats)
+
     def evaluate_condition(self, email: Email, condition: RuleCondition) -> bool:
         """Evaluate a single condition against an email."""
         # Map the field name to the model attribute name
@@ -27,19 +34,8 @@ class RuleEngine:
 
         if condition.field == 'received_date':
             # Handle date comparisons
-            try:
-                if isinstance(value, str):
-                    # Parse relative time (e.g., "7 days", "2 months")
-                    amount, unit = value.split()
-                    amount = int(amount)
-                    if unit.lower() == 'days':
-                        value = datetime.utcnow() - timedelta(days=amount)
-                    elif unit.lower() == 'months':
-                        value = datetime.utcnow() - timedelta(days=amount * 30)
-                    else:
-                        value = datetime.fromisoformat(value)
-
-            except ValueError:
+            value = resolve_date_value(value, datetime.utcnow())
+            if value is None:
                 return False
 
             if predicate == 'less_than':
@@ -53,7 +49,16 @@ class RuleEngine:
             if not isinstance(field_value, str):
                 field_value = str(field_value)
             
-            if predicate == 'contains':
+            if predicate == 'matches':
+                try:
+                    return re.search(value, field_value, re.IGNORECASE) is not None
+                except re.error:
+                    return False
+            elif predicate == 'domain_is':
+                return domain_matches(field_value.lower(), normalize_domain(value))
+            elif predicate == 'starts_with':
+                return field_value.lower().startswith(value.lower())
+            elif predicate == 'contains':
                 return value.lower() in field_value.lower()
             elif predicate == 'not_contains':
                 return value.lower() not in field_value.lower()
@@ -64,9 +69,13 @@ class RuleEngine:
 
         return False
 
-    def evaluate_rule(self, email: Email, rule: Rule) -> bool:
+    def evaluate_rule(self, email: Email, rule: Union[Rule, CompiledRule]) -> bool:
         """Evaluate all conditions of a rule against an email."""
-        
+        if metrics.enabled:
+            return self._evaluate_instrumented(email, rule)
+        if isinstance(rule, CompiledRule):
+            return rule.matches(email)
+
         if not rule.conditions:
             return False
         if rule.predicate == 'all':
@@ -76,8 +85,43 @@ class RuleEngine:
         
         return False
 
+    def _evaluate_instrumented(self, email: Email, rule: Union[Rule, CompiledRule]) -> bool:
+        """evaluate_rule, recording the rule's time and outcome and every condition it tried.
+
+        Conditions are evaluated one by one with the same short-circuiting as all()/any(),
+        so the result is the one evaluate_rule gives with metrics off.
+        """
+        start = time.perf_counter()
+        matched = False
+        if rule.conditions and rule.predicate in ('all', 'any'):
+            # The condition result that settles the rule: a failure for 'all', a match for 'any'
+            decisive = rule.predicate == 'any'
+            matched = not decisive
+            for condition in rule.conditions:
+                if isinstance(condition, CompiledCondition):
+                    result, label = bool(condition.test(email)), condition.label
+                else:
+                    result, label = self.evaluate_condition(email, condition), condition_label(condition)
+                metrics.inc('condition_evaluations_total', rule=rule.name, condition=label)
+                if not result:
+                    metrics.inc('condition_rejections_total', rule=rule.name, condition=label)
+                if result == decisive:
+                    matched = decisive
+                    break
+        metrics.inc('rule_evaluations_total', rule=rule.name)
+        if matched:
+            metrics.inc('rule_matches_total', rule=rule.name)
+        metrics.inc('rule_evaluation_seconds_total', time.perf_counter() - start, rule=rule.name)
+        return matched
+
     def execute_action(self, email: Email, action: RuleAction) -> bool:
         """Execute a single action on an email."""
+        with metrics.time('action_latency_seconds', action=action.action_type):
+            success = self._run_action(email, action)
+        metrics.inc('actions_total', action=action.action_type, outcome='success' if success else 'failure')
+        return success
+
+    def _run_action(self, email: Email, action: RuleAction) -> bool:
         try:
             if action.action_type == 'mark_as_read':
                 return self.gmail_client.mark_as_read(email.gmail_id)
@@ -90,24 +134,61 @@ class RuleEngine:
             print(f"Error executing action {action.action_type}: {e}")
             return False
 
-    def process_email(self, email: Email, rules: List[Rule]) -> List[Dict[str, Any]]:
-        """Process an email against all rules and return the results."""
+    def matching_rules(self, email: Email,
+                       rules: Union[List[Rule], CompiledRuleSet]) -> List[Union[Rule, CompiledRule]]:
+        """Return the rules the email matches, in rule order.
+
+        Plain Rules are interpreted as they are; callers evaluating many emails compile
+        them once with compile_rules and pass the result.
+        """
+        if metrics.enabled:
+            return [rule for rule in rules if self._evaluate_instrumented(email, rule)]
+        # Checked once per email rather than per rule, so disabled metrics cost nothing here
+        if isinstance(rules, CompiledRuleSet):
+            # Only the rules filed under the email's sender, recipient etc. (and unfiled ones) can match
+            return [rule for rule in rules.dispatch.candidates(email) if rule.matches(email)]
+        return [rule for rule in rules if self.evaluate_rule(email, rule)]
+
+    def matching_rules_batch(self, emails: List[Email],
+                             rules: Union[List[Rule], CompiledRuleSet]) -> List[List[CompiledRule]]:
+        """matching_rules for a chunk of emails, evaluating column conditions as NumPy masks (see rules.columnar)."""
+        if metrics.enabled:
+            # Condition metrics count each condition an email is tested with, so go email by email
+            rules = compile_rules(rules)
+            return [self.matching_rules(email, rules) for email in emails]
+        return matching_rules_batch(emails, rules)
+
+    def apply_rules(self, email: Email, rules: Iterable[Union[Rule, CompiledRule]],
+                    batch: Optional[ActionBatch] = None) -> List[Dict[str, Any]]:
+        """Run (or queue on `batch`) the actions of rules the email is known to match."""
         results = []
         
         for rule in rules:
-            if self.evaluate_rule(email, rule):
-                action_results = []
-                for action in rule.actions:
-                    success = self.execute_action(email, action)
-                    action_results.append({
-                        'action_type': action.action_type,
-                        'value': action.value,
-                        'success': success
-                    })
-                
-                results.append({
-                    'rule_name': rule.name,
-                    'actions': action_results
-                })
+            action_results = []
+            for action in rule.actions:
+                action_result = {
+                    'action_type': action.action_type,
+                    'value': action.value,
+                    'success': None
+                }
+                if batch is not None:
+                    batch.add(email, action, action_result)
+                else:
+                    action_result['success'] = self.execute_action(email, action)
+                action_results.append(action_result)
+            
+            results.append({
+                'rule_name': rule.name,
+                'actions': action_results
+            })
         
-        return results 
\ No newline at end of file
+        return results
+
+    def process_email(self, email: Email, rules: Union[List[Rule], CompiledRuleSet],
+                      batch: Optional[ActionBatch] = None) -> List[Dict[str, Any]]:
+        """Process an email against all rules and return the results.
+
+        When a batch is given, actions are queued on it instead of being executed, and
+        each action's 'success' is filled in once the batch is flushed.
+        """
+        return self.apply_rules(email, self.matching_rules(email, rules), batch)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import bindparam, exists, not_, or_, update
+from sqlalchemy.orm import Session
+from ..database.ingest import dialect_insert
+from ..database.models import Email, ProcessedEmail
+from .parser import RuleParser
+
+# Outcomes that mean the email does not need to be processed again by the same rule set
+SETTLED_OUTCOMES = ('matched', 'no_match')
+
+
+def rules_fingerprint(rules: Iterable) -> str:
+    """Hash of the normalized rules; changes whenever a rule, condition or action changes."""
+    normalized = [RuleParser.rule_to_dict(rule) for rule in rules]
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def outcome_of(results: List[Dict[str, Any]]) -> str:
+    """Classify the result list returned by RuleEngine.process_email."""
+    if not results:
+        return 'no_match'
+    if all(action['success'] for result in results for action in result['actions']):
+        return 'matched'
+    return 'failed'
+
+
+class ProcessingLedger:
+    """Records which emails the current rule set has already handled.
+
+    An email is skipped while it has a settled outcome for this rule set's fingerprint that
+    is newer than the email's last update. 'no_match' is not trusted when a rule matches
+    emails older than some age, since those start matching as time passes. Failed emails
+    are always retried.
+    """
+
+    def __init__(self, db: Session, rules: Iterable):
+        rules = list(rules)
+        self.db = db
+        self.fingerprint = rules_fingerprint(rules)
+        self.trust_no_match = not any(
+            condition.field == 'received_date' and condition.predicate == 'greater_than'
+            for rule in rules for condition in getattr(rule, 'rule', rule).conditions
+        )
+
+    def pending_filter(self):
+        """Filter keeping only emails this rule set still has to process."""
+        outcomes = SETTLED_OUTCOMES if self.trust_no_match else ('matched',)
+        settled = exists().where(
+            ProcessedEmail.email_id == Email.id,
+            ProcessedEmail.fingerprint == self.fingerprint,
+            ProcessedEmail.outcome.in_(outcomes),
+            or_(Email.updated_at.is_(None), ProcessedEmail.processed_at >= Email.updated_at)
+        )
+        return not_(settled)
+
+    def record(self, outcomes: Dict[int, str], read_states: Optional[Dict[int, bool]] = None):
+        """Store {email id: outcome} for this rule set and commit.
+
+        `read_states` is {email id: is_read} as the actions left the emails (see
+        ActionBatch.read_states). It is stored on the emails first, so the change does not
+        look like an outside update when sync brings it back.
+        """
+        if read_states:
+            emails = Email.__table__
+            self.db.execute(
+                update(emails).where(emails.c.id == bindparam('email_id')).values(is_read=bindparam('is_read')),
+                [{'email_id': email_id, 'is_read': is_read} for email_id, is_read in read_states.items()]
+            )
+        if not outcomes:
+            self.db.commit()
+            return
+        # Stamped when the outcome is stored, so updates made earlier in the run are settled too
+        processed_at = datetime.utcnow()
+        rows = [
+            {'email_id': email_id, 'fingerprint': self.fingerprint, 'outcome': outcome,
+             'processed_at': processed_at}
+            for email_id, outcome in outcomes.items()
+        ]
+        statement = dialect_insert(self.db, ProcessedEmail.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=['email_id', 'fingerprint'],
+            set_={'outcome': statement.excluded.outcome, 'processed_at': statement.excluded.processed_at}
+        )
+        self.db.execute(statement, rows)
+        self.db.commit()
+
+    def prune(self) -> int:
+        """Drop entries of other rule sets and of emails that no longer exist."""
+        orphaned = ~exists().where(Email.id == ProcessedEmail.email_id)
+        deleted = self.db.query(ProcessedEmail).filter(
+            or_(ProcessedEmail.fingerprint != self.fingerprint, orphaned)
+        ).delete(synchronize_session=False)
+        self.db.commit()
+        return deleted
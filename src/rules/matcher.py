@@ -0,0 +1,280 @@
+import re
+from operator import attrgetter
+from typing import Dict, FrozenSet, List, Optional, Pattern, Tuple
+
+# Below this many distinct patterns, per-pattern `in` searches (which run in C) beat
+# walking the automaton character by character in Python.
+AUTOMATON_THRESHOLD = 256
+# Constructs whose meaning depends on the pattern's own group numbering or flags; such
+# patterns cannot be put inside a combined alternation
+_NOT_COMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+def sender_domain(text: str) -> str:
+    """The domain of the address in a lowercased field, e.g. 'shop <sales@mail.shop.com>' -> 'mail.shop.com'."""
+    at = text.rfind('@')
+    if at < 0:
+        return ''
+    domain = text[at + 1:]
+    end = domain.find('>')
+    if end >= 0:
+        domain = domain[:end]
+    return domain.strip()
+
+
+def domain_suffixes(domain: str) -> List[str]:
+    """A domain and every parent domain: 'mail.shop.com' -> ['mail.shop.com', 'shop.com', 'com']."""
+    if not domain:
+        return []
+    return [domain] + [domain[index + 1:] for index, char in enumerate(domain) if char == '.']
+
+
+def normalize_domain(value: str) -> str:
+    """A domain_is rule value as it is compared: lowercased, without a leading '@'."""
+    return value.strip().lower().lstrip('@')
+
+
+def domain_matches(text: str, domain: str) -> bool:
+    """Whether the address in lowercased `text` is in `domain` (a normalize_domain value) or a subdomain of it."""
+    return bool(domain) and domain in domain_suffixes(sender_domain(text))
+
+
+def compile_pattern(pattern: str) -> Optional[Pattern]:
+    """A 'matches' rule value as a case-insensitive regular expression, or None if it is invalid."""
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        print(f"Warning: Invalid regular expression '{pattern}' never matches: {e}")
+        return None
+
+
+class PatternAutomaton:
+    """Aho-Corasick automaton reporting every pattern id that occurs in a text."""
+
+    def __init__(self, patterns: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.outputs: List[FrozenSet[int]] = [frozenset()]
+        fail = [0]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.outputs.append(frozenset())
+                    fail.append(0)
+                state = next_state
+            self.outputs[state] = self.outputs[state] | {pattern_id}
+
+        # Breadth-first pass computing failure links and merging their outputs
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                link = fail[state]
+                while link and char not in self.goto[link]:
+                    link = fail[link]
+                target = self.goto[link].get(char, 0)
+                fail[next_state] = target if target != next_state else 0
+                self.outputs[next_state] = self.outputs[next_state] | self.outputs[fail[next_state]]
+        self.fail = fail
+
+    def scan(self, text: str) -> FrozenSet[int]:
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return frozenset(found)
+
+
+class FieldPatternIndex:
+    """All `contains`/`not_contains` patterns of one email field, matched in a single pass.
+
+    Patterns are deduplicated across rules, the field is lowercased once per email and
+    the set of matching pattern ids is reused by every condition on that field.
+    """
+
+    def __init__(self, attribute: str):
+        self.attribute = attribute
+        self.get = attrgetter(attribute)
+        self.patterns: Dict[str, int] = {}
+        self.automaton = None
+        self._empty = frozenset()
+        self._pairs = []
+        self._last = (object(), frozenset())
+
+    def add(self, pattern: str) -> int:
+        """Register a pattern (already lowercased) and return its id."""
+        return self.patterns.setdefault(pattern, len(self.patterns))
+
+    def build(self):
+        ordered = sorted(self.patterns, key=self.patterns.get)
+        self._empty = frozenset(pid for pattern, pid in self.patterns.items() if not pattern)
+        self._pairs = [(pattern, pid) for pattern, pid in self.patterns.items() if pattern]
+        if len(self._pairs) >= AUTOMATON_THRESHOLD:
+            automaton = PatternAutomaton([pattern for pattern in ordered if pattern])
+            ids = [self.patterns[pattern] for pattern in ordered if pattern]
+            self.automaton = (automaton, ids)
+        self._last = (object(), frozenset())
+
+    def scan(self, text: str) -> FrozenSet[int]:
+        """Return the ids of every pattern that occurs in the lowercased `text`."""
+        if self.automaton is not None:
+            automaton, ids = self.automaton
+            found = {ids[index] for index in automaton.scan(text)}
+        else:
+            found = {pid for pattern, pid in self._pairs if pattern in text}
+        return self._empty | found
+
+    def hits(self, email) -> FrozenSet[int]:
+        """Pattern ids found in this email's field, scanning each field value only once."""
+        value = self.get(email)
+        last_value, last_hits = self._last
+        if last_value is value:
+            return last_hits
+        text = value if isinstance(value, str) else str(value)
+        found = self.scan(text.lower())
+        self._last = (value, found)
+        return found
+
+
+class FieldLookup:
+    """The equals, starts_with, domain_is and matches values of one email field, found with lookups.
+
+    The field is read and lowercased once per email and matched against the values of
+    every rule at once: equals with a dict lookup of the whole value, domain_is with a
+    lookup of each suffix of the sender domain, starts_with with one lookup per distinct
+    value length. Regular expressions are first tried as one combined alternation, so an
+    email none of them matches costs a single search. Results are kept for the email
+    being evaluated, so every rule on the field reuses them.
+    """
+
+    def __init__(self, attribute: str):
+        self.attribute = attribute
+        self.get = attrgetter(attribute)
+        self.equals: Dict[str, int] = {}
+        self.domains: Dict[str, int] = {}
+        self.prefixes: Dict[str, int] = {}
+        self.patterns: Dict[str, int] = {}
+        self._regexes: List[Tuple[int, Pattern]] = []
+        self._prefix_lengths: Tuple[int, ...] = ()
+        self._combined: Optional[Pattern] = None
+        self._combined_regexes: List[Tuple[int, Pattern]] = []
+        self._separate_regexes: List[Tuple[int, Pattern]] = []
+        self._last = (object(), '', '', {})
+
+    def add_equals(self, value: str) -> int:
+        """Register a lowercased equals value and return its id."""
+        return self.equals.setdefault(value, len(self.equals))
+
+    def add_domain(self, domain: str) -> int:
+        """Register a normalize_domain value and return its id."""
+        return self.domains.setdefault(domain, len(self.domains))
+
+    def add_prefix(self, prefix: str) -> int:
+        """Register a lowercased starts_with value and return its id."""
+        return self.prefixes.setdefault(prefix, len(self.prefixes))
+
+    def add_pattern(self, pattern: str) -> Optional[int]:
+        """Register a regular expression and return its id, or None if it does not compile."""
+        if pattern in self.patterns:
+            return self.patterns[pattern]
+        regex = compile_pattern(pattern)
+        if regex is None:
+            return None
+        pattern_id = self.patterns[pattern] = len(self.patterns)
+        self._regexes.append((pattern_id, regex))
+        return pattern_id
+
+    def build(self):
+        self._prefix_lengths = tuple(sorted({len(prefix) for prefix in self.prefixes}))
+        combinable = [(pid, regex) for pid, regex in self._regexes if not _NOT_COMBINABLE.search(regex.pattern)]
+        combined_ids = {pid for pid, _ in combinable}
+        self._separate_regexes = [(pid, regex) for pid, regex in self._regexes if pid not in combined_ids]
+        self._combined, self._combined_regexes = None, combinable
+        if len(combinable) > 1:
+            try:
+                self._combined = re.compile('|'.join(f'(?:{regex.pattern})' for _, regex in combinable),
+                                            re.IGNORECASE)
+            except re.error:
+                # e.g. the same group name in two patterns; every pattern is then searched
+                self._combined = None
+        self._last = (object(), '', '', {})
+
+    def _current(self, email) -> Tuple[object, str, str, Dict[str, object]]:
+        value = self.get(email)
+        last = self._last
+        if last[0] is value:
+            return last
+        text = value if isinstance(value, str) else str(value)
+        # One tuple, replaced whole, so threads sharing the rule set never see a mix of two emails
+        last = self._last = (value, text, text.lower(), {})
+        return last
+
+    def equals_id(self, email) -> Optional[int]:
+        """Id of the equals value this email's field has, if any."""
+        _, _, lower, found = self._current(email)
+        if 'equals' not in found:
+            found['equals'] = self.equals.get(lower)
+        return found['equals']
+
+    def domain_ids(self, email) -> FrozenSet[int]:
+        """Ids of the domain_is values the field's address is in."""
+        _, _, lower, found = self._current(email)
+        if 'domains' not in found:
+            domains = self.domains
+            found['domains'] = frozenset(domains[suffix] for suffix in domain_suffixes(sender_domain(lower))
+                                         if suffix in domains)
+        return found['domains']
+
+    def prefix_ids(self, email) -> FrozenSet[int]:
+        """Ids of the starts_with values the field starts with."""
+        _, _, lower, found = self._current(email)
+        if 'prefixes' not in found:
+            prefixes = self.prefixes
+            found['prefixes'] = frozenset(prefixes[lower[:length]] for length in self._prefix_lengths
+                                          if length <= len(lower) and lower[:length] in prefixes)
+        return found['prefixes']
+
+    def pattern_ids(self, email) -> FrozenSet[int]:
+        """Ids of the regular expressions found in the field."""
+        _, text, _, found = self._current(email)
+        if 'patterns' not in found:
+            matched = {pid for pid, regex in self._separate_regexes if regex.search(text)}
+            if self._combined is None or self._combined.search(text):
+                matched.update(pid for pid, regex in self._combined_regexes if regex.search(text))
+            found['patterns'] = frozenset(matched)
+        return found['patterns']
+
+
+class PatternIndex:
+    """Per-field substring indexes and value lookups shared by every rule in a compiled rule set."""
+
+    def __init__(self):
+        self.fields: Dict[str, FieldPatternIndex] = {}
+        self.lookups: Dict[str, FieldLookup] = {}
+
+    def field(self, attribute: str) -> FieldPatternIndex:
+        index = self.fields.get(attribute)
+        if index is None:
+            index = self.fields[attribute] = FieldPatternIndex(attribute)
+        return index
+
+    def lookup(self, attribute: str) -> FieldLookup:
+        lookup = self.lookups.get(attribute)
+        if lookup is None:
+            lookup = self.lookups[attribute] = FieldLookup(attribute)
+        return lookup
+
+    def build(self):
+        for index in self.fields.values():
+            index.build()
+        for lookup in self.lookups.values():
+            lookup.build()
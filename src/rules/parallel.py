@@ -0,0 +1,87 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session, sessionmaker
+from ..database.models import Email
+from ..database.sqlite import create_database_engine
+from ..database.streaming import iter_email_chunks
+from ..metrics import metrics
+from .compiler import CompiledRule, compile_rules
+from .engine import RuleEngine
+from .parser import RuleParser
+from .selectivity import load_condition_stats
+from .sql import candidate_filters, email_load_options
+
+# Email ids per shard; several shards per worker keep the workers evenly loaded
+SHARD_SIZE = 20000
+
+# Per-process state set up by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(database_url: str, rules_data: List[Dict[str, Any]], now: datetime, reprocess: bool,
+                 record_metrics: bool):
+    metrics.enabled = record_metrics
+    engine = create_database_engine(database_url)
+    _worker['session_factory'] = sessionmaker(bind=engine)
+    db = _worker['session_factory']()
+    try:
+        stats = load_condition_stats(db)
+    finally:
+        db.close()
+    _worker['rules'] = compile_rules([RuleParser.rule_from_dict(data) for data in rules_data], now, stats)
+    _worker['reprocess'] = reprocess
+
+
+def _evaluate_shard(first_id: int, last_id: int) -> Tuple[List[Tuple[int, str, List[int]]], Dict]:
+    """Evaluate the candidates with first_id <= id <= last_id in a worker process.
+
+    Returns (email id, gmail id, positions of the matching rules) for every candidate,
+    and the rule metrics the shard recorded.
+    """
+    rules = _worker['rules']
+    engine = RuleEngine(gmail_client=None)
+    positions = {id(rule): position for position, rule in enumerate(rules)}
+    db = _worker['session_factory']()
+    try:
+        filters = [Email.id >= first_id, Email.id <= last_id] + candidate_filters(db, rules, _worker['reprocess'])
+        results = []
+        for chunk in iter_email_chunks(db, filters, options=email_load_options(rules)):
+            for email, matched in zip(chunk, engine.matching_rules_batch(chunk, rules)):
+                results.append((email.id, email.gmail_id, [positions[id(rule)] for rule in matched]))
+        return results, metrics.take_counters()
+    finally:
+        db.close()
+
+
+def evaluate_in_parallel(db: Session, rules, workers: int, reprocess: bool = False,
+                         shard_size: int = SHARD_SIZE) -> Iterator[List[Tuple[Email, List[CompiledRule]]]]:
+    """Evaluate the candidate emails in `workers` processes, one id-range shard at a time.
+
+    Each worker opens its own connection to the session's database and compiles its own
+    copy of the rules against the same run timestamp. For every finished shard this
+    yields (email, matching compiled rules) pairs, where the email is a transient Email
+    carrying only its id and gmail_id: enough to queue actions and record the outcome
+    in the parent, which keeps the Gmail side batched and quota-limited.
+    """
+    rules = compile_rules(rules, getattr(rules, 'now', None))
+    now = getattr(rules, 'now', None) or datetime.utcnow()
+    first_id, last_id = db.query(func.min(Email.id), func.max(Email.id)).one()
+    if first_id is None:
+        return
+    database_url = db.get_bind().url.render_as_string(hide_password=False)
+    rules_data = [RuleParser.rule_to_dict(rule) for rule in rules]
+
+    # Workers are spawned rather than forked so they never share the parent's connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(database_url, rules_data, now, reprocess, metrics.enabled)) as executor:
+        shards = [executor.submit(_evaluate_shard, start, min(start + shard_size - 1, last_id))
+                  for start in range(first_id, last_id + 1, shard_size)]
+        for shard in as_completed(shards):
+            results, counters = shard.result()
+            metrics.merge_counters(counters)
+            yield [(Email(id=email_id, gmail_id=gmail_id), [rules[position] for position in positions])
+                   for email_id, gmail_id, positions in results]
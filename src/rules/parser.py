@@ -1,12 +1,96 @@
 # src/rules/parser.py
+import hashlib
 import json
 import os
+import re
+from src.database.meta import get_meta, set_meta
 from src.database.models import Rule, RuleCondition, RuleAction
+from src.rules.compiler import DATE_PREDICATES, TEXT_PREDICATES
 from sqlalchemy.orm import joinedload
 
+# Meta table key holding the hash of the rules file last loaded into the database
+RULES_HASH_KEY = 'rules_hash'
+
+
+class CachedCondition:
+    __slots__ = ('field', 'predicate', 'value')
+
+    def __init__(self, field, predicate, value):
+        self.field = field
+        self.predicate = predicate
+        self.value = value
+
+
+class CachedAction:
+    __slots__ = ('action_type', 'value')
+
+    def __init__(self, action_type, value=None):
+        self.action_type = action_type
+        self.value = value
+
+
+class CachedRule:
+    """A rule read back from the rule cache.
+
+    Has the attributes the engine, compiler and ledger read from a Rule, without the ORM
+    instrumentation that makes building hundreds of transient Rules slow. Like a detached
+    rule it belongs to no session, so it can be shared between threads. Built by
+    RuleParser.rule_from_dict.
+    """
+
+    __slots__ = ('name', 'priority', 'predicate', 'conditions', 'actions')
+
+    def __init__(self, name, priority=0, predicate='all'):
+        self.name = name
+        self.priority = priority
+        self.predicate = predicate
+        self.conditions = []
+        self.actions = []
+
+    def __repr__(self):
+        return f"<CachedRule(name='{self.name}')>"
+
+
 class RuleParser:
-    def __init__(self, rules_file):
+    def __init__(self, rules_file, cache_file=None):
         self.rules_file = rules_file
+        # Parsed copy of the database's rules, next to the rules file by default
+        self.cache_file = cache_file or os.path.join(os.path.dirname(rules_file), '.rules_cache.json')
+
+    @staticmethod
+    def rule_to_dict(rule):
+        """Serializes a rule (ORM or compiled) into the rules.json format."""
+        rule = getattr(rule, 'rule', rule)
+        return {
+            'name': rule.name,
+            'priority': rule.priority or 0,
+            'predicate': rule.predicate,
+            'conditions': [
+                {'field': c.field, 'predicate': c.predicate, 'value': c.value}
+                for c in rule.conditions
+            ],
+            'actions': [
+                {'type': a.action_type, 'value': a.value}
+                for a in rule.actions
+            ]
+        }
+
+    @staticmethod
+    def rule_from_dict(data, rule_class=Rule, condition_class=RuleCondition, action_class=RuleAction):
+        """Builds a transient Rule from the rule_to_dict format (e.g. to ship rules to another process).
+
+        The classes default to the ORM models; the rule cache passes the Cached* ones.
+        """
+        rule = rule_class(name=data['name'], priority=data.get('priority', 0), predicate=data.get('predicate', 'all'))
+        rule.conditions = [
+            condition_class(field=c['field'], predicate=c['predicate'], value=c['value'])
+            for c in data.get('conditions', [])
+        ]
+        rule.actions = [
+            action_class(action_type=a['type'], value=a.get('value'))
+            for a in data.get('actions', [])
+        ]
+        return rule
 
     def get_rules_from_db(self, db):
         """Fetches rules from the database, eagerly loading their conditions and actions."""
@@ -15,78 +99,168 @@ class RuleParser:
             joinedload(Rule.actions)
         ).all()
 
+    def file_hash(self):
+        """SHA-256 of the rules file's bytes, or None if it does not exist."""
+        try:
+            with open(self.rules_file, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def load_rules(self, db):
+        """Returns the rules to run, reloading the JSON file into the database only if it changed.
+
+        The file's hash is stored in the meta table when it is loaded. While the file and
+        database agree, rules come from the on-disk cache (or the database if the cache is
+        stale) without parsing the JSON again.
+        """
+        digest = self.file_hash()
+        if digest is None:
+            print(f"Error: Rule file not found at {self.rules_file}")
+            return self.get_rules_from_db(db)
+
+        if get_meta(db, RULES_HASH_KEY) != digest:
+            print("Rule file changed, updating rules in the database...")
+            self.save_rules_to_db(db)
+            rules = self.get_rules_from_db(db)
+            self._write_cache(db, digest, rules)
+            return rules
+
+        rules = self._read_cache(db, digest)
+        if rules is None:
+            rules = self.get_rules_from_db(db)
+            self._write_cache(db, digest, rules)
+        return rules
+
+    def _cache_key(self, db, digest):
+        # A cache written for another database (e.g. a reset one) must not be reused
+        return {'hash': digest, 'database': db.get_bind().url.render_as_string(hide_password=True)}
+
+    def _read_cache(self, db, digest):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cache.get('key') != self._cache_key(db, digest):
+            return None
+        return [self.rule_from_dict(data, CachedRule, CachedCondition, CachedAction)
+                for data in cache.get('rules', [])]
+
+    def _write_cache(self, db, digest, rules):
+        cache = {'key': self._cache_key(db, digest), 'rules': [self.rule_to_dict(rule) for rule in rules]}
+        try:
+            # Written under a temporary name first so a concurrent run never reads half a file
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError as e:
+            print(f"Warning: Could not write the rule cache {self.cache_file}: {e}")
+
+    @staticmethod
+    def _check_condition(rule_name, cond_data):
+        """Warn about a condition that can never match. It is kept, so an 'all' rule does not widen."""
+        predicates = DATE_PREDICATES if cond_data['field'] == 'received_date' else TEXT_PREDICATES
+        if cond_data['predicate'] not in predicates:
+            print(f"Warning: Unknown predicate in rule '{rule_name}', the condition never matches: {cond_data}")
+        elif cond_data['predicate'] == 'matches':
+            try:
+                re.compile(cond_data['value'])
+            except re.error as e:
+                print(f"Warning: Invalid regular expression in rule '{rule_name}', the condition never matches: "
+                      f"{cond_data} ({e})")
+
+    @staticmethod
+    def _normalize(rule_name, rule_data):
+        """The rule_to_dict form of a rule's JSON entry, dropping malformed conditions and actions."""
+        conditions = []
+        for cond_data in rule_data.get('conditions', []):
+            if cond_data.get('field') and cond_data.get('predicate') and cond_data.get('value') is not None:
+                RuleParser._check_condition(rule_name, cond_data)
+                conditions.append({'field': cond_data['field'], 'predicate': cond_data['predicate'],
+                                   'value': cond_data['value']})
+            else:
+                print(f"Warning: Skipping malformed condition for rule '{rule_name}': {cond_data}")
+        actions = []
+        for action_data in rule_data.get('actions', []):
+            if action_data.get('type'):
+                actions.append({'type': action_data['type'], 'value': action_data.get('value')})
+            else:
+                print(f"Warning: Skipping malformed action for rule '{rule_name}': {action_data}")
+        return {
+            'name': rule_name,
+            'priority': rule_data.get('priority') or 0,
+            'predicate': rule_data.get('predicate', 'all'),  # Default to 'all' if not specified
+            'conditions': conditions,
+            'actions': actions,
+        }
+
     def save_rules_to_db(self, db):
         """
         Loads rules from the JSON file, saves/updates them in the database,
         and ensures they are bound to the provided session.
+
+        Existing rules are loaded with one query and only those whose name, priority,
+        predicate, conditions or actions differ from the file are rewritten. Rules no
+        longer in the file are deleted. The file's hash is stored with them for load_rules.
         """
-        if not os.path.exists(self.rules_file):
+        digest = self.file_hash()
+        if digest is None:
             print(f"Error: Rule file not found at {self.rules_file}")
             return []
 
         with open(self.rules_file, 'r') as f:
             rules_data = json.load(f)
 
-        saved_rules = []
+        stored = self.get_rules_from_db(db)
+        existing = {rule.name: rule for rule in stored}
+        saved_rules = {}
+        changed = 0
         for rule_data in rules_data.get('rules', []):
             rule_name = rule_data.get('name')
             if not rule_name:
                 print(f"Warning: Rule data missing 'name': {rule_data}")
                 continue
 
-            # Try to find an existing rule by name
-            rule = db.query(Rule).filter_by(name=rule_name).first()
-
-            if rule:
-                # Update existing rule's fields
-                rule.priority = rule_data.get('priority', 0)
-                rule.predicate = rule_data.get('predicate', 'all')  # Default to 'all' if not specified
-                
-                # Clear existing conditions and actions
-                db.query(RuleCondition).filter_by(rule_id=rule.id).delete()
-                db.query(RuleAction).filter_by(rule_id=rule.id).delete()
-                db.refresh(rule)
-            else:
-                # Create a new rule with all required fields
-                rule = Rule(
-                    name=rule_name,
-                    priority=rule_data.get('priority', 0),
-                    predicate=rule_data.get('predicate', 'all')  # Default to 'all' if not specified
-                )
+            wanted = self._normalize(rule_name, rule_data)
+            rule = existing.get(rule_name)
+            if rule is not None and self.rule_to_dict(rule) == wanted:
+                saved_rules[rule_name] = rule
+                continue
+
+            if rule is None:
+                rule = existing[rule_name] = Rule(name=rule_name)
                 db.add(rule)
+            rule.priority = wanted['priority']
+            rule.predicate = wanted['predicate']
+            # Replacing the collections deletes the old conditions and actions (delete-orphan)
+            rule.conditions = [RuleCondition(field=c['field'], predicate=c['predicate'], value=c['value'])
+                               for c in wanted['conditions']]
+            rule.actions = [RuleAction(action_type=a['type'], value=a['value']) for a in wanted['actions']]
+            saved_rules[rule_name] = rule
+            changed += 1
 
-            # Add new conditions for the rule
-            for cond_data in rule_data.get('conditions', []):
-                condition = RuleCondition(
-                    field=cond_data.get('field'),
-                    predicate=cond_data.get('predicate'),
-                    value=cond_data.get('value')
-                )
-                if condition.field and condition.predicate and condition.value is not None:
-                    rule.conditions.append(condition)
-                else:
-                    print(f"Warning: Skipping malformed condition for rule '{rule_name}': {cond_data}")
-
-            # Add new actions for the rule
-            for action_data in rule_data.get('actions', []):
-                action = RuleAction(
-                    action_type=action_data.get('type'),
-                    value=action_data.get('value')
-                )
-                if action.action_type:
-                    rule.actions.append(action)
-                else:
-                    print(f"Warning: Skipping malformed action for rule '{rule_name}': {action_data}")
-
-            saved_rules.append(rule)
+        # Removed from the file (or a duplicate name left by an older version): their
+        # conditions and actions go with them (delete-orphan)
+        kept = {id(rule) for rule in saved_rules.values()}
+        removed = [rule for rule in stored if id(rule) not in kept]
+        for rule in removed:
+            db.delete(rule)
 
+        set_meta(db, RULES_HASH_KEY, digest)
+        # Ids are read before the commit expires the rules, which would reload each one
+        db.flush()
+        rule_ids = [r.id for r in saved_rules.values() if r.id]
         db.commit()
+        if changed:
+            print(f"Updated {changed} of {len(saved_rules)} rules")
+        if removed:
+            print(f"Deleted {len(removed)} rules no longer in {self.rules_file}")
         
         # Re-query rules with eager loading for both conditions and actions
-        rule_ids = [r.id for r in saved_rules if r.id]
         if rule_ids:
             return db.query(Rule).filter(Rule.id.in_(rule_ids)).options(
                 joinedload(Rule.conditions),
                 joinedload(Rule.actions)
             ).all()
-        return []
\ No newline at end of file
+        return []
@@ -0,0 +1,33 @@
+from typing import Iterable, List, Optional
+from ..gmail.client import PARSED_HEADERS
+from .compiler import used_attributes
+
+# Email attributes that can only be filled from a message's body
+BODY_ATTRIBUTES = frozenset({'message'})
+
+
+class FetchPlan:
+    """The users.messages.get format that is enough to evaluate a set of rules.
+
+    Rules that never look at the body only need the headers parse_message reads, so
+    messages are fetched with format='metadata' and stored without a body.
+    """
+
+    __slots__ = ('needs_body', 'format', 'metadata_headers')
+
+    def __init__(self, needs_body: bool):
+        self.needs_body = needs_body
+        self.format = 'full' if needs_body else 'metadata'
+        self.metadata_headers: Optional[List[str]] = None if needs_body else list(PARSED_HEADERS)
+
+    def __repr__(self):
+        return f"<FetchPlan(format='{self.format}')>"
+
+
+# Fetch everything; what callers without rules at hand get
+FULL_FETCH = FetchPlan(needs_body=True)
+
+
+def plan_fetch(rules: Iterable) -> FetchPlan:
+    """Pick the cheapest message format that still serves every field the rules read."""
+    return FetchPlan(needs_body=bool(used_attributes(rules) & BODY_ATTRIBUTES))
@@ -0,0 +1,80 @@
+from typing import List, Tuple
+from sqlalchemy.orm import Session
+from ..database.models import Email
+from ..database.streaming import iter_email_chunks
+from ..gmail.client import GmailClient
+from ..gmail.sync import MailboxSync
+from .actions import ActionBatch
+from .compiler import CompiledRule
+from .engine import RuleEngine
+from .ledger import ProcessingLedger, outcome_of
+from .parallel import evaluate_in_parallel
+from .planner import plan_fetch
+from .sql import candidate_filters, email_load_options
+
+# Number of candidate emails loaded and acted on per chunk (the batchModify limit)
+CHUNK_SIZE = 1000
+
+
+def act_on(rule_engine: RuleEngine, batch: ActionBatch, ledger: ProcessingLedger,
+           evaluated: List[Tuple[Email, List[CompiledRule]]]):
+    """Run the actions for (email, matching rules) pairs as batchModify calls and record the outcomes."""
+    matched = []
+    processed = {}
+    for email, rules in evaluated:
+        results = rule_engine.apply_rules(email, rules, batch=batch)
+        processed[email.id] = results
+        if results:
+            matched.append((email.gmail_id, results))
+    batch.flush()
+    ledger.record({email_id: outcome_of(results) for email_id, results in processed.items()}, batch.read_states)
+
+    for gmail_id, results in matched:
+        print(f"Email {gmail_id} matched rules:")
+        for result in results:
+            print(f"  Rule: {result['rule_name']}")
+            for action in result['actions']:
+                status = "successful" if action['success'] else "failed"
+                print(f"    Action: {action['action_type']} - {status}")
+
+
+def process_stored_emails(gmail_client: GmailClient, db: Session, rules, reprocess: bool = False,
+                          workers: int = 1) -> int:
+    """Apply compiled `rules` to the stored emails of `db`'s mailbox; returns the candidates evaluated.
+
+    Emails already handled by the rule set are skipped unless `reprocess` is set. With
+    `workers` > 1 the rules are evaluated in that many processes, while actions are still
+    sent from this one.
+    """
+    rule_engine = RuleEngine(gmail_client)
+
+    # Emails fetched while no rule read the body were stored without one
+    if plan_fetch(rules).needs_body:
+        filled = MailboxSync(gmail_client, db).fetch_missing_bodies()
+        if filled:
+            print(f"Fetched {filled} message bodies needed by the rules")
+
+    # Let SQLite narrow the table down to emails some rule can match and that the
+    # current rule set has not handled yet
+    ledger = ProcessingLedger(db, rules)
+    batch = ActionBatch(gmail_client)
+    total = 0
+
+    if workers > 1:
+        # Evaluate id-range shards in worker processes and act on each as it finishes
+        for shard in evaluate_in_parallel(db, rules, workers, reprocess=reprocess):
+            total += len(shard)
+            for start in range(0, len(shard), CHUNK_SIZE):
+                act_on(rule_engine, batch, ledger, shard[start:start + CHUNK_SIZE])
+    else:
+        # Stream the candidates in keyset-paginated chunks (bodies only when a rule reads
+        # them), evaluating each chunk column-wise and sending the resulting label changes
+        # as batchModify calls once per chunk
+        filters = candidate_filters(db, rules, reprocess)
+        options = email_load_options(rules)
+        for chunk in iter_email_chunks(db, filters, chunk_size=CHUNK_SIZE, options=options):
+            total += len(chunk)
+            act_on(rule_engine, batch, ledger, list(zip(chunk, rule_engine.matching_rules_batch(chunk, rules))))
+
+    ledger.prune()
+    return total
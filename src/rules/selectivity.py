@@ -0,0 +1,159 @@
+import hashlib
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session, undefer
+from ..database.ingest import dialect_insert
+from ..database.meta import get_meta, set_meta
+from ..database.models import ConditionStat, Email
+
+# Relative cost of testing a condition, by the rule field it reads; bodies are by far the longest
+FIELD_COSTS = {
+    'is_read': 1.0,
+    'received_date': 1.0,
+    'from': 2.0,
+    'to': 2.0,
+    'subject': 3.0,
+    'message': 20.0,
+}
+DEFAULT_FIELD_COST = 3.0
+# How much more than a plain comparison a predicate costs on the same field
+PREDICATE_COST_FACTORS = {
+    'matches': 4.0,
+}
+# Share of emails a condition is assumed to match before any statistics exist, by predicate
+PRIOR_HIT_RATES = {
+    'equals': 0.1,
+    'contains': 0.2,
+    'not_equals': 0.9,
+    'not_contains': 0.8,
+    'less_than': 0.5,
+    'greater_than': 0.5,
+    'starts_with': 0.1,
+    'domain_is': 0.1,
+    'matches': 0.2,
+}
+DEFAULT_HIT_RATE = 0.5
+# Weight of the prior, in evaluations, when blending it with the measured hit rate
+PRIOR_WEIGHT = 10
+# Emails sampled per run to refresh the statistics
+STATS_SAMPLE_SIZE = 1000
+# Statistics of an unchanged set of conditions are sampled again once they are this old
+STATS_MAX_AGE = timedelta(days=1)
+# Meta table key holding the fingerprint of the conditions the statistics were last sampled for
+STATS_CONDITIONS_KEY = 'condition_stats_conditions'
+
+# {condition label: (evaluations, hits)}
+ConditionCounts = Dict[str, Tuple[int, int]]
+
+
+def condition_cost(condition) -> float:
+    return FIELD_COSTS.get(condition.field, DEFAULT_FIELD_COST) * PREDICATE_COST_FACTORS.get(condition.predicate, 1.0)
+
+
+def hit_rate(condition, stats: Optional[ConditionCounts] = None) -> float:
+    """Estimated share of emails `condition` matches: its measured rate, smoothed towards the prior."""
+    prior = PRIOR_HIT_RATES.get(condition.predicate, DEFAULT_HIT_RATE)
+    evaluations, hits = (stats or {}).get(condition.label, (0, 0))
+    return (hits + prior * PRIOR_WEIGHT) / (evaluations + PRIOR_WEIGHT)
+
+
+def order_conditions(conditions: Iterable, predicate: str, stats: Optional[ConditionCounts] = None) -> List:
+    """Order compiled conditions so the rule is settled after as little work as possible.
+
+    An 'all' rule stops at the first condition that fails, so conditions are ranked by cost
+    per chance of failing; an 'any' rule stops at the first match, so by cost per chance of
+    matching. Conditions have no side effects, so the order never changes the result.
+    Ties keep the stored order.
+    """
+    conditions = list(conditions)
+    if predicate == 'all':
+        decisive = lambda condition: 1.0 - hit_rate(condition, stats)
+    elif predicate == 'any':
+        decisive = lambda condition: hit_rate(condition, stats)
+    else:
+        return conditions
+    # The smoothed rates stay strictly between 0 and 1, so there is no division by zero
+    return sorted(conditions, key=lambda condition: condition_cost(condition) / decisive(condition))
+
+
+def load_condition_stats(db: Session) -> ConditionCounts:
+    """The hit counts saved by earlier runs."""
+    return {stat.condition: (stat.evaluations, stat.hits) for stat in db.query(ConditionStat)}
+
+
+def analyze_conditions(db: Session, rules, sample_size: int = STATS_SAMPLE_SIZE) -> ConditionCounts:
+    """Count how many of a random sample of stored emails each compiled condition matches.
+
+    Every condition is evaluated on every sampled email, so the rates do not depend on the
+    order the conditions were run in.
+    """
+    conditions = {}
+    for rule in rules:
+        for condition in rule.conditions:
+            conditions.setdefault(condition.label, condition)
+    first_id, last_id = db.query(func.min(Email.id), func.max(Email.id)).one()
+    if not conditions or first_id is None:
+        return {}
+
+    # Random ids rather than ORDER BY random(), which would read the whole table
+    ids = range(first_id, last_id + 1)
+    sample_ids = random.sample(ids, min(sample_size, len(ids)))
+    query = db.query(Email).filter(Email.id.in_(sample_ids))
+    if any(condition.field == 'message' for condition in conditions.values()):
+        query = query.options(undefer(Email.message))
+    emails = query.all()
+
+    counts = {}
+    for label, condition in conditions.items():
+        counts[label] = (len(emails), sum(bool(condition.test(email)) for email in emails))
+    for email in emails:
+        db.expunge(email)
+    return counts
+
+
+def conditions_fingerprint(rules) -> str:
+    """Hash of the distinct condition labels of compiled `rules`, the only part the statistics depend on."""
+    labels = sorted({condition.label for rule in rules for condition in rule.conditions})
+    return hashlib.sha256('\n'.join(labels).encode()).hexdigest()
+
+
+def refresh_condition_stats(db: Session, rules, max_age: timedelta = STATS_MAX_AGE,
+                            sample_size: int = STATS_SAMPLE_SIZE) -> bool:
+    """Sample and save the statistics of compiled `rules` when they are missing, stale or for other conditions.
+
+    Sampling reads up to `sample_size` emails with their bodies, so runs with the same
+    conditions skip it until the saved counts are older than `max_age`. Returns whether
+    the statistics were sampled.
+    """
+    fingerprint = conditions_fingerprint(rules)
+    labels = {condition.label for rule in rules for condition in rule.conditions}
+    if labels and get_meta(db, STATS_CONDITIONS_KEY) == fingerprint:
+        saved, oldest = (db.query(func.count(ConditionStat.id), func.min(ConditionStat.updated_at))
+                         .filter(ConditionStat.condition.in_(labels)).one())
+        if saved == len(labels) and datetime.utcnow() - oldest < max_age:
+            return False
+    save_condition_stats(db, analyze_conditions(db, rules, sample_size))
+    set_meta(db, STATS_CONDITIONS_KEY, fingerprint)
+    db.commit()
+    return True
+
+
+def save_condition_stats(db: Session, counts: ConditionCounts):
+    """Store the latest counts for the next run, replacing earlier ones, and commit."""
+    if not counts:
+        return
+    now = datetime.utcnow()
+    rows = [{'condition': label, 'evaluations': evaluations, 'hits': hits, 'updated_at': now}
+            for label, (evaluations, hits) in counts.items() if evaluations]
+    if not rows:
+        return
+    statement = dialect_insert(db, ConditionStat.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=['condition'],
+        set_={'evaluations': statement.excluded.evaluations, 'hits': statement.excluded.hits,
+              'updated_at': statement.excluded.updated_at}
+    )
+    db.execute(statement, rows)
+    db.commit()
@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import and_, false, func, or_, true
+from sqlalchemy.orm import Session, undefer
+from sqlalchemy.sql.elements import ColumnElement
+from ..database.fts import FTS_MIN_LENGTH, fts_available, fts_contains
+from ..database.models import Email
+from .compiler import CompiledCondition, CompiledRule, compile_rules, used_attributes
+from .ledger import ProcessingLedger
+from .matcher import normalize_domain
+
+# Python lowercases rule values and str(field) with full Unicode case folding, while
+# SQLite's lower()/LIKE and the trigram index only fold ASCII, so non-ASCII values are
+# left to Python.
+TEXT_COLUMNS = {
+    'from_address': Email.from_address,
+    'to_address': Email.to_address,
+    'subject': Email.subject,
+    'message': Email.message,
+}
+# Columns in the full-text index; 'contains' on them is answered by the index
+FTS_COLUMNS = {'subject', 'message'}
+# Message bodies are stored compressed, so only the index can search them
+COMPRESSED_COLUMNS = {'message'}
+
+
+def _text_filter(column, predicate: str, value: str, fts: bool = False) -> Optional[ColumnElement]:
+    # str(None) is 'none' in the Python evaluator, so NULL columns need their own branch
+    null_text = 'none'
+    indexed = fts and column.key in FTS_COLUMNS and len(value) >= FTS_MIN_LENGTH
+    if column.key in COMPRESSED_COLUMNS and not (indexed and predicate == 'contains' and value.isascii()):
+        return None
+    if predicate == 'contains':
+        if not value.isascii():
+            return None
+        if indexed:
+            clause = fts_contains(column.key, value)
+        else:
+            clause = func.lower(column).contains(value, autoescape=True)
+        return or_(column.is_(None), clause) if value in null_text else clause
+    elif predicate == 'not_contains':
+        clause = ~func.lower(column).contains(value, autoescape=True)
+        return clause if value in null_text else or_(column.is_(None), clause)
+    elif predicate == 'equals':
+        if not value.isascii():
+            return None
+        clause = func.lower(column) == value
+        return or_(column.is_(None), clause) if value == null_text else clause
+    elif predicate == 'not_equals':
+        clause = func.lower(column) != value
+        return clause if value == null_text else or_(column.is_(None), clause)
+    elif predicate == 'starts_with':
+        if not value.isascii():
+            return None
+        clause = func.lower(column).startswith(value, autoescape=True)
+        return or_(column.is_(None), clause) if null_text.startswith(value) else clause
+    elif predicate == 'domain_is':
+        domain = normalize_domain(value)
+        if not domain.isascii():
+            return None
+        if not domain:
+            return false()
+        # Keeps every address in the domain or a subdomain; Python checks where the domain ends
+        return or_(func.lower(column).contains('@' + domain, autoescape=True),
+                   func.lower(column).contains('.' + domain, autoescape=True))
+    elif predicate == 'matches':
+        # Regular expressions are only evaluated in Python
+        return None
+    return false()
+
+
+def condition_filter(condition: CompiledCondition, fts: bool = False) -> Optional[ColumnElement]:
+    """Translate a compiled condition into a filter that keeps every email it could match.
+
+    Returns None when the condition cannot be expressed in SQL; the caller then treats it
+    as unrestricted and leaves the decision to the Python evaluator. With `fts`, 'contains'
+    on subject and message is looked up in the trigram index (see database.fts).
+    """
+    predicate = condition.predicate
+    if condition.field == 'received_date':
+        if condition.value is None:
+            return false()
+        if predicate == 'less_than':
+            return Email.received_date > condition.value
+        elif predicate == 'greater_than':
+            return Email.received_date < condition.value
+        return false()
+
+    if condition.field == 'is_read':
+        if predicate not in ('equals', 'not_equals') or condition.value not in ('true', 'false'):
+            return None
+        expected = condition.value == 'true'
+        if predicate == 'equals':
+            return Email.is_read == expected
+        return or_(Email.is_read.is_(None), Email.is_read != expected)
+
+    column = TEXT_COLUMNS.get(condition.attribute)
+    if column is None:
+        return None
+    return _text_filter(column, predicate, condition.value, fts)
+
+
+def rule_filter(rule: CompiledRule, fts: bool = False) -> ColumnElement:
+    """Combine a rule's condition filters with and_/or_ according to Rule.predicate."""
+    if not rule.conditions or rule.predicate not in ('all', 'any'):
+        return false()
+
+    clauses = [condition_filter(condition, fts) for condition in rule.conditions]
+    if rule.predicate == 'all':
+        clauses = [clause for clause in clauses if clause is not None]
+        return and_(*clauses) if clauses else true()
+    if any(clause is None for clause in clauses):
+        return true()
+    return or_(*clauses)
+
+
+def rules_filter(rules: Iterable, fts: bool = False) -> ColumnElement:
+    """Filter keeping every email at least one of the rules can match."""
+    return or_(false(), *(rule_filter(rule, fts) for rule in compile_rules(rules)))
+
+
+def candidate_filters(db: Session, rules: Iterable, reprocess: bool = False) -> List[ColumnElement]:
+    """Filters selecting the emails a processing run has to evaluate.
+
+    Keeps emails some rule can match and, unless `reprocess` is set, that the rule set
+    has not settled yet according to its ProcessingLedger.
+    """
+    filters = [rules_filter(rules, fts=fts_available(db))]
+    if not reprocess:
+        filters.append(ProcessingLedger(db, rules).pending_filter())
+    return filters
+
+
+def email_load_options(rules: Iterable) -> List:
+    """Query options loading the deferred message body up front when a rule reads it."""
+    if 'message' in used_attributes(rules):
+        return [undefer(Email.message)]
+    return []
+
+
+def candidate_email_ids(db: Session, rule: CompiledRule, extra_filter: Optional[ColumnElement] = None) -> List[int]:
+    """Ids of the emails the rule can match, found by SQLite instead of a Python scan."""
+    query = db.query(Email.id).filter(rule_filter(rule, fts_available(db)))
+    if extra_filter is not None:
+        query = query.filter(extra_filter)
+    return [email_id for email_id, in query]
+
+
+def plan_candidates(db: Session, rules: Iterable,
+                    extra_filter: Optional[ColumnElement] = None) -> Dict[int, List[CompiledRule]]:
+    """Map each candidate email id to the rules (in rule order) that may match it.
+
+    `extra_filter` further restricts the emails considered, e.g. to those a
+    ProcessingLedger still has pending.
+    """
+    plan: Dict[int, List[CompiledRule]] = {}
+    for rule in compile_rules(rules):
+        for email_id in candidate_email_ids(db, rule, extra_filter):
+            plan.setdefault(email_id, []).append(rule)
+    return plan
@@ -0,0 +1,17 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+from src.database.models import Base
+from src.database.sqlite import create_database_engine
+
+@pytest.fixture
+def db_engine(tmp_path):
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def db(db_engine):
+    session = sessionmaker(bind=db_engine)()
+    yield session
+    session.close()
@@ -0,0 +1,94 @@
+import json
+import pytest
+from src.accounts import Account, MultiAccountRunner, load_accounts
+from src.database.models import Email, ProcessedEmail, Rule, RuleAction, RuleCondition
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+
+@pytest.fixture
+def servers():
+    with FakeGmailServer(FakeMailbox(40, seed=1)) as first, FakeGmailServer(FakeMailbox(25, seed=2)) as second:
+        yield first, second
+
+def unread_rule():
+    rule = Rule(name='Read everything unread', predicate='all', priority=0)
+    rule.conditions = [RuleCondition(field='is_read', predicate='equals', value='false')]
+    rule.actions = [RuleAction(action_type='mark_as_read')]
+    return rule
+
+def make_runner(servers, tmp_path, rules=None, **kwargs):
+    accounts = [Account(f'account{index}', database_url=f"sqlite:///{tmp_path / f'account{index}.db'}",
+                        api_endpoint=server.url, max_results=100)
+                for index, server in enumerate(servers)]
+    return MultiAccountRunner(accounts, rules or [unread_rule()], max_workers=2, quota_rate=None, **kwargs)
+
+def test_accounts_file(tmp_path):
+    path = tmp_path / 'accounts.json'
+    path.write_text(json.dumps({'accounts': [
+        {'name': 'work', 'token_file': 'tokens/work.pickle', 'query': 'newer_than:7d', 'max_results': 500},
+        {'name': 'home', 'database_url': 'sqlite:///home.db'},
+    ]}))
+    work, home = load_accounts(str(path))
+    assert (work.token_file, work.query, work.max_results) == ('tokens/work.pickle', 'newer_than:7d', 500)
+    assert work.database_url.endswith('work.db')
+    assert (home.token_file, home.database_url) == ('tokens/home.pickle', 'sqlite:///home.db')
+
+    path.write_text(json.dumps({'accounts': [{'name': 'work'}, {'name': 'work'}]}))
+    with pytest.raises(ValueError):
+        load_accounts(str(path))
+
+def test_each_mailbox_is_synced_and_processed_into_its_own_database(servers, tmp_path):
+    runner = make_runner(servers, tmp_path)
+    try:
+        results = runner.run()
+        for index, server in enumerate(servers):
+            assert results[f'account{index}']['added'] == len(server.mailbox.messages)
+            db = runner.mailboxes[f'account{index}'].session_factory()
+            assert {email.gmail_id for email in db.query(Email)} == set(server.mailbox.messages)
+            assert db.query(ProcessedEmail).count() == results[f'account{index}']['processed']
+            db.close()
+            assert all('UNREAD' not in message['labelIds'] for message in server.mailbox.messages.values())
+
+        # Later rounds reuse every mailbox's client and only pick up what changed
+        clients = {name: mailbox.gmail_client for name, mailbox in runner.mailboxes.items()}
+        marked_read = results['account0']['processed']
+        new = servers[1].mailbox.add_new()
+        results = runner.run()
+        # The history replays the first round's mark_as_read actions
+        assert results['account0'] == {'added': 0, 'deleted': 0, 'relabelled': marked_read, 'processed': 0}
+        assert results['account1']['added'] == 1
+        assert {name: mailbox.gmail_client for name, mailbox in runner.mailboxes.items()} == clients
+        assert clients['account0'].scheduler is not clients['account1'].scheduler
+        assert 'UNREAD' not in servers[1].mailbox.messages[new['id']]['labelIds']
+    finally:
+        runner.close()
+
+def test_a_failing_account_does_not_stop_the_others(servers, tmp_path):
+    runner = make_runner(servers, tmp_path)
+    # Unattended runs never start the browser consent flow for a mailbox without a token
+    runner.accounts.append(Account('broken', token_file=str(tmp_path / 'missing.pickle'),
+                                   database_url=f"sqlite:///{tmp_path / 'broken.db'}"))
+    try:
+        results = runner.run()
+        assert 'missing.pickle' in results['broken']['error']
+        assert results['account0']['added'] == 40 and results['account1']['added'] == 25
+    finally:
+        runner.close()
+
+def test_each_round_compiles_the_rules_and_settles_new_emails(servers, tmp_path):
+    rule = Rule(name='File recent mail', predicate='all', priority=0)
+    rule.conditions = [RuleCondition(field='received_date', predicate='less_than', value='365 days')]
+    rule.actions = [RuleAction(action_type='move_to', value='Filed')]
+    runner = make_runner(servers, tmp_path, rules=[rule])
+    try:
+        runner.run()
+        first_now = runner.rules.now
+        servers[1].mailbox.add_new()
+        results = runner.run()
+        assert runner.rules.now > first_now
+        assert results['account1']['added'] == 1 and results['account1']['processed'] == 1
+        assert results['account0']['processed'] == 0
+        # Neither the email stored after startup nor the labels the rule set are processed again
+        results = runner.run()
+        assert [stats['processed'] for stats in results.values()] == [0, 0]
+    finally:
+        runner.close()
@@ -0,0 +1,92 @@
+import pytest
+from unittest.mock import MagicMock
+from src.database.models import Email, RuleAction
+from src.gmail.client import GmailClient
+from src.rules.actions import ActionBatch
+
+class FakeGmailClient:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def get_label_id(self, label_name):
+        if label_name == "Broken":
+            raise RuntimeError("label create failed")
+        return f"Label_{label_name}"
+
+    def batch_modify(self, msg_ids, add_label_ids=None, remove_label_ids=None):
+        self.calls.append((sorted(msg_ids), add_label_ids, remove_label_ids))
+        return {msg_id: msg_id not in self.failing for msg_id in msg_ids}
+
+def queue(batch, gmail_id, *actions):
+    results = []
+    for action_type, value in actions:
+        result = {'action_type': action_type, 'value': value, 'success': None}
+        batch.add(Email(id=ord(gmail_id), gmail_id=gmail_id), RuleAction(action_type=action_type, value=value), result)
+        results.append(result)
+    return results
+
+def test_messages_with_same_label_delta_share_a_call():
+    client = FakeGmailClient(failing={"c"})
+    batch = ActionBatch(client)
+    a = queue(batch, "a", ("mark_as_read", None), ("move_to", "News"))
+    b = queue(batch, "b", ("move_to", "News"), ("mark_as_read", None))
+    c = queue(batch, "c", ("mark_as_read", None))
+
+    outcome = batch.flush()
+
+    assert sorted(client.calls) == [
+        (["a", "b"], ["Label_News"], ["UNREAD"]),
+        (["c"], [], ["UNREAD"]),
+    ]
+    assert outcome == {"a": True, "b": True, "c": False}
+    assert [r['success'] for r in a + b] == [True] * 4
+    assert c[0]['success'] is False
+    assert len(batch) == 0
+    # The read state of the messages that were modified, by email id
+    assert batch.read_states == {ord("a"): True, ord("b"): True}
+
+def test_later_actions_win_within_a_message():
+    client = FakeGmailClient()
+    batch = ActionBatch(client)
+    queue(batch, "a", ("mark_as_read", None), ("mark_as_unread", None))
+    batch.flush()
+    assert client.calls == [(["a"], ["UNREAD"], [])]
+    assert batch.read_states == {ord("a"): False}
+
+def test_unresolvable_labels_and_unknown_actions_fail_only_themselves():
+    client = FakeGmailClient()
+    batch = ActionBatch(client)
+    results = queue(batch, "a", ("move_to", "Broken"), ("mark_as_read", None), ("archive", None))
+    batch.flush()
+    assert [r['success'] for r in results] == [False, True, False]
+    assert client.calls == [(["a"], [], ["UNREAD"])]
+
+@pytest.fixture
+def gmail_client():
+    return GmailClient(service=MagicMock())
+
+def test_batch_modify_chunks_and_falls_back_per_message(gmail_client, monkeypatch):
+    monkeypatch.setattr("src.gmail.client.BATCH_MODIFY_LIMIT", 2)
+    messages = gmail_client.service.users.return_value.messages.return_value
+    calls = []
+
+    def batch_modify(userId, body):
+        calls.append(body['ids'])
+        request = MagicMock()
+        if 'bad' in body['ids']:
+            request.execute.side_effect = RuntimeError("batch failed")
+        return request
+
+    def modify(userId, id, body):
+        request = MagicMock()
+        if id == 'bad':
+            request.execute.side_effect = RuntimeError("modify failed")
+        return request
+
+    messages.batchModify.side_effect = batch_modify
+    messages.modify.side_effect = modify
+
+    results = gmail_client.batch_modify(['a', 'b', 'c', 'bad', 'd'], remove_label_ids=['UNREAD'])
+    assert calls == [['a', 'b'], ['c', 'bad'], ['d']]
+    assert results == {'a': True, 'b': True, 'c': True, 'bad': False, 'd': True}
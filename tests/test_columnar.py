@@ -0,0 +1,74 @@
+import random
+from datetime import datetime, timedelta
+import numpy as np
+from benchmarks.synthetic import make_email_data, make_rules
+from src.database.models import Email, Rule, RuleCondition
+from src.metrics import metrics
+from src.rules.columnar import EmailColumns, condition_mask, matching_rules_batch
+from src.rules.compiler import compile_rules
+from src.rules.engine import RuleEngine
+
+def make_rule(predicate, *conditions):
+    return Rule(name=f'{predicate} {conditions}', predicate=predicate,
+                conditions=[RuleCondition(field=field, predicate=test, value=value)
+                            for field, test, value in conditions])
+
+def per_email(emails, rules):
+    engine = RuleEngine(gmail_client=None)
+    return [engine.matching_rules(email, rules) for email in emails]
+
+def test_batch_matches_per_email_evaluation():
+    rng = random.Random(9)
+    now = datetime.utcnow()
+    emails = [Email(**make_email_data(index, rng, now)) for index in range(500)]
+    sender = emails[0].from_address
+    rules = compile_rules(make_rules(30, seed=5) + [
+        make_rule('all', ('from', 'equals', sender.upper()), ('received_date', 'less_than', '30 days')),
+        make_rule('any', ('from', 'not_equals', sender), ('is_read', 'not_equals', 'true')),
+        make_rule('any', ('subject', 'contains', 'report'), ('received_date', 'greater_than', '10 days')),
+        make_rule('all', ('subject', 'contains', 'a')),
+        make_rule('all'),
+        make_rule('some', ('is_read', 'equals', 'true')),
+        make_rule('any', ('from', 'domain_is', sender.split('@')[-1]), ('subject', 'matches', r'\d{2}')),
+        make_rule('all', ('from', 'starts_with', sender[:3]), ('subject', 'matches', '(')),
+    ], now=now)
+    assert matching_rules_batch(emails, rules) == per_email(emails, rules)
+    assert matching_rules_batch([], rules) == []
+
+def test_masks_follow_the_compiled_tests_on_odd_values():
+    now = datetime(2024, 6, 1)
+    emails = [Email(from_address='A@x.com', subject=None, is_read=True, received_date=now - timedelta(days=1)),
+              Email(from_address='b@x.com', subject='None', is_read=None, received_date=now - timedelta(days=9)),
+              Email(from_address='a@x.com', subject='Hi', is_read=False, received_date=now - timedelta(days=40))]
+    conditions = [('from', 'equals', 'a@X.com'), ('subject', 'equals', 'none'), ('subject', 'not_equals', 'hi'),
+                  ('is_read', 'equals', 'false'), ('is_read', 'not_equals', 'true'), ('is_read', 'equals', 'none'),
+                  ('received_date', 'less_than', '7 days'), ('received_date', 'greater_than', '1 months'),
+                  ('received_date', 'less_than', 'soon'), ('received_date', 'equals', '7 days'),
+                  ('from', 'sounds_like', 'a'), ('from', 'starts_with', 'A@'), ('subject', 'starts_with', 'non'),
+                  ('from', 'domain_is', '@X.com'), ('from', 'domain_is', '')]
+    columns = EmailColumns(emails)
+    for condition in compile_rules([make_rule('all', *conditions)], now=now)[0].conditions:
+        mask = condition_mask(columns, condition)
+        assert mask is not None, condition.label
+        assert mask.tolist() == [bool(condition.test(email)) for email in emails], condition.label
+    # Substring conditions stay with the shared pattern scan
+    contains, = compile_rules([make_rule('all', ('subject', 'contains', 'hi'))], now=now)[0].conditions
+    assert condition_mask(columns, contains) is None
+    regex, = compile_rules([make_rule('all', ('subject', 'matches', '^h'))], now=now)[0].conditions
+    assert condition_mask(columns, regex) is None
+    assert columns.flags('is_read').dtype == np.int8
+
+def test_engine_batch_records_metrics_per_email():
+    rng = random.Random(3)
+    emails = [Email(**make_email_data(index, rng, datetime.utcnow())) for index in range(50)]
+    rules = compile_rules(make_rules(5))
+    engine = RuleEngine(gmail_client=None)
+    expected = per_email(emails, rules)
+    metrics.reset()
+    metrics.enable()
+    try:
+        assert engine.matching_rules_batch(emails, rules) == expected
+        assert metrics.totals('rule_evaluations_total', 'rule') == {rule.name: len(emails) for rule in rules}
+    finally:
+        metrics.disable()
+        metrics.reset()
@@ -0,0 +1,120 @@
+import pytest
+from datetime import datetime, timedelta
+from src.database.models import Email, Rule, RuleCondition
+from src.rules.compiler import compile_rules, CompiledRule, resolve_date_value
+from src.rules.engine import RuleEngine
+
+@pytest.fixture
+def rule_engine():
+    return RuleEngine(gmail_client=None)
+
+@pytest.fixture
+def emails():
+    now = datetime.utcnow()
+    return [
+        Email(gmail_id="a", thread_id="t", from_address="News@Example.com", to_address="me@example.com",
+              subject="Weekly Newsletter", message="Big SALE today", received_date=now - timedelta(days=1),
+              is_read=False),
+        Email(gmail_id="b", thread_id="t", from_address="boss@work.com", to_address="me@example.com",
+              subject="URGENT: report", message=None, received_date=now - timedelta(days=20),
+              is_read=True),
+    ]
+
+CONDITIONS = [
+    ("subject", "contains", "newsletter"),
+    ("subject", "not_contains", "urgent"),
+    ("from", "equals", "news@example.com"),
+    ("from", "not_equals", "news@example.com"),
+    ("message", "contains", "none"),
+    ("message", "contains", "sale"),
+    ("is_read", "equals", "false"),
+    ("is_read", "not_equals", "true"),
+    ("is_read", "contains", "ru"),
+    ("received_date", "less_than", "7 days"),
+    ("received_date", "greater_than", "1 months"),
+    ("received_date", "less_than", "2024-01-01"),
+    ("received_date", "equals", "7 days"),
+    ("subject", "unknown", "x"),
+    ("from", "starts_with", "NEWS@"),
+    ("message", "starts_with", "non"),
+    ("from", "domain_is", "example.com"),
+    ("from", "domain_is", "@Work.com"),
+    ("to", "domain_is", "ample.com"),
+    ("subject", "domain_is", ""),
+    ("subject", "matches", r"^weekly\s+news"),
+    ("subject", "matches", r"(\w+): \1|report$"),
+    ("message", "matches", "none"),
+    ("subject", "matches", "(unclosed"),
+]
+
+@pytest.mark.parametrize("field,predicate,value", CONDITIONS)
+def test_compiled_condition_matches_interpreter(rule_engine, emails, field, predicate, value):
+    condition = RuleCondition(field=field, predicate=predicate, value=value)
+    rule = Rule(name="r", predicate="all")
+    rule.conditions = [condition]
+    compiled = compile_rules([rule])[0]
+    for email in emails:
+        assert compiled.conditions[0](email) == rule_engine.evaluate_condition(email, condition)
+
+@pytest.mark.parametrize("predicate", ["all", "any", "bogus"])
+def test_compiled_rule_matches_interpreter(rule_engine, emails, predicate):
+    rule = Rule(name="r", predicate=predicate)
+    rule.conditions = [RuleCondition(field=f, predicate=p, value=v) for f, p, v in CONDITIONS[:4]]
+    compiled = compile_rules([rule])[0]
+    assert isinstance(compiled, CompiledRule)
+    for email in emails:
+        assert rule_engine.evaluate_rule(email, compiled) == rule_engine.evaluate_rule(email, rule)
+
+def test_rule_without_conditions_never_matches(rule_engine, emails):
+    compiled = compile_rules([Rule(name="empty", predicate="all")])[0]
+    assert not any(rule_engine.evaluate_rule(email, compiled) for email in emails)
+
+def test_relative_dates_resolve_against_run_timestamp():
+    now = datetime(2024, 6, 1)
+    assert resolve_date_value("7 days", now) == datetime(2024, 5, 25)
+    assert resolve_date_value("2 months", now) == now - timedelta(days=60)
+    assert resolve_date_value("soon", now) is None
+
+    rule = Rule(name="recent", predicate="all")
+    rule.conditions = [RuleCondition(field="received_date", predicate="less_than", value="7 days")]
+    rule_set = compile_rules([rule], now=now)
+    assert rule_set.now == now
+    assert rule_set[0].conditions[0].value == datetime(2024, 5, 25)
+
+def test_dispatch_tests_only_rules_filed_under_the_email(rule_engine):
+    def rule(name, predicate, *conditions):
+        return Rule(name=name, predicate=predicate,
+                    conditions=[RuleCondition(field=f, predicate=p, value=v) for f, p, v in conditions])
+
+    senders = [f"user{i}@example.com" for i in range(20)]
+    rules = [rule(f"sender {i}", "all", ("from", "equals", sender), ("subject", "contains", "report"))
+             for i, sender in enumerate(senders)]
+    rules += [
+        rule("domain", "all", ("subject", "not_contains", "spam"), ("from", "domain_is", "example.com")),
+        rule("sub domain", "all", ("from", "domain_is", "mail.example.com")),
+        rule("either", "any", ("from", "equals", senders[3]), ("to", "domain_is", "work.com")),
+        rule("loose", "any", ("from", "equals", senders[4]), ("subject", "contains", "report")),
+        rule("recent", "all", ("received_date", "less_than", "7 days")),
+    ]
+    compiled = compile_rules(rules)
+    assert len(compiled.dispatch.unfiled) == 2
+
+    now = datetime.utcnow()
+    emails = [Email(from_address=address, to_address=to, subject="Monthly report", received_date=now)
+              for address in [senders[3], senders[4].upper(), "News <news@mail.example.com>", "x@other.org"]
+              for to in ["me@work.com", "me@home.org"]]
+    for email in emails:
+        expected = [r for r in compiled if r.matches(email)]
+        assert rule_engine.matching_rules(email, compiled) == expected
+        assert set(compiled.dispatch.candidates(email)) >= set(expected)
+    assert [r.name for r in compiled.dispatch.candidates(emails[3])] == ["sender 4", "domain", "loose", "recent"]
+
+def test_plain_rules_are_interpreted_without_compiling(rule_engine, emails, capsys):
+    news = Rule(name="news", predicate="all",
+                conditions=[RuleCondition(field="from", predicate="domain_is", value="example.com")])
+    broken = Rule(name="broken", predicate="any",
+                  conditions=[RuleCondition(field="subject", predicate="matches", value="(")])
+    for email in emails:
+        assert rule_engine.matching_rules(email, [news, broken]) == ([news] if email is emails[0] else [])
+    # Compiling would have warned about the invalid pattern for every email
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,119 @@
+import random
+from datetime import datetime
+from sqlalchemy import create_engine, inspect, text, update
+from sqlalchemy.orm import sessionmaker
+from benchmarks.synthetic import make_email_data
+from src.database.fts import FTS_TABLE, drop_fts, fts_available, fts_contentless, rebuild_fts, reindex
+from src.database.ingest import ingest_emails
+from src.database.models import Base, Email, Rule, RuleCondition
+from src.rules.compiler import compile_rules
+from src.rules.sql import candidate_email_ids, condition_filter
+
+def indexed(db, column, phrase):
+    query = text(f"SELECT rowid FROM {FTS_TABLE} WHERE {column} MATCH :phrase")
+    return {rowid for rowid, in db.execute(query, {"phrase": f'"{phrase}"'})}
+
+def add_email(db, subject, message, gmail_id):
+    email = Email(gmail_id=gmail_id, thread_id="t", from_address="a@x.com", to_address="me@x.com",
+                  subject=subject, message=message, received_date=datetime.utcnow())
+    db.add(email)
+    db.commit()
+    return email
+
+def make_rule(field, predicate, value):
+    rule = Rule(name="r", predicate="all")
+    rule.conditions = [RuleCondition(field=field, predicate=predicate, value=value)]
+    return compile_rules([rule])[0]
+
+def test_index_follows_inserts_updates_and_deletes(db):
+    assert fts_available(db)
+    email = add_email(db, "Quarterly Report", "numbers inside", "1")
+    assert indexed(db, "subject", "rly rep") == {email.id}
+
+    email.message = "completely different body"
+    db.commit()
+    assert indexed(db, "message", "numbers") == set()
+    assert indexed(db, "message", "different") == {email.id}
+
+    email.is_read = True
+    db.commit()
+    assert indexed(db, "subject", "report") == {email.id}
+
+    db.query(Email).filter_by(id=email.id).delete()
+    db.commit()
+    assert indexed(db, "subject", "report") == set()
+
+def test_bulk_ingested_rows_are_indexed(db):
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    rows = [make_email_data(index, rng, now, body_words=10) for index in range(30)]
+    ingest_emails(db, rows, chunk_size=7)
+    # Duplicates are skipped and must not be indexed twice
+    ingest_emails(db, rows[:10], chunk_size=7)
+    count = db.execute(text(f"SELECT count(*) FROM {FTS_TABLE}")).scalar()
+    assert count == 30
+    expected = {email.id for email in db.query(Email) if "invoice" in email.message}
+    assert indexed(db, "message", "invoice") == expected
+
+def test_index_keeps_no_copy_of_the_text(db):
+    body = "confidential quarterly figures " * 20
+    email = add_email(db, "Board pack", body, "1")
+    tables = set(inspect(db.get_bind()).get_table_names())
+    assert f"{FTS_TABLE}_content" not in tables
+    assert fts_contentless(db.connection())
+    for name in tables - {"emails"}:
+        for row in db.execute(text(f"SELECT * FROM {name}")):
+            assert not any(isinstance(value, (str, bytes)) and b"confidential" in
+                           (value.encode() if isinstance(value, str) else value) for value in row)
+    assert indexed(db, "message", "quarterly fig") == {email.id}
+
+    # Core updates, such as filling in a body fetched later, go through the trigger too
+    db.execute(update(Email).where(Email.id == email.id).values(message="minutes of the meeting"))
+    db.commit()
+    assert indexed(db, "message", "quarterly") == set()
+    assert indexed(db, "message", "minutes") == {email.id}
+    assert reindex(db.connection(), [email.id]) == 0
+
+    db.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, subject, message) "
+                    "VALUES ('delete', :id, 'Board pack', 'minutes of the meeting')"), {"id": email.id})
+    assert reindex(db.connection(), [email.id]) == 1
+    assert indexed(db, "message", "minutes") == {email.id}
+
+def test_contains_uses_the_index_and_falls_back_otherwise(db):
+    first = add_email(db, "Weekly sale", "meeting at noon", "1")
+    add_email(db, "Hello", "nothing here", "2")
+
+    sql = str(condition_filter(make_rule("message", "contains", "meeting").conditions[0], fts=True))
+    assert FTS_TABLE in sql
+    assert candidate_email_ids(db, make_rule("message", "contains", "meeting")) == [first.id]
+    # Too short for trigrams: the body cannot be searched in SQL, the subject uses LIKE
+    assert condition_filter(make_rule("message", "contains", "at").conditions[0], fts=True) is None
+    assert FTS_TABLE not in str(condition_filter(make_rule("subject", "contains", "we").conditions[0], fts=True))
+    # Without the index, bodies are left to Python
+    assert condition_filter(make_rule("message", "contains", "meeting").conditions[0]) is None
+
+def test_databases_without_the_index_fall_back_and_can_be_rebuilt(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    email = add_email(db, "Old newsletter", "archived body", "1")
+    with engine.begin() as connection:
+        drop_fts(connection)
+    assert not fts_available(db)
+    assert candidate_email_ids(db, make_rule("subject", "contains", "newsletter")) == [email.id]
+
+    with engine.begin() as connection:
+        assert rebuild_fts(connection) == 1
+    assert fts_available(db)
+    assert indexed(db, "message", "archived") == {email.id}
+
+    # An index from before it was contentless is replaced, not reused
+    with engine.begin() as connection:
+        drop_fts(connection)
+        connection.execute(text(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(subject, message, tokenize='trigram')"))
+        assert not fts_contentless(connection)
+        assert rebuild_fts(connection) == 1
+        assert fts_contentless(connection)
+    assert indexed(db, "subject", "newsletter") == {email.id}
+    db.close()
+    engine.dispose()
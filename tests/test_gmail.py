@@ -0,0 +1,132 @@
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from src.gmail.client import GmailClient
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+from src.gmail.scheduler import RequestScheduler
+
+# The fake server has no quota to stay within
+UNTHROTTLED = RequestScheduler(rate=None)
+
+@pytest.fixture
+def server():
+    with FakeGmailServer(FakeMailbox(250, seed=1)) as server:
+        yield server
+
+@pytest.fixture
+def gmail_client(server):
+    return GmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED)
+
+def test_get_message_and_parse(gmail_client, server):
+    msg_id = server.mailbox.ordered_ids()[0]
+    parsed = gmail_client.parse_message(gmail_client.get_message(msg_id))
+    expected = server.mailbox.messages[msg_id]
+    assert parsed['gmail_id'] == msg_id
+    assert parsed['subject'] == expected['payload']['headers'][2]['value']
+    assert parsed['is_read'] == ('UNREAD' not in expected['labelIds'])
+    assert parsed['message']
+
+def test_get_messages_uses_http_batches(gmail_client, server):
+    ids = server.mailbox.ordered_ids()
+    before = server.request_count
+    results = gmail_client.get_messages(ids, max_workers=2)
+    assert not isinstance(results, (list, dict))
+    fetched = dict(results)
+    assert set(fetched) == set(ids)
+    assert all(fetched[msg_id]['id'] == msg_id for msg_id in ids)
+    assert server.request_count - before == 3
+
+def test_get_messages_leaves_retries_to_the_scheduler(gmail_client, server):
+    ids = server.mailbox.ordered_ids()[:5] + ['missing']
+    before = server.request_count
+    fetched = dict(gmail_client.get_messages(ids))
+    assert fetched['missing'] is None
+    assert all(fetched[msg_id] for msg_id in ids[:5])
+    # A missing message is not worth retrying: the batch is the only request
+    assert server.request_count - before == 1
+
+def test_rate_limited_items_get_only_the_schedulers_retries(server):
+    server.error_rate = 1.0
+    scheduler = RequestScheduler(rate=None, max_retries=2, base_delay=0.001)
+    client = GmailClient(api_endpoint=server.url, scheduler=scheduler)
+    fetched = dict(client.get_messages(server.mailbox.ordered_ids()[:5]))
+    assert list(fetched.values()) == [None] * 5
+    # Each message fails once inside the batch, then gets the scheduler's three attempts alone
+    assert server.error_count == 5 + 5 * 3
+    assert scheduler.stats()['retries'] == 5 * 2
+
+def test_iter_messages_follows_page_tokens_lazily(gmail_client, server):
+    before = server.request_count
+    messages = gmail_client.iter_messages(page_size=100)
+    first = next(messages)
+    assert server.request_count - before == 1
+    ids = [first['id']] + [message['id'] for message in messages]
+    assert ids == server.mailbox.ordered_ids()
+    assert server.request_count - before == 3
+
+def test_iter_messages_filters_server_side_and_resumes(gmail_client, server):
+    unread = [msg_id for msg_id in server.mailbox.ordered_ids()
+              if 'UNREAD' in server.mailbox.messages[msg_id]['labelIds']]
+    cursors = []
+    listed = []
+    for message in gmail_client.iter_messages(query='is:unread', label_ids=['INBOX'], page_size=50,
+                                              on_page=cursors.append):
+        listed.append(message['id'])
+        if len(listed) == 50:
+            break
+    assert cursors == []
+
+    resumed = list(gmail_client.iter_messages(query='is:unread', page_size=50, page_token='50',
+                                              on_page=cursors.append))
+    assert listed + [message['id'] for message in resumed] == unread
+    assert cursors[-1] is None
+
+def test_list_messages_keeps_its_list_api(gmail_client, server):
+    assert [m['id'] for m in gmail_client.list_messages(max_results=120)] == server.mailbox.ordered_ids()[:120]
+
+def test_label_changes_reach_the_mailbox(gmail_client, server):
+    first, second, third = server.mailbox.ordered_ids()[:3]
+    assert gmail_client.move_message(first, 'Receipts')
+    label_id = gmail_client.get_label_id('receipts')
+    assert label_id.startswith('Label_')
+    assert label_id in server.mailbox.messages[first]['labelIds']
+
+    outcome = gmail_client.batch_modify([second, third, 'missing'], [label_id], ['UNREAD'])
+    assert outcome == {second: True, third: True, 'missing': True}
+    for msg_id in (second, third):
+        assert label_id in server.mailbox.messages[msg_id]['labelIds']
+        assert 'UNREAD' not in server.mailbox.messages[msg_id]['labelIds']
+
+    assert gmail_client.mark_as_unread(first)
+    assert 'UNREAD' in server.mailbox.messages[first]['labelIds']
+    assert not gmail_client.modify_message(first, ['Label_unknown'])
+
+def test_injected_errors_are_retried_by_the_scheduler(server):
+    server.error_rate = 0.3
+    scheduler = RequestScheduler(rate=None, base_delay=0.001)
+    client = GmailClient(api_endpoint=server.url, scheduler=scheduler)
+    ids = server.mailbox.ordered_ids()[:60]
+
+    fetched = dict(client.get_messages(ids))
+    assert server.error_count > 0
+    assert all(fetched[msg_id] for msg_id in ids)
+    assert scheduler.stats()['retries'] > 0
+
+def test_calls_from_worker_threads_use_their_own_connections(gmail_client, server):
+    # httplib2.Http is not thread-safe, so the service's shared one must never be used
+    def shared_http_used(*args, **kwargs):
+        raise AssertionError("request sent over the shared connection")
+    gmail_client.service._http.request = shared_http_used
+    ids = server.mailbox.ordered_ids()
+
+    def work(index):
+        msg_id = ids[index]
+        assert next(gmail_client.iter_messages(page_size=10))
+        assert gmail_client.get_message(msg_id)['id'] == msg_id
+        assert gmail_client.move_message(msg_id, f'Folder {index % 2}')
+        return threading.get_ident(), gmail_client._thread_http()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        used = set(executor.map(work, range(8)))
+    # One connection per thread
+    assert len(used) == len({thread for thread, _ in used}) == len({http for _, http in used})
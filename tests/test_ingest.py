@@ -0,0 +1,33 @@
+import random
+from datetime import datetime
+from benchmarks.synthetic import make_email_data
+from src.database.ingest import EmailIngestor, existing_gmail_ids, ingest_emails
+from src.database.models import Email
+
+def make_rows(count, start=0):
+    rng = random.Random(start)
+    now = datetime.utcnow()
+    return [make_email_data(index, rng, now, body_words=5) for index in range(start, start + count)]
+
+def test_existing_ids_are_found_in_chunks(db):
+    ingest_emails(db, make_rows(12))
+    wanted = [f'msg{index:08d}' for index in range(8, 20)]
+    assert existing_gmail_ids(db, wanted, chunk_size=5) == set(wanted[:4])
+
+def test_ingest_skips_duplicates_and_fills_defaults(db):
+    assert ingest_emails(db, make_rows(25), chunk_size=10) == 25
+    assert ingest_emails(db, make_rows(10, start=20), chunk_size=4) == 5
+    assert db.query(Email).count() == 30
+    email = db.query(Email).filter_by(gmail_id='msg00000003').one()
+    assert email.created_at is not None
+
+def test_ingestor_commits_each_full_chunk(db):
+    ingestor = EmailIngestor(db, chunk_size=4)
+    for row in make_rows(6):
+        ingestor.add(row)
+    # The first chunk is committed, the remainder is still buffered
+    db.rollback()
+    assert db.query(Email).count() == 4
+    ingestor.flush()
+    assert db.query(Email).count() == 6
+    assert ingestor.inserted == 6
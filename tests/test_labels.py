@@ -0,0 +1,90 @@
+import threading
+import time
+from sqlalchemy.orm import sessionmaker
+from src.database.models import GmailLabel
+from src.gmail.labels import LabelCache, LabelStore
+
+class Request:
+    def __init__(self, execute):
+        self.execute = execute
+
+class FakeLabelsService:
+    """Just enough of the Gmail service object for users().labels()."""
+
+    def __init__(self, labels=None):
+        self.remote = dict(labels or {})
+        self.list_calls = 0
+        self.create_calls = 0
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId):
+        def execute():
+            self.list_calls += 1
+            return {'labels': [{'name': name, 'id': label_id} for name, label_id in self.remote.items()]}
+        return Request(execute)
+
+    def create(self, userId, body):
+        def execute():
+            self.create_calls += 1
+            time.sleep(0.01)
+            label_id = f"Label_{len(self.remote)}"
+            self.remote[body['name']] = label_id
+            return {'name': body['name'], 'id': label_id}
+        return Request(execute)
+
+def test_labels_are_listed_once_and_matched_case_insensitively():
+    service = FakeLabelsService({'Newsletters': 'Label_1', 'INBOX': 'INBOX'})
+    cache = LabelCache(service)
+    assert cache.get_id('newsletters') == 'Label_1'
+    assert cache.get_id('NEWSLETTERS') == 'Label_1'
+    assert cache.get_id('inbox') == 'INBOX'
+    assert service.list_calls == 1
+
+def test_missing_label_is_created_once_and_cached():
+    service = FakeLabelsService()
+    cache = LabelCache(service)
+    label_id = cache.get_id('Urgent')
+    assert cache.get_id('urgent') == label_id
+    assert service.create_calls == 1
+    assert cache.get_id('Other', create=False) is None
+    assert service.create_calls == 1
+
+def test_stale_cache_is_refreshed():
+    service = FakeLabelsService({'A': 'Label_A'})
+    cache = LabelCache(service, ttl=0)
+    cache.get_id('A')
+    time.sleep(0.001)
+    service.remote['A'] = 'Label_A2'
+    assert cache.get_id('A') == 'Label_A2'
+    assert service.list_calls == 2
+
+def test_concurrent_moves_create_a_label_once():
+    service = FakeLabelsService()
+    cache = LabelCache(service)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_id('Receipts'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert service.create_calls == 1
+    assert len(set(results)) == 1
+
+def test_store_warms_later_caches(db_engine):
+    store = LabelStore(sessionmaker(bind=db_engine))
+    service = FakeLabelsService({'Receipts': 'Label_9'})
+    LabelCache(service, store=store).get_id('Travel')
+
+    session = sessionmaker(bind=db_engine)()
+    assert {row.name for row in session.query(GmailLabel)} == {'Receipts', 'Travel'}
+    session.close()
+
+    fresh = FakeLabelsService()
+    warm = LabelCache(fresh, store=store)
+    assert warm.get_id('receipts') == 'Label_9'
+    assert fresh.list_calls == 0
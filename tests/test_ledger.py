@@ -0,0 +1,78 @@
+import pytest
+from datetime import datetime, timedelta
+from src.database.models import Email, ProcessedEmail, Rule, RuleAction, RuleCondition
+from src.rules.compiler import compile_rules
+from src.rules.ledger import ProcessingLedger, outcome_of, rules_fingerprint
+from src.rules.sql import plan_candidates
+
+def make_rule(field="subject", predicate="contains", value="sale"):
+    rule = Rule(name="Sales", predicate="all", priority=0)
+    rule.conditions = [RuleCondition(field=field, predicate=predicate, value=value)]
+    rule.actions = [RuleAction(action_type="mark_as_read")]
+    return rule
+
+@pytest.fixture
+def emails(db):
+    now = datetime.utcnow()
+    rows = [
+        Email(gmail_id=str(i), thread_id="t", from_address="a@x.com", to_address="me@x.com",
+              subject="Big sale" if i % 2 else "Hello", message="", received_date=now - timedelta(days=i))
+        for i in range(4)
+    ]
+    db.add_all(rows)
+    db.commit()
+    return rows
+
+def test_fingerprint_tracks_rule_content():
+    assert rules_fingerprint([make_rule()]) == rules_fingerprint(compile_rules([make_rule()]))
+    assert rules_fingerprint([make_rule()]) != rules_fingerprint([make_rule(value="offer")])
+
+def test_outcome_of():
+    assert outcome_of([]) == 'no_match'
+    assert outcome_of([{'rule_name': 'r', 'actions': [{'success': True}]}]) == 'matched'
+    assert outcome_of([{'rule_name': 'r', 'actions': [{'success': True}, {'success': False}]}]) == 'failed'
+
+def test_settled_emails_are_skipped_until_updated(db, emails):
+    rules = compile_rules([make_rule()], now=datetime.utcnow() + timedelta(seconds=1))
+    ledger = ProcessingLedger(db, rules)
+    assert set(plan_candidates(db, rules, ledger.pending_filter())) == {emails[1].id, emails[3].id}
+
+    ledger.record({emails[1].id: 'matched', emails[3].id: 'failed'})
+    assert set(plan_candidates(db, rules, ledger.pending_filter())) == {emails[3].id}
+
+    emails[1].is_read = True
+    emails[1].updated_at = datetime.utcnow() + timedelta(seconds=5)
+    db.commit()
+    assert set(plan_candidates(db, rules, ledger.pending_filter())) == {emails[1].id, emails[3].id}
+
+    changed = ProcessingLedger(db, compile_rules([make_rule(value="big")]))
+    assert set(plan_candidates(db, rules, changed.pending_filter())) == {emails[1].id, emails[3].id}
+
+def test_no_match_is_not_trusted_for_aging_rules(db, emails):
+    rules = compile_rules([make_rule("received_date", "greater_than", "2 days")],
+                          now=datetime.utcnow() + timedelta(seconds=1))
+    ledger = ProcessingLedger(db, rules)
+    assert not ledger.trust_no_match
+    ledger.record({email.id: 'no_match' for email in emails})
+    assert set(plan_candidates(db, rules, ledger.pending_filter())) == {emails[2].id, emails[3].id}
+
+def test_prune_drops_stale_entries(db, emails):
+    old = ProcessingLedger(db, [make_rule(value="old")])
+    old.record({emails[0].id: 'matched'})
+    ledger = ProcessingLedger(db, [make_rule()])
+    ledger.record({emails[1].id: 'matched', emails[2].id: 'no_match'})
+    db.delete(emails[2])
+    db.commit()
+    assert ledger.prune() == 2
+    assert [row.email_id for row in db.query(ProcessedEmail)] == [emails[1].id]
+
+def test_emails_updated_during_the_run_are_settled_when_recorded(db, emails):
+    rules = compile_rules([make_rule()], now=datetime.utcnow() - timedelta(hours=1))
+    ledger = ProcessingLedger(db, rules)
+    # e.g. a body fetched or labels synced after the rules were compiled
+    emails[1].label = "INBOX"
+    db.commit()
+    ledger.record({emails[1].id: 'matched'}, {emails[1].id: True})
+    assert set(plan_candidates(db, rules, ledger.pending_filter())) == {emails[3].id}
+    db.refresh(emails[1])
+    assert emails[1].is_read is True
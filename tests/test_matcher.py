@@ -0,0 +1,85 @@
+import random
+import pytest
+from datetime import datetime
+from src.database.models import Email, Rule, RuleCondition
+from src.rules import matcher
+from src.rules.compiler import compile_rules
+from src.rules.engine import RuleEngine
+from src.rules.matcher import FieldLookup, FieldPatternIndex, PatternAutomaton, domain_matches
+
+def test_automaton_reports_overlapping_patterns():
+    automaton = PatternAutomaton(["he", "she", "his", "hers"])
+    assert automaton.scan("ushers") == {0, 1, 3}
+    assert automaton.scan("this") == {2}
+    assert automaton.scan("xyz") == frozenset()
+
+def test_automaton_matches_naive_search():
+    rng = random.Random(7)
+    patterns = list({"".join(rng.choice("abc") for _ in range(rng.randint(1, 5))) for _ in range(60)})
+    automaton = PatternAutomaton(patterns)
+    for _ in range(50):
+        text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 40)))
+        expected = {i for i, pattern in enumerate(patterns) if pattern in text}
+        assert automaton.scan(text) == expected
+
+@pytest.mark.parametrize("threshold", [1, 1000])
+def test_field_index_dedupes_patterns_and_scans_once(monkeypatch, threshold):
+    monkeypatch.setattr(matcher, "AUTOMATON_THRESHOLD", threshold)
+    index = FieldPatternIndex("subject")
+    first = index.add("sale")
+    assert index.add("sale") == first
+    empty = index.add("")
+    other = index.add("urgent")
+    index.build()
+
+    email = Email(subject="Big SALE")
+    assert index.hits(email) == {first, empty}
+    email.subject = "urgent sale"
+    assert index.hits(email) == {first, empty, other}
+
+@pytest.mark.parametrize("threshold", [1, 1000])
+def test_indexed_rules_match_interpreter(monkeypatch, threshold):
+    monkeypatch.setattr(matcher, "AUTOMATON_THRESHOLD", threshold)
+    engine = RuleEngine(gmail_client=None)
+    words = ["news", "newsletter", "sale", "urgent", "", "none"]
+    rules = []
+    for i, word in enumerate(words):
+        rule = Rule(name=f"r{i}", predicate="all" if i % 2 else "any")
+        rule.conditions = [
+            RuleCondition(field="subject", predicate="contains", value=word.upper()),
+            RuleCondition(field="message", predicate="not_contains", value=word),
+        ]
+        rules.append(rule)
+    compiled = compile_rules(rules)
+    emails = [
+        Email(subject="Weekly Newsletter", message="big sale", received_date=datetime.utcnow()),
+        Email(subject="URGENT", message=None, received_date=datetime.utcnow()),
+    ]
+    for email in emails:
+        for rule, compiled_rule in zip(rules, compiled):
+            assert engine.evaluate_rule(email, compiled_rule) == engine.evaluate_rule(email, rule)
+
+def test_domains_match_whole_labels():
+    assert domain_matches("news <news@mail.example.com>", "example.com")
+    assert domain_matches("news@example.com", "example.com")
+    assert not domain_matches("news@notexample.com", "example.com")
+    assert not domain_matches("example.com", "example.com")
+    assert not domain_matches("news@example.com", "")
+
+def test_field_lookup_answers_every_value_from_one_read():
+    lookup = FieldLookup("subject")
+    weekly = lookup.add_pattern(r"^weekly\b")
+    repeated = lookup.add_pattern(r"(\w+) \1")
+    named = [lookup.add_pattern(r"(?P<w>sale)"), lookup.add_pattern(r"(?P<w>deal)")]
+    assert lookup.add_pattern("(") is None
+    assert lookup.add_pattern(r"^weekly\b") == weekly
+    sale = lookup.add_prefix("sale")
+    weekly_prefix = lookup.add_prefix("weekly")
+    lookup.build()
+
+    email = Email(subject="Weekly sale sale")
+    assert lookup.pattern_ids(email) == {weekly, repeated, named[0]}
+    assert lookup.prefix_ids(email) == {weekly_prefix}
+    assert lookup.pattern_ids(Email(subject="Big DEAL")) == {named[1]}
+    assert lookup.pattern_ids(Email(subject=None)) == frozenset()
+    assert lookup.prefix_ids(Email(subject="Sale")) == {sale}
@@ -0,0 +1,116 @@
+import json
+import random
+from datetime import datetime
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from benchmarks.synthetic import make_email_data, make_rules
+from src.database.models import Email, Rule, RuleCondition
+from src.gmail.scheduler import RequestScheduler
+from src.metrics import MetricsRegistry, metrics
+from src.rules.compiler import compile_rules
+from src.rules.engine import RuleEngine
+
+@pytest.fixture
+def recording():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+class FlakyRequest:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+
+    def execute(self, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry()
+    registry.inc('calls_total', method='get')
+    registry.observe('latency_seconds', 0.1)
+    with registry.time('latency_seconds'):
+        pass
+    assert registry.report() == {'counters': [], 'histograms': []}
+
+def test_prometheus_export():
+    registry = MetricsRegistry(enabled=True)
+    registry.inc('rule_matches_total', rule='Say "hi"')
+    registry.inc('rule_matches_total', 2, rule='Say "hi"')
+    for seconds in (0.002, 0.02, 60):
+        registry.observe('gmail_api_latency_seconds', seconds, method='messages.get')
+
+    text = registry.to_prometheus()
+    assert '# TYPE gmail_processor_rule_matches_total counter' in text
+    assert 'gmail_processor_rule_matches_total{rule="Say \\"hi\\""} 3' in text
+    assert 'gmail_processor_gmail_api_latency_seconds_bucket{method="messages.get",le="0.005"} 1' in text
+    assert 'gmail_processor_gmail_api_latency_seconds_bucket{method="messages.get",le="30.0"} 2' in text
+    assert 'gmail_processor_gmail_api_latency_seconds_bucket{method="messages.get",le="+Inf"} 3' in text
+    assert 'gmail_processor_gmail_api_latency_seconds_count{method="messages.get"} 3' in text
+
+    histogram, = registry.report()['histograms']
+    assert histogram['count'] == 3 and histogram['p50'] == 0.025 and histogram['p99'] is None
+
+def test_export_writes_json_and_prometheus_files(tmp_path):
+    registry = MetricsRegistry(enabled=True)
+    registry.inc('actions_total', action='mark_as_read', outcome='success')
+    paths = registry.export(str(tmp_path))
+    assert [path.rsplit('/', 1)[-1] for path in paths] == ['metrics.json', 'metrics.prom']
+    report = json.loads((tmp_path / 'metrics.json').read_text())
+    assert report['counters'] == [{'name': 'actions_total', 'value': 1,
+                                   'labels': {'action': 'mark_as_read', 'outcome': 'success'}}]
+    assert MetricsRegistry().export(str(tmp_path / 'off')) == []
+
+def test_instrumented_evaluation_matches_and_counts_conditions(recording):
+    rng = random.Random(2)
+    now = datetime.utcnow()
+    emails = [Email(**make_email_data(index, rng, now)) for index in range(200)]
+    rules = compile_rules(make_rules(10))
+    engine = RuleEngine(gmail_client=None)
+
+    recording.disable()
+    expected = [[rule.name for rule in engine.matching_rules(email, rules)] for email in emails]
+    recording.enable()
+    assert [[rule.name for rule in engine.matching_rules(email, rules)] for email in emails] == expected
+
+    evaluations = recording.totals('rule_evaluations_total', 'rule')
+    matches = recording.totals('rule_matches_total', 'rule')
+    assert evaluations == {rule.name: len(emails) for rule in rules}
+    for rule in rules:
+        assert matches.get(rule.name, 0) == sum(rule.name in names for names in expected)
+    assert set(recording.totals('rule_evaluation_seconds_total', 'rule')) == set(evaluations)
+
+def test_condition_rejections_follow_short_circuiting(recording):
+    rule = Rule(name='Invoices', predicate='all', conditions=[
+        RuleCondition(field='from', predicate='contains', value='billing'),
+        RuleCondition(field='subject', predicate='contains', value='invoice'),
+    ])
+    emails = [Email(subject='Invoice 7', from_address='billing@shop.com'),
+              Email(subject='Hello', from_address='billing@shop.com'),
+              Email(subject='Invoice 8', from_address='sales@shop.com')]
+    engine = RuleEngine(gmail_client=None)
+    for rules in ([rule], compile_rules([rule])):
+        recording.reset()
+        assert [bool(engine.matching_rules(email, rules)) for email in emails] == [True, False, False]
+        sender = {'rule': 'Invoices', 'condition': 'from contains billing'}
+        subject = {'rule': 'Invoices', 'condition': 'subject contains invoice'}
+        assert recording.value('condition_evaluations_total', **sender) == 3
+        assert recording.value('condition_rejections_total', **sender) == 1
+        # The third email is rejected by its sender, so its subject is never looked at
+        assert recording.value('condition_evaluations_total', **subject) == 2
+        assert recording.value('condition_rejections_total', **subject) == 1
+
+def test_scheduler_records_latency_and_status_per_method(recording):
+    scheduler = RequestScheduler(rate=None, sleep=lambda seconds: None)
+    error = HttpError(httplib2.Response({'status': 503}), b'{}')
+    assert scheduler.execute('messages.list', FlakyRequest(error)) == 'ok'
+
+    assert recording.value('gmail_api_calls_total', method='messages.list', status='503') == 1
+    assert recording.value('gmail_api_calls_total', method='messages.list', status='ok') == 1
+    assert recording.value('gmail_api_retries_total', method='messages.list') == 1
+    assert recording.value('gmail_api_units_total', method='messages.list') == 10
+    histogram, = recording.report()['histograms']
+    assert histogram['name'] == 'gmail_api_latency_seconds' and histogram['count'] == 2
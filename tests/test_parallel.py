@@ -0,0 +1,49 @@
+import random
+from datetime import datetime
+from benchmarks.synthetic import make_email_data, make_rules
+from src.database.ingest import ingest_emails
+from src.database.models import Email
+from src.rules.compiler import compile_rules
+from src.rules.engine import RuleEngine
+from src.rules.ledger import ProcessingLedger, rules_fingerprint
+from src.rules.parallel import evaluate_in_parallel
+from src.rules.parser import RuleParser
+
+def store_emails(db, count):
+    rng = random.Random(4)
+    now = datetime.utcnow()
+    ingest_emails(db, [make_email_data(index, rng, now, body_words=20) for index in range(count)])
+
+def test_rules_survive_serialization():
+    rules = make_rules(5)
+    copies = [RuleParser.rule_from_dict(RuleParser.rule_to_dict(rule)) for rule in rules]
+    assert rules_fingerprint(copies) == rules_fingerprint(rules)
+
+def test_parallel_results_match_sequential_evaluation(db):
+    store_emails(db, 300)
+    rules = compile_rules(make_rules(12))
+    engine = RuleEngine(gmail_client=None)
+    expected = {email.id: [rule.name for rule in engine.matching_rules(email, rules)]
+                for email in db.query(Email) if engine.matching_rules(email, rules)}
+
+    seen = {}
+    for shard in evaluate_in_parallel(db, rules, workers=2, reprocess=True, shard_size=70):
+        for email, matched in shard:
+            assert email.id not in seen
+            assert all(rule in rules.rules for rule in matched)
+            seen[email.id] = (email.gmail_id, [rule.name for rule in matched])
+
+    assert {email_id: names for email_id, (_, names) in seen.items() if names} == expected
+    gmail_ids = dict(db.query(Email.id, Email.gmail_id))
+    assert all(gmail_ids[email_id] == gmail_id for email_id, (gmail_id, _) in seen.items())
+
+def test_workers_skip_emails_the_ledger_settled(db):
+    store_emails(db, 50)
+    rules = compile_rules(make_rules(4))
+    ledger = ProcessingLedger(db, rules)
+    settled = [email_id for email_id, in db.query(Email.id).order_by(Email.id).limit(20)]
+    ledger.record({email_id: 'matched' for email_id in settled})
+
+    evaluated = {email.id for shard in evaluate_in_parallel(db, rules, workers=2, shard_size=10)
+                 for email, _ in shard}
+    assert evaluated and not evaluated & set(settled)
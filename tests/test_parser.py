@@ -0,0 +1,109 @@
+import json
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from src.database.meta import get_meta
+from src.database.models import Base, Rule, RuleAction, RuleCondition
+from src.rules.parser import RULES_HASH_KEY, CachedRule, RuleParser
+
+RULES = {'rules': [
+    {'name': 'Newsletters', 'predicate': 'all',
+     'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'newsletter'}],
+     'actions': [{'type': 'mark_as_read'}, {'type': 'move_to', 'value': 'News'}]},
+    {'name': 'Invoices', 'predicate': 'any',
+     'conditions': [{'field': 'from', 'predicate': 'contains', 'value': 'billing'},
+                    {'field': 'subject', 'predicate': 'contains', 'value': 'invoice'}],
+     'actions': [{'type': 'move_to', 'value': 'Bills'}]},
+]}
+
+@pytest.fixture
+def rules_file(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps(RULES))
+    return path
+
+@pytest.fixture
+def parser(rules_file):
+    return RuleParser(str(rules_file))
+
+def count_writes(db_engine):
+    writes = []
+
+    @event.listens_for(db_engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            writes.append(statement)
+    return writes
+
+def condition_ids(db):
+    return {rule.name: sorted(condition.id for condition in rule.conditions) for rule in db.query(Rule)}
+
+def test_unchanged_file_is_not_reloaded(parser, db, db_engine):
+    rules = parser.load_rules(db)
+    assert [RuleParser.rule_to_dict(rule) for rule in rules] == [
+        RuleParser._normalize(data['name'], data) for data in RULES['rules']]
+    assert get_meta(db, RULES_HASH_KEY) == parser.file_hash()
+
+    writes = count_writes(db_engine)
+    cached = parser.load_rules(db)
+    assert writes == []
+    # Served from the on-disk cache as plain rules that belong to no session
+    assert [RuleParser.rule_to_dict(rule) for rule in cached] == [RuleParser.rule_to_dict(rule) for rule in rules]
+    assert all(isinstance(rule, CachedRule) for rule in cached)
+
+def test_changed_file_rewrites_only_the_changed_rules(parser, rules_file, db):
+    parser.load_rules(db)
+    before = condition_ids(db)
+    changed = json.loads(json.dumps(RULES))
+    changed['rules'][1]['conditions'][1]['value'] = 'receipt'
+    changed['rules'].append({'name': 'Alerts', 'conditions': [{'field': 'from', 'predicate': 'equals',
+                                                               'value': 'alerts@bank.com'}],
+                             'actions': [{'type': 'mark_as_unread'}]})
+    rules_file.write_text(json.dumps(changed))
+
+    rules = parser.load_rules(db)
+    after = condition_ids(db)
+    assert after['Newsletters'] == before['Newsletters']
+    assert after['Invoices'] != before['Invoices']
+    assert [rule.name for rule in rules] == ['Newsletters', 'Invoices', 'Alerts']
+    assert [c.value for c in rules[1].conditions] == ['billing', 'receipt']
+    # The replaced conditions were deleted, not left orphaned
+    assert db.query(RuleCondition).count() == 4
+    assert db.query(RuleAction).count() == 4
+    assert get_meta(db, RULES_HASH_KEY) == parser.file_hash()
+
+def test_rules_removed_from_the_file_are_deleted(parser, rules_file, db):
+    parser.load_rules(db)
+    rules_file.write_text(json.dumps({'rules': RULES['rules'][:1]}))
+
+    assert [rule.name for rule in parser.load_rules(db)] == ['Newsletters']
+    assert [rule.name for rule in db.query(Rule)] == ['Newsletters']
+    assert db.query(RuleCondition).count() == 1
+    assert db.query(RuleAction).count() == 2
+    # The cache written with them does not bring the deleted rule back either
+    assert [rule.name for rule in parser.load_rules(db)] == ['Newsletters']
+
+def test_cache_is_not_shared_between_databases(parser, db, tmp_path):
+    parser.load_rules(db)
+    other_engine = create_engine(f"sqlite:///{tmp_path / 'other.db'}")
+    Base.metadata.create_all(bind=other_engine)
+    other = sessionmaker(bind=other_engine)()
+    try:
+        rules = parser.load_rules(other)
+        assert other.query(Rule).count() == 2 and all(rule.id for rule in rules)
+    finally:
+        other.close()
+        other_engine.dispose()
+
+def test_conditions_that_never_match_are_kept_with_a_warning(rules_file, parser, db, capsys):
+    conditions = [{'field': 'from', 'predicate': 'domain_is', 'value': 'example.com'},
+                  {'field': 'subject', 'predicate': 'matches', 'value': '(unclosed'},
+                  {'field': 'received_date', 'predicate': 'starts_with', 'value': '7 days'}]
+    rules_file.write_text(json.dumps({'rules': [{'name': 'Odd', 'predicate': 'all', 'conditions': conditions,
+                                                 'actions': [{'type': 'mark_as_read'}]}]}))
+    rule, = parser.load_rules(db)
+    assert [(c.field, c.predicate, c.value) for c in rule.conditions] == [tuple(c.values()) for c in conditions]
+    output = capsys.readouterr().out
+    assert "Invalid regular expression in rule 'Odd'" in output
+    assert "Unknown predicate in rule 'Odd'" in output
+    assert output.count('Warning') == 2
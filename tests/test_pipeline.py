@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+from src.database.models import Email, ProcessedEmail, Rule, RuleAction, RuleCondition
+from src.gmail.client import GmailClient
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+from src.pipeline import EmailPipeline
+from src.gmail.scheduler import RequestScheduler
+
+# The fake server has no quota to stay within
+UNTHROTTLED = RequestScheduler(rate=None)
+
+class RecordingGmailClient(GmailClient):
+    """Talks to the fake server for reads and records label changes instead of sending them."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.modified = []
+
+    def batch_modify(self, msg_ids, add_label_ids=None, remove_label_ids=None):
+        self.modified.extend(msg_ids)
+        return {msg_id: True for msg_id in msg_ids}
+
+@pytest.fixture
+def server():
+    with FakeGmailServer(FakeMailbox(300, seed=2)) as server:
+        yield server
+
+@pytest.fixture
+def session_factory(db_engine):
+    return sessionmaker(bind=db_engine)
+
+def unread_rule():
+    rule = Rule(name="Read everything unread", predicate="all", priority=0)
+    rule.conditions = [RuleCondition(field="is_read", predicate="equals", value="false")]
+    rule.actions = [RuleAction(action_type="mark_as_read")]
+    return rule
+
+# Parsing and evaluation on a thread each, or in worker processes
+@pytest.mark.parametrize("cpu_workers", [1, 2])
+def test_pipeline_stores_and_acts_on_new_emails(server, session_factory, cpu_workers):
+    client = RecordingGmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED)
+    pipeline = EmailPipeline(client, session_factory, [unread_rule()], fetch_workers=3,
+                             fetch_batch_size=40, store_batch_size=64, act_batch_size=25, queue_size=50,
+                             flush_interval=0.05, parse_workers=cpu_workers, evaluate_workers=cpu_workers)
+    stats = pipeline.run()
+
+    unread = {msg_id for msg_id, message in server.mailbox.messages.items() if 'UNREAD' in message['labelIds']}
+    assert stats['listed'] == stats['stored'] == stats['evaluated'] == 300
+    assert sorted(client.modified) == sorted(unread)
+    assert stats['matched'] == len(unread)
+
+    db = session_factory()
+    assert db.query(Email).count() == 300
+    assert db.query(ProcessedEmail).count() == 300
+    db.close()
+
+def test_pipeline_skips_stored_emails_and_honours_max_results(server, session_factory):
+    client = RecordingGmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED)
+    EmailPipeline(client, session_factory, [unread_rule()], max_results=120, flush_interval=0.05).run()
+
+    stats = EmailPipeline(client, session_factory, [unread_rule()], flush_interval=0.05).run()
+    assert stats['skipped'] == 120
+    assert stats['stored'] == 180
+
+def test_unfetchable_messages_are_counted_and_not_stored(server, session_factory):
+    class FlakyGmailClient(RecordingGmailClient):
+        def get_messages(self, msg_ids, **kwargs):
+            for msg_id, message in super().get_messages(msg_ids, **kwargs):
+                yield msg_id, None if msg_id in failing else message
+
+    failing = set(server.mailbox.ordered_ids()[:3])
+    pipeline = EmailPipeline(FlakyGmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED), session_factory, [unread_rule()],
+                             fetch_workers=1, flush_interval=0.05)
+    stats = pipeline.run()
+    assert stats['failed'] == 3
+    assert stats['stored'] == 297
+    db = session_factory()
+    assert db.query(Email).filter(Email.gmail_id.in_(failing)).count() == 0
+    db.close()
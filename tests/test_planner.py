@@ -0,0 +1,63 @@
+import pytest
+from src.database.models import Email, Rule, RuleCondition
+from src.gmail.client import GmailClient
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+from src.gmail.scheduler import RequestScheduler
+from src.gmail.sync import MailboxSync
+from src.rules.planner import plan_fetch
+
+@pytest.fixture
+def server():
+    with FakeGmailServer(FakeMailbox(40, seed=3, body_words=20)) as server:
+        yield server
+
+@pytest.fixture
+def gmail_client(server):
+    return GmailClient(api_endpoint=server.url, scheduler=RequestScheduler(rate=None))
+
+def make_rule(*fields):
+    rule = Rule(name="r", predicate="any")
+    rule.conditions = [RuleCondition(field=field, predicate="contains", value="x") for field in fields]
+    return rule
+
+def test_plan_only_fetches_bodies_for_body_rules():
+    headers_only = plan_fetch([make_rule("from", "subject"), make_rule("received_date", "is_read")])
+    assert headers_only.format == 'metadata'
+    assert headers_only.metadata_headers == ['From', 'To', 'Subject', 'Date']
+    assert plan_fetch([make_rule("subject"), make_rule("message")]).format == 'full'
+    assert plan_fetch([]).format == 'metadata'
+
+def test_metadata_messages_parse_without_a_body(gmail_client, server):
+    msg_id = server.mailbox.ordered_ids()[0]
+    full = gmail_client.parse_message(gmail_client.get_message(msg_id))
+    metadata = gmail_client.parse_message(gmail_client.get_message(
+        msg_id, format='metadata', metadata_headers=['From', 'To', 'Subject', 'Date']))
+    assert metadata['message'] is None
+    assert full['message']
+    assert {key: value for key, value in full.items() if key != 'message'} == \
+        {key: value for key, value in metadata.items() if key != 'message'}
+
+def test_bodies_are_fetched_later_when_a_rule_needs_them(gmail_client, server, db):
+    sync = MailboxSync(gmail_client, db, max_results=40, fetch_plan=plan_fetch([make_rule("subject")]))
+    assert sync.sync()['added'] == 40
+    assert db.query(Email).filter(Email.message.is_(None)).count() == 40
+
+    assert sync.fetch_missing_bodies(chunk_size=15) == 40
+    assert db.query(Email).filter(Email.message.is_(None)).count() == 0
+    msg_id = server.mailbox.ordered_ids()[5]
+    email = db.query(Email).filter_by(gmail_id=msg_id).one()
+    assert email.message == gmail_client.parse_message(server.mailbox.messages[msg_id])['message']
+    assert sync.fetch_missing_bodies() == 0
+
+def test_bodies_gmail_no_longer_has_are_not_requested_again(gmail_client, server, db):
+    sync = MailboxSync(gmail_client, db, max_results=40, fetch_plan=plan_fetch([make_rule("subject")]))
+    sync.sync()
+    gone = server.mailbox.ordered_ids()[:2]
+    for msg_id in gone:
+        server.mailbox.messages.pop(msg_id)
+
+    assert sync.fetch_missing_bodies() == 38
+    assert db.query(Email).filter(Email.gmail_id.in_(gone)).count() == 0
+    before = server.request_count
+    assert sync.fetch_missing_bodies() == 0
+    assert server.request_count == before
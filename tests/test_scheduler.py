@@ -0,0 +1,99 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from src.gmail.scheduler import RequestScheduler, TokenBucket, is_retryable
+
+def http_error(status, content=b'{}', headers=None):
+    response = httplib2.Response(dict({'status': status}, **(headers or {})))
+    return HttpError(response, content)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class FlakyRequest:
+    def __init__(self, *errors, result='ok'):
+        self.errors = list(errors)
+        self.result = result
+        self.calls = 0
+
+    def execute(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.result
+
+def test_retryable_errors():
+    assert is_retryable(http_error(429))
+    assert is_retryable(http_error(503))
+    assert is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'))
+    assert not is_retryable(http_error(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}'))
+    assert not is_retryable(http_error(404))
+    assert is_retryable(ConnectionResetError())
+    assert not is_retryable(ValueError())
+
+def test_bucket_spaces_callers_at_the_refill_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=100, capacity=100, clock=clock, sleep=clock.sleep)
+    # The burst is served at once, then each call waits for its own units
+    assert bucket.acquire(100) == 0
+    assert bucket.acquire(50) == pytest.approx(0.5)
+    assert bucket.acquire(50) == pytest.approx(0.5)
+    clock.now += 10
+    assert bucket.acquire(100) == 0
+
+def test_retries_with_backoff_until_success():
+    clock = FakeClock()
+    scheduler = RequestScheduler(rate=None, base_delay=1, sleep=clock.sleep, clock=clock)
+    request = FlakyRequest(http_error(429), http_error(500))
+    assert scheduler.execute('messages.get', request) == 'ok'
+    assert request.calls == 3
+    assert len(clock.sleeps) == 2
+    assert 0 <= clock.sleeps[0] <= 1 and 0 <= clock.sleeps[1] <= 2
+    stats = scheduler.stats()
+    assert stats['retries'] == 2 and stats['failures'] == 0 and stats['requests'] == 3
+
+def test_retry_after_is_honoured():
+    clock = FakeClock()
+    scheduler = RequestScheduler(rate=None, sleep=clock.sleep, clock=clock)
+    scheduler.execute('messages.get', FlakyRequest(http_error(429, headers={'retry-after': '7'})))
+    assert clock.sleeps == [7.0]
+
+def test_gives_up_after_max_retries_and_on_permanent_errors():
+    clock = FakeClock()
+    scheduler = RequestScheduler(rate=None, max_retries=2, sleep=clock.sleep, clock=clock)
+    request = FlakyRequest(*[http_error(503)] * 5)
+    with pytest.raises(HttpError):
+        scheduler.execute('messages.get', request)
+    assert request.calls == 3
+
+    request = FlakyRequest(http_error(404))
+    with pytest.raises(HttpError):
+        scheduler.execute('messages.get', request)
+    assert request.calls == 1
+    assert scheduler.stats()['failures'] == 2
+
+def test_requests_are_charged_their_quota_units():
+    clock = FakeClock()
+    scheduler = RequestScheduler(rate=100, burst=100, sleep=clock.sleep, clock=clock)
+    for _ in range(2):
+        scheduler.execute('messages.batchModify', FlakyRequest())
+    scheduler.execute('messages.get', FlakyRequest(), units=100)
+    stats = scheduler.stats()
+    assert stats['units'] == 200
+    assert stats['throttled_seconds'] == pytest.approx(1.0)
+
+def test_rate_limit_drains_the_bucket():
+    clock = FakeClock()
+    scheduler = RequestScheduler(rate=100, burst=100, base_delay=0, sleep=clock.sleep, clock=clock)
+    scheduler.execute('messages.get', FlakyRequest(http_error(429)))
+    # The retry had to wait for a refill instead of using the remaining burst
+    assert scheduler.stats()['throttled_seconds'] == pytest.approx(0.05)
@@ -0,0 +1,80 @@
+import threading
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import sessionmaker
+from src.database.fts import FTS_TABLE
+from src.database.models import Email
+from src.database.schema import upgrade_schema
+from src.database.sqlite import create_database_engine
+
+# The schema of databases created before the ledger, labels, sync state, full-text index
+# and email indexes existed
+OLD_SCHEMA = [
+    "CREATE TABLE emails (id INTEGER PRIMARY KEY, gmail_id VARCHAR NOT NULL UNIQUE, thread_id VARCHAR NOT NULL, "
+    "from_address VARCHAR NOT NULL, to_address VARCHAR NOT NULL, subject VARCHAR, message TEXT, "
+    "received_date DATETIME NOT NULL, is_read BOOLEAN, label VARCHAR, created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE rules (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, predicate VARCHAR NOT NULL, "
+    "priority INTEGER, created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE rule_conditions (id INTEGER PRIMARY KEY, rule_id INTEGER NOT NULL REFERENCES rules (id), "
+    "field VARCHAR NOT NULL, predicate VARCHAR NOT NULL, value VARCHAR NOT NULL)",
+    "CREATE TABLE rule_actions (id INTEGER PRIMARY KEY, rule_id INTEGER NOT NULL REFERENCES rules (id), "
+    "action_type VARCHAR NOT NULL, value VARCHAR)",
+    # Before the backfill could be resumed
+    "CREATE TABLE sync_state (id INTEGER PRIMARY KEY, account VARCHAR NOT NULL UNIQUE, history_id VARCHAR, "
+    "updated_at DATETIME)",
+    "INSERT INTO emails (gmail_id, thread_id, from_address, to_address, subject, message, received_date, is_read) "
+    "VALUES ('1', 't1', 'Boss@work.com', 'me@x.com', 'Quarterly report', 'numbers attached', "
+    "'2024-01-02 10:00:00', 0)",
+]
+
+def test_old_database_is_upgraded_in_place(tmp_path):
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.execute(text(statement))
+
+    changes = upgrade_schema(engine)
+    assert 'created table processed_emails' in changes and 'created table meta' in changes
+    assert 'added column sync_state.backfill_token' in changes
+    assert {f'created index {index.name}' for index in Email.__table__.indexes} <= set(changes)
+    assert f'built {FTS_TABLE} over 1 emails' in changes
+
+    db = sessionmaker(bind=engine)()
+    email = db.query(Email).one()
+    assert (email.subject, email.message) == ('Quarterly report', 'numbers attached')
+    assert db.execute(text(f"SELECT rowid FROM {FTS_TABLE} WHERE message MATCH '\"attached\"'")).all() == [(email.id,)]
+    indexes = {name for name, in db.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    assert {index.name for index in Email.__table__.indexes} <= indexes
+    db.close()
+
+    assert upgrade_schema(engine) == []
+    assert 'backfill_query' in {column['name'] for column in inspect(engine).get_columns('sync_state')}
+    engine.dispose()
+
+def test_profile_lets_writers_commit_while_a_reader_is_open(tmp_path):
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'wal.db'}")
+    upgrade_schema(engine)
+    with engine.begin() as connection:
+        for key in 'abc':
+            connection.execute(text("INSERT INTO meta (key) VALUES (:key)"), {'key': key})
+
+    with engine.connect() as reader:
+        assert reader.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+        assert reader.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        # A half-read result keeps a read lock, which would block the writer's commit without WAL
+        rows = reader.execute(text("SELECT key FROM meta ORDER BY key"))
+        assert rows.fetchone() == ('a',)
+
+        committed = threading.Event()
+
+        def write():
+            with engine.begin() as writer:
+                writer.execute(text("INSERT INTO meta (key) VALUES ('d')"))
+            committed.set()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        assert committed.wait(2)
+        thread.join()
+        # The reader still sees the snapshot it started with
+        assert [key for key, in rows] == ['b', 'c']
+    engine.dispose()
@@ -0,0 +1,100 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from benchmarks.synthetic import make_email_data, make_rules
+from src.database.ingest import ingest_emails
+from src.database.models import ConditionStat, Email, Rule, RuleCondition
+from src.metrics import metrics
+from src.rules.compiler import compile_rules
+from src.rules.engine import RuleEngine
+from src.rules.selectivity import (analyze_conditions, load_condition_stats, order_conditions,
+                                   refresh_condition_stats, save_condition_stats)
+
+@pytest.fixture
+def recording():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+def make_rule(predicate, *conditions):
+    return Rule(name='Rule', predicate=predicate,
+                conditions=[RuleCondition(field=field, predicate=test, value=value)
+                            for field, test, value in conditions])
+
+def fields(rule):
+    return [condition.field for condition in rule.conditions]
+
+def test_cheap_conditions_run_first_without_statistics():
+    rule = make_rule('all', ('message', 'contains', 'unsubscribe'), ('subject', 'contains', 'sale'),
+                     ('is_read', 'equals', 'false'))
+    compiled, = compile_rules([rule])
+    assert fields(compiled) == ['is_read', 'subject', 'message']
+    # The stored rule keeps its order
+    assert [condition.field for condition in rule.conditions] == ['message', 'subject', 'is_read']
+
+def test_statistics_put_rejecting_conditions_first_for_all_and_likely_matches_first_for_any():
+    conditions = (('subject', 'contains', 'weekly'), ('subject', 'contains', 'report'))
+    stats = {'subject contains weekly': (1000, 900), 'subject contains report': (1000, 10)}
+    compiled, = compile_rules([make_rule('all', *conditions)], stats=stats)
+    assert [condition.value for condition in compiled.conditions] == ['report', 'weekly']
+    compiled, = compile_rules([make_rule('any', *conditions)], stats=stats)
+    assert [condition.value for condition in compiled.conditions] == ['weekly', 'report']
+    assert order_conditions(compiled.conditions, 'unknown', stats) == compiled.conditions
+
+def test_ordering_keeps_results_and_evaluates_fewer_conditions(db, recording):
+    rng = random.Random(6)
+    now = datetime.utcnow()
+    ingest_emails(db, [make_email_data(index, rng, now) for index in range(400)])
+    emails = db.query(Email).all()
+    rules = make_rules(30, seed=3)
+    engine = RuleEngine(gmail_client=None)
+
+    def evaluate(rule_set):
+        recording.reset()
+        matches = [[rule.name for rule in rule_set if engine.evaluate_rule(email, rule)] for email in emails]
+        return matches, sum(recording.totals('condition_evaluations_total', 'rule').values())
+
+    # Plain rules are interpreted in their stored order
+    stored_matches, stored_evaluations = evaluate(rules)
+    save_condition_stats(db, analyze_conditions(db, compile_rules(rules), sample_size=1000))
+    ordered_matches, ordered_evaluations = evaluate(compile_rules(rules, stats=load_condition_stats(db)))
+    assert ordered_matches == stored_matches
+    assert ordered_evaluations < stored_evaluations * 0.9
+
+def test_condition_stats_round_trip(db):
+    rng = random.Random(1)
+    ingest_emails(db, [make_email_data(index, rng, datetime.utcnow()) for index in range(50)])
+    rules = compile_rules([make_rule('all', ('is_read', 'equals', 'true'), ('message', 'contains', 'a'))])
+    counts = analyze_conditions(db, rules, sample_size=1000)
+    read = db.query(Email).filter(Email.is_read.is_(True)).count()
+    assert counts['is_read equals true'] == (50, read)
+    save_condition_stats(db, counts)
+    save_condition_stats(db, {'is_read equals true': (10, 4)})
+    stats = load_condition_stats(db)
+    assert stats['is_read equals true'] == (10, 4)
+    assert stats['message contains a'] == counts['message contains a']
+    assert analyze_conditions(db, compile_rules([]), sample_size=10) == {}
+
+def test_condition_stats_are_sampled_again_only_when_needed(db):
+    rng = random.Random(2)
+    ingest_emails(db, [make_email_data(index, rng, datetime.utcnow()) for index in range(20)])
+    rules = compile_rules([make_rule('all', ('is_read', 'equals', 'true'))])
+    assert refresh_condition_stats(db, rules)
+    assert load_condition_stats(db)['is_read equals true'][0] == 20
+    # Same conditions, fresh counts: nothing is read, even if the actions or names differ
+    assert not refresh_condition_stats(db, rules)
+    renamed = compile_rules([Rule(name='Other', predicate='all', conditions=[
+        RuleCondition(field='is_read', predicate='equals', value='true')])])
+    assert not refresh_condition_stats(db, renamed)
+
+    changed = compile_rules([make_rule('any', ('is_read', 'equals', 'true'), ('subject', 'contains', 'sale'))])
+    assert refresh_condition_stats(db, changed)
+    assert 'subject contains sale' in load_condition_stats(db)
+    assert not refresh_condition_stats(db, changed)
+
+    db.query(ConditionStat).update({'updated_at': datetime.utcnow() - timedelta(days=2)})
+    db.commit()
+    assert refresh_condition_stats(db, changed)
+    assert not refresh_condition_stats(db, changed)
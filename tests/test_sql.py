@@ -0,0 +1,94 @@
+import pytest
+from datetime import datetime, timedelta
+from src.database.models import Email, Rule, RuleCondition
+from src.rules.compiler import compile_rules
+from src.rules.sql import candidate_email_ids, plan_candidates, rules_filter
+
+NOW = datetime(2024, 6, 1)
+
+@pytest.fixture
+def emails(db):
+    rows = [
+        Email(gmail_id="1", thread_id="t", from_address="News@Example.com", to_address="me@x.com",
+              subject="Weekly 100% Newsletter", message="sale", received_date=NOW - timedelta(days=1), is_read=False),
+        Email(gmail_id="2", thread_id="t", from_address="boss@work.com", to_address="me@x.com",
+              subject=None, message="Café meeting", received_date=NOW - timedelta(days=20), is_read=True),
+        Email(gmail_id="3", thread_id="t", from_address="friend@gmail.com", to_address="me@x.com",
+              subject="urgent_stuff", message=None, received_date=NOW - timedelta(days=3), is_read=None),
+    ]
+    db.add_all(rows)
+    db.commit()
+    return rows
+
+def make_rule(predicate, *conditions):
+    rule = Rule(name="r", predicate=predicate)
+    rule.conditions = [RuleCondition(field=f, predicate=p, value=v) for f, p, v in conditions]
+    return compile_rules([rule], now=NOW)[0]
+
+CONDITIONS = [
+    ("subject", "contains", "newsletter"),
+    ("subject", "contains", "100%"),
+    ("subject", "contains", "t_s"),
+    ("subject", "contains", "non"),
+    ("subject", "not_contains", "urgent"),
+    ("subject", "equals", "none"),
+    ("subject", "not_equals", "urgent_stuff"),
+    ("from", "equals", "news@example.com"),
+    ("message", "contains", "CAFÉ"),
+    ("message", "contains", "sale"),
+    ("message", "contains", "caf"),
+    ("message", "contains", "non"),
+    ("message", "not_contains", "café"),
+    ("is_read", "equals", "false"),
+    ("is_read", "not_equals", "true"),
+    ("is_read", "contains", "fal"),
+    ("received_date", "less_than", "7 days"),
+    ("received_date", "greater_than", "7 days"),
+    ("received_date", "less_than", "soon"),
+    ("from", "starts_with", "NEWS@"),
+    ("subject", "starts_with", "100%"),
+    ("subject", "starts_with", "non"),
+    ("from", "domain_is", "@Example.com"),
+    ("from", "domain_is", "ample.com"),
+    ("to", "domain_is", "x.com"),
+]
+
+@pytest.mark.parametrize("field,predicate,value", CONDITIONS)
+def test_candidates_cover_python_matches(db, emails, field, predicate, value):
+    rule = make_rule("all", (field, predicate, value))
+    candidates = set(candidate_email_ids(db, rule))
+    matches = {email.id for email in emails if rule.matches(email)}
+    assert matches <= candidates
+    if value.isascii() and field != "is_read" or predicate in ("equals", "not_equals"):
+        assert candidates == matches
+
+def test_rule_predicates_combine_filters(db, emails):
+    both = make_rule("all", ("subject", "contains", "newsletter"), ("is_read", "equals", "false"))
+    assert set(candidate_email_ids(db, both)) == {emails[0].id}
+
+    either = make_rule("any", ("subject", "contains", "urgent"), ("from", "contains", "work.com"))
+    assert set(candidate_email_ids(db, either)) == {emails[1].id, emails[2].id}
+
+    # An untranslatable branch of an 'any' rule leaves the rule unrestricted
+    loose = make_rule("any", ("subject", "contains", "urgent"), ("is_read", "contains", "x"))
+    assert set(candidate_email_ids(db, loose)) == {email.id for email in emails}
+
+    assert candidate_email_ids(db, make_rule("all")) == []
+
+def test_plan_candidates_keeps_rule_order(db, emails):
+    first = make_rule("all", ("received_date", "less_than", "7 days"))
+    second = make_rule("all", ("subject", "contains", "newsletter"))
+    plan = plan_candidates(db, [first, second])
+    assert plan == {emails[0].id: [first, second], emails[2].id: [first]}
+
+def test_rules_filter_is_the_union_of_rule_filters(db, emails):
+    newsletter = make_rule("all", ("subject", "contains", "newsletter"))
+    urgent = make_rule("all", ("subject", "contains", "urgent"))
+    candidates = {email.id for email in db.query(Email).filter(rules_filter([newsletter, urgent]))}
+    assert candidates == {emails[0].id, emails[2].id}
+    assert db.query(Email).filter(rules_filter([])).count() == 0
+
+def test_regex_conditions_are_not_pushed_down(db, emails):
+    rule = make_rule("all", ("subject", "matches", r"^weekly\s"), ("received_date", "less_than", "7 days"))
+    assert set(candidate_email_ids(db, rule)) == {emails[0].id, emails[2].id}
+    assert [email.id for email in emails if rule.matches(email)] == [emails[0].id]
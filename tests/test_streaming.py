@@ -0,0 +1,44 @@
+import random
+from datetime import datetime
+from benchmarks.synthetic import make_email_data
+from src.database.ingest import ingest_emails
+from src.database.models import Email
+from src.database.streaming import iter_email_chunks
+
+def make_rows(count):
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    return [make_email_data(index, rng, now, body_words=5) for index in range(count)]
+
+def test_chunks_cover_every_email_in_id_order(db):
+    ingest_emails(db, make_rows(23))
+    chunks = list(iter_email_chunks(db, chunk_size=5))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 5, 5, 3]
+    ids = [email.id for chunk in chunks for email in chunk]
+    assert ids == sorted(ids) and len(set(ids)) == 23
+
+def test_chunks_apply_filters(db):
+    ingest_emails(db, make_rows(30))
+    expected = [email_id for email_id, in db.query(Email.id).filter(Email.is_read.is_(False)).order_by(Email.id)]
+    streamed = [email.id for chunk in iter_email_chunks(db, [Email.is_read.is_(False)], chunk_size=4) for email in chunk]
+    assert streamed == expected
+
+def test_processed_chunks_are_expunged(db):
+    ingest_emails(db, make_rows(12))
+    chunks = iter_email_chunks(db, chunk_size=5)
+    first = next(chunks)
+    assert all(email in db for email in first)
+    second = next(chunks)
+    assert not any(email in db for email in first)
+    assert len(db.identity_map) == len(second)
+
+def test_rows_changed_mid_stream_do_not_shift_pages(db):
+    ingest_emails(db, make_rows(10))
+    seen = []
+    for chunk in iter_email_chunks(db, [Email.is_read.is_(False)], chunk_size=3):
+        for email in chunk:
+            seen.append(email.id)
+            email.is_read = True
+        db.commit()
+    assert len(seen) == len(set(seen))
+    assert db.query(Email).filter(Email.is_read.is_(False)).count() == 0
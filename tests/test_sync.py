@@ -0,0 +1,150 @@
+import pytest
+from src.database.models import Email, Rule, RuleAction, RuleCondition, SyncState
+from src.gmail.client import GmailClient
+from src.gmail.fake_server import FakeGmailServer, FakeMailbox
+from src.gmail.sync import MailboxSync
+from src.gmail.scheduler import RequestScheduler
+from src.rules.compiler import compile_rules
+from src.rules.processing import process_stored_emails
+
+# The fake server has no quota to stay within
+UNTHROTTLED = RequestScheduler(rate=None)
+
+@pytest.fixture
+def server():
+    with FakeGmailServer(FakeMailbox(30, seed=2)) as server:
+        yield server
+
+@pytest.fixture
+def sync(server, db):
+    return MailboxSync(GmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED), db, max_results=50)
+
+def stored(db):
+    return {email.gmail_id: email for email in db.query(Email)}
+
+def test_first_run_is_a_full_sync(sync, server, db):
+    stats = sync.sync()
+    assert stats['added'] == 30
+    assert set(stored(db)) == set(server.mailbox.messages)
+    assert db.query(SyncState).one().history_id == str(server.mailbox.history_id)
+
+def test_incremental_sync_applies_only_changes(sync, server, db):
+    sync.sync()
+    mailbox = server.mailbox
+    ids = mailbox.ordered_ids()
+    new = mailbox.add_new()
+    mailbox.delete(ids[0])
+    mailbox.modify_labels(ids[1], add=['UNREAD', 'Label_7'])
+    mailbox.modify_labels(ids[2], remove=['UNREAD'])
+    before = server.request_count
+
+    stats = sync.sync()
+
+    emails = stored(db)
+    assert stats == {'added': 1, 'deleted': 1, 'relabelled': 2}
+    assert new['id'] in emails and ids[0] not in emails
+    assert emails[ids[1]].is_read is False
+    assert 'Label_7' in emails[ids[1]].label.split(',')
+    assert emails[ids[2]].is_read is True
+    # profile + history + one batch for the new message
+    assert server.request_count - before == 3
+    assert db.query(SyncState).one().history_id == str(mailbox.history_id)
+
+def test_incremental_sync_keeps_to_the_filters(server, db):
+    mailbox = server.mailbox
+    client = GmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED)
+    labelled = MailboxSync(client, db, account='labelled', max_results=50, label_ids=['Label_7'])
+    searched = MailboxSync(client, db, account='searched', max_results=50, query='subject:invoice')
+    labelled.sync()
+    searched.sync()
+    before = set(stored(db))
+
+    new = [mailbox.add_new() for _ in range(8)]
+    # Labelled on arrival, or later in the same replay
+    mailbox.modify_labels(new[0]['id'], add=['Label_7'])
+    mailbox.modify_labels(new[1]['id'], add=['Label_7'])
+    assert labelled.sync()['added'] == 2
+    invoices = {message['id'] for message in new if any(
+        header['name'] == 'Subject' and 'invoice' in header['value'].lower()
+        for header in message['payload']['headers'])}
+    assert invoices - {new[0]['id'], new[1]['id']}
+    searched.sync()
+    assert set(stored(db)) - before == {new[0]['id'], new[1]['id']} | invoices
+
+def test_expired_history_falls_back_to_full_sync(sync, server, db):
+    sync.sync()
+    mailbox = server.mailbox
+    msg_id = mailbox.ordered_ids()[3]
+    mailbox.modify_labels(msg_id, add=['UNREAD'])
+    mailbox.modify_labels(msg_id, remove=['UNREAD'])
+    mailbox.modify_labels(msg_id, add=['STARRED'])
+    mailbox.expire_history()
+
+    stats = sync.sync()
+    assert stats['added'] == 0
+    assert 'STARRED' in stored(db)[msg_id].label
+
+def test_backfill_resumes_from_saved_cursor(server, db, monkeypatch):
+    client = GmailClient(api_endpoint=server.url, scheduler=UNTHROTTLED)
+    sync = MailboxSync(client, db)
+    original = client.iter_messages
+
+    def crash_on_second_page(**kwargs):
+        for index, message in enumerate(original(**dict(kwargs, page_size=10))):
+            if index == 10:
+                raise RuntimeError("crash")
+            yield message
+
+    monkeypatch.setattr(client, 'iter_messages', crash_on_second_page)
+    with pytest.raises(RuntimeError):
+        sync.backfill(query='is:unread')
+    monkeypatch.setattr(client, 'iter_messages', lambda **kwargs: original(**dict(kwargs, page_size=10)))
+    db.rollback()
+
+    state = db.query(SyncState).one()
+    assert state.backfill_token == '10'
+    assert db.query(Email).count() == 10
+
+    before = server.request_count
+    added = sync.backfill(query='is:unread')
+    unread = [m for m in server.mailbox.messages.values() if 'UNREAD' in m['labelIds']]
+    assert added == len(unread) - 10
+    assert db.query(Email).count() == len(unread)
+    assert state.backfill_token is None and state.backfill_query is None
+    # The first page is not listed again
+    assert server.request_count - before < 2 * (len(unread) // 10 + 1)
+
+def test_rule_actions_coming_back_through_sync_keep_emails_processed(sync, server, db):
+    sync.sync()
+    rule = Rule(name="File", predicate="all", priority=0,
+                conditions=[RuleCondition(field="subject", predicate="not_contains", value="zzz")],
+                actions=[RuleAction(action_type="mark_as_read"), RuleAction(action_type="move_to", value="Done")])
+    rules = compile_rules([rule])
+    assert process_stored_emails(sync.gmail_client, db, rules) == 30
+
+    # The read state and labels the actions set are not changes to process again
+    assert sync.sync()['relabelled'] == 30
+    assert process_stored_emails(sync.gmail_client, db, rules) == 0
+
+    # A change made outside the processor still is
+    server.mailbox.modify_labels(server.mailbox.ordered_ids()[0], add=['UNREAD'])
+    sync.sync()
+    assert process_stored_emails(sync.gmail_client, db, rules) == 1
+
+def test_only_read_state_changes_move_updated_at(sync, server, db):
+    sync.sync()
+    mailbox = server.mailbox
+    relabelled, toggled = mailbox.ordered_ids()[:2]
+    before = {email.gmail_id: email.updated_at for email in db.query(Email)}
+    mailbox.modify_labels(relabelled, add=['Label_7'])
+    if 'UNREAD' in mailbox.messages[toggled]['labelIds']:
+        mailbox.modify_labels(toggled, remove=['UNREAD'])
+    else:
+        mailbox.modify_labels(toggled, add=['UNREAD'])
+
+    assert sync.sync()['relabelled'] == 2
+    emails = stored(db)
+    assert 'Label_7' in emails[relabelled].label.split(',')
+    assert emails[relabelled].updated_at == before[relabelled]
+    assert emails[toggled].is_read == ('UNREAD' not in mailbox.messages[toggled]['labelIds'])
+    assert emails[toggled].updated_at > before[toggled]
@@ -0,0 +1,56 @@
+from datetime import datetime
+from sqlalchemy import text
+from src.database.models import Email, Rule, RuleCondition
+from src.database.streaming import iter_email_chunks
+from src.database.types import CompressedText
+from src.rules.compiler import compile_rules
+from src.rules.sql import email_load_options
+
+def add_email(db, message, gmail_id="1"):
+    email = Email(gmail_id=gmail_id, thread_id="t", from_address="a@x.com", to_address="me@x.com",
+                  subject="Hi", message=message, received_date=datetime.utcnow())
+    db.add(email)
+    db.commit()
+    return email.id
+
+def make_rule(field):
+    rule = Rule(name="r", predicate="all")
+    rule.conditions = [RuleCondition(field=field, predicate="contains", value="x")]
+    return rule
+
+def raw_message(db, email_id):
+    return db.execute(text("SELECT message FROM emails WHERE id = :id"), {"id": email_id}).scalar()
+
+def test_values_round_trip():
+    column = CompressedText(threshold=10)
+    for value in (None, "", "short", "héllo wörld " * 50):
+        assert column.process_result_value(column.process_bind_param(value, None), None) == value
+
+def test_long_bodies_are_compressed_short_ones_are_not(db):
+    body = "weekly newsletter with the same words again " * 200
+    long_id = add_email(db, body)
+    short_id = add_email(db, "ok", gmail_id="2")
+    stored = raw_message(db, long_id)
+    assert stored[:1] == b"\x01" and len(stored) < len(body) / 10
+    assert raw_message(db, short_id) == b"\x00ok"
+    db.expire_all()
+    assert db.get(Email, long_id).message == body
+
+def test_legacy_text_rows_are_read_unchanged(db):
+    email_id = add_email(db, None)
+    db.execute(text("UPDATE emails SET message = 'plain old body' WHERE id = :id"), {"id": email_id})
+    db.commit()
+    db.expire_all()
+    assert db.get(Email, email_id).message == "plain old body"
+
+def test_bodies_are_only_loaded_when_a_rule_reads_them(db):
+    add_email(db, "body text")
+    header_rules = compile_rules([make_rule("subject")])
+    body_rules = compile_rules([make_rule("message")])
+    assert email_load_options(header_rules) == []
+
+    email = next(iter_email_chunks(db, options=email_load_options(header_rules)))[0]
+    assert 'message' not in email.__dict__
+    db.expire_all()
+    email = next(iter_email_chunks(db, options=email_load_options(body_rules)))[0]
+    assert email.__dict__['message'] == "body text"